@@ -0,0 +1,351 @@
+"""
+/api/process 的准入控制
+全局并发上限、按API密钥的并发上限和令牌桶限流，超出时进入有界等待队列，队列满时快速拒绝
+名额只由实际发起的上游调用占用（合并到在途调用的请求不占用）；限流按客户端请求计
+多进程模式下并发名额和令牌桶保存在共享状态中，上限对所有工作进程合计生效；等待队列仍在各进程内
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+from shared_state import SharedState, get_shared_state, SHARED_STATE_POLL_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# 准入配置（从环境变量读取，如果没有则使用默认值）
+ADMISSION_MAX_CONCURRENT = int(os.getenv("ADMISSION_MAX_CONCURRENT", "64"))  # 同时进行的上游调用总数
+ADMISSION_MAX_PER_KEY = int(os.getenv("ADMISSION_MAX_PER_KEY", "8"))  # 每个API密钥同时进行的上游调用数
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "128"))  # 等待队列长度
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "120"))  # 最长排队时间（秒）
+ADMISSION_RATE_PER_KEY = float(os.getenv("ADMISSION_RATE_PER_KEY", "0"))  # 每个API密钥每秒允许的请求数，0表示不限
+ADMISSION_BURST = float(os.getenv("ADMISSION_BURST", "10"))  # 令牌桶容量
+
+# 令牌桶数量超过该值时清理已经回满的桶
+_MAX_BUCKETS = 10000
+
+
+class AdmissionRejected(Exception):
+    """请求被准入控制拒绝"""
+
+    def __init__(self, reason: str, detail: str, status_code: int = 503, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.reason = reason  # queue_full | rate_limited | queue_timeout
+        self.detail = detail
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class _TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, capacity: float):
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, rate: float, capacity: float) -> None:
+        now = time.monotonic()
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+
+class AdmissionWait:
+    """排队中的上游调用在流中产出的状态：排队位置（从1开始）和已排队的秒数"""
+    __slots__ = ("position", "waited")
+
+    def __init__(self, position: int, waited: float):
+        self.position = position
+        self.waited = waited
+
+
+class Ticket:
+    """一个请求的准入凭证"""
+    __slots__ = ("key", "admitted", "released", "enqueued_at", "admitted_at", "shared", "_changed")
+
+    def __init__(self, key: str):
+        self.key = key
+        self.admitted = False
+        self.shared = False  # 是否占用了共享状态中的名额
+        self.released = False
+        self.enqueued_at = time.monotonic()
+        self.admitted_at: Optional[float] = None
+        self._changed = asyncio.Event()
+
+    def notify(self) -> None:
+        self._changed.set()
+
+    async def wait(self, timeout: float) -> None:
+        """等待被放行或排队位置变化，最多等待 timeout 秒"""
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._changed.clear()
+
+    @property
+    def waited(self) -> float:
+        end = self.admitted_at if self.admitted_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class AdmissionController:
+    """准入控制器（单事件循环内使用，无需加锁；共享状态由 SharedState 自己加锁）"""
+
+    def __init__(
+        self,
+        max_concurrent: int = ADMISSION_MAX_CONCURRENT,
+        max_per_key: int = ADMISSION_MAX_PER_KEY,
+        queue_size: int = ADMISSION_QUEUE_SIZE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+        rate_per_key: float = ADMISSION_RATE_PER_KEY,
+        burst: float = ADMISSION_BURST,
+        shared: Callable[[], Optional[SharedState]] = get_shared_state
+    ):
+        self.max_concurrent = max_concurrent
+        self.max_per_key = max_per_key
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.rate_per_key = rate_per_key
+        self.burst = burst
+        self._shared = shared
+        self._poll_task: Optional[asyncio.Task] = None
+        self._active = 0
+        self._active_per_key: Dict[str, int] = {}
+        self._queue: Deque[Ticket] = deque()
+        self._buckets: Dict[str, _TokenBucket] = {}
+        # 监控统计
+        self.admitted_total = 0
+        self.queued_total = 0
+        self.rejected: Dict[str, int] = {"queue_full": 0, "rate_limited": 0, "queue_timeout": 0}
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.shared_errors = 0
+
+    @property
+    def shared(self) -> Optional[SharedState]:
+        """共享状态（第一次使用时才打开数据库），未启用时为None"""
+        return self._shared()
+
+    @staticmethod
+    def key_for(api_key: Optional[str]) -> str:
+        """API密钥只以哈希形式保存"""
+        return hashlib.sha256((api_key or "").encode("utf-8")).hexdigest()[:16]
+
+    def _shared_failed(self, e: sqlite3.Error) -> None:
+        """共享状态不可用（如写锁等待超时）时本次按进程内状态判断"""
+        self.shared_errors += 1
+        logger.warning("[Admission] 共享状态操作失败，按进程内状态判断: %s", e)
+
+    def check_rate(self, api_key: Optional[str]) -> None:
+        """客户端请求的限流（每个请求取一个令牌，批量请求和分段处理也只算一个），令牌不足时抛出 AdmissionRejected"""
+        self._take_token(self.key_for(api_key))
+
+    def _take_token(self, key: str) -> None:
+        if self.rate_per_key <= 0:
+            return
+        if self.shared is not None:
+            try:
+                retry_after = self.shared.take_token(key, self.rate_per_key, self.burst)
+            except sqlite3.Error as e:
+                self._shared_failed(e)
+            else:
+                if retry_after is not None:
+                    self._reject_rate_limited(retry_after)
+                return
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= _MAX_BUCKETS:
+                self._prune_buckets()
+            bucket = self._buckets[key] = _TokenBucket(self.burst)
+        bucket.refill(self.rate_per_key, self.burst)
+        if bucket.tokens < 1:
+            self._reject_rate_limited((1 - bucket.tokens) / self.rate_per_key)
+        bucket.tokens -= 1
+
+    def _reject_queue_full(self) -> None:
+        self.rejected["queue_full"] += 1
+        raise AdmissionRejected("queue_full", f"服务器繁忙，等待队列已满（{self.queue_size}），请稍后重试")
+
+    def _reject_rate_limited(self, retry_after: float) -> None:
+        self.rejected["rate_limited"] += 1
+        raise AdmissionRejected(
+            "rate_limited",
+            f"请求过于频繁，请 {retry_after:.1f} 秒后重试",
+            status_code=429,
+            retry_after=round(retry_after, 2)
+        )
+
+    def _prune_buckets(self) -> None:
+        full = []
+        for key, bucket in self._buckets.items():
+            bucket.refill(self.rate_per_key, self.burst)
+            if bucket.tokens >= self.burst:
+                full.append(key)
+        for key in full:
+            del self._buckets[key]
+
+    def _can_admit(self, key: str) -> bool:
+        return self._active < self.max_concurrent and self._active_per_key.get(key, 0) < self.max_per_key
+
+    @staticmethod
+    def _slot_names(key: str) -> List[str]:
+        return ["global", f"key:{key}"]
+
+    def _try_admit(self, ticket: Ticket) -> bool:
+        """检查进程内和共享的名额，都有空闲时放行"""
+        if not self._can_admit(ticket.key):
+            return False
+        if self.shared is not None:
+            global_name, key_name = self._slot_names(ticket.key)
+            try:
+                if not self.shared.try_acquire([(global_name, self.max_concurrent), (key_name, self.max_per_key)]):
+                    return False
+                ticket.shared = True
+            except sqlite3.Error as e:
+                self._shared_failed(e)
+        self._admit(ticket)
+        return True
+
+    def _admit(self, ticket: Ticket) -> None:
+        ticket.admitted = True
+        ticket.admitted_at = time.monotonic()
+        self._active += 1
+        self._active_per_key[ticket.key] = self._active_per_key.get(ticket.key, 0) + 1
+        self.admitted_total += 1
+        waited = ticket.waited
+        self.wait_time_total += waited
+        if waited > self.wait_time_max:
+            self.wait_time_max = waited
+
+    def submit(self, api_key: Optional[str]) -> Ticket:
+        """
+        申请执行一个上游调用（限流由 check_rate 按客户端请求单独计算）
+
+        有空闲名额时立即放行；否则进入等待队列。队列已满时抛出 AdmissionRejected。
+        """
+        key = self.key_for(api_key)
+        ticket = Ticket(key)
+        if not self._queue and self._try_admit(ticket):
+            return ticket
+        if len(self._queue) >= self.queue_size:
+            self._reject_queue_full()
+        self._queue.append(ticket)
+        self.queued_total += 1
+        # 队列中可能有其他密钥的请求被并发上限阻塞，而本请求可以立即执行
+        self._dispatch()
+        self._ensure_polling()
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """排队位置（从1开始），已放行时返回0"""
+        if ticket.admitted:
+            return 0
+        for index, queued in enumerate(self._queue):
+            if queued is ticket:
+                return index + 1
+        return 0
+
+    def expire(self, ticket: Ticket) -> None:
+        """排队超时：移出队列并记录拒绝"""
+        self.rejected["queue_timeout"] += 1
+        self.release(ticket)
+
+    def release(self, ticket: Ticket) -> None:
+        """释放名额（已放行）或离开队列（未放行），可重复调用"""
+        if ticket.released:
+            return
+        ticket.released = True
+        if ticket.admitted:
+            if ticket.shared:
+                try:
+                    self.shared.release(self._slot_names(ticket.key))
+                except sqlite3.Error as e:
+                    # 名额会在本进程退出时由其他进程回收
+                    self._shared_failed(e)
+            self._active -= 1
+            remaining = self._active_per_key.get(ticket.key, 1) - 1
+            if remaining > 0:
+                self._active_per_key[ticket.key] = remaining
+            else:
+                self._active_per_key.pop(ticket.key, None)
+        else:
+            try:
+                self._queue.remove(ticket)
+            except ValueError:
+                pass
+            else:
+                # 后面的请求排队位置前移
+                for queued in self._queue:
+                    queued.notify()
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """按先进先出放行可以执行的排队请求（跳过达到单密钥上限的请求），并通知位置变化"""
+        if not self._queue:
+            return
+        admitted = []
+        # 共享名额先读一次快照，跳过明显无法放行的请求，避免逐个尝试写事务
+        counts: Optional[Dict[str, int]] = None
+        if self.shared is not None:
+            try:
+                names = ["global"] + sorted({f"key:{ticket.key}" for ticket in self._queue})
+                counts = self.shared.slot_counts(names)
+            except sqlite3.Error as e:
+                self._shared_failed(e)
+        for ticket in list(self._queue):
+            if self._active >= self.max_concurrent:
+                break
+            if counts is not None:
+                if counts.get("global", 0) >= self.max_concurrent:
+                    break
+                if counts.get(f"key:{ticket.key}", 0) >= self.max_per_key:
+                    continue
+            if self._try_admit(ticket):
+                self._queue.remove(ticket)
+                admitted.append(ticket)
+                if counts is not None:
+                    counts["global"] = counts.get("global", 0) + 1
+                    counts[f"key:{ticket.key}"] = counts.get(f"key:{ticket.key}", 0) + 1
+        if admitted:
+            for ticket in admitted:
+                ticket.notify()
+            for ticket in self._queue:
+                ticket.notify()
+
+    def _ensure_polling(self) -> None:
+        """多进程模式下其他进程释放名额时不会通知本进程，有请求排队期间定期检查"""
+        if self.shared is None or (self._poll_task is not None and not self._poll_task.done()):
+            return
+        self._poll_task = asyncio.create_task(self._poll())
+
+    async def _poll(self) -> None:
+        while self._queue:
+            await asyncio.sleep(SHARED_STATE_POLL_INTERVAL)
+            # 一次失败（如写锁等待超时）不能结束轮询，否则排队的请求只能等到超时
+            try:
+                self.shared.cleanup()
+                self._dispatch()
+            except sqlite3.Error as e:
+                self._shared_failed(e)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self._active,
+            "queue_depth": len(self._queue),
+            "queue_size": self.queue_size,
+            "admitted": self.admitted_total,
+            "queued": self.queued_total,
+            "rejected": dict(self.rejected),
+            "wait_time_avg": round(self.wait_time_total / self.admitted_total, 3) if self.admitted_total else 0.0,
+            "wait_time_max": round(self.wait_time_max, 3),
+            "shared": self.shared is not None,
+            "shared_errors": self.shared_errors
+        }
+
+
+# 全局准入控制器
+admission = AdmissionController()
@@ -0,0 +1,269 @@
+"""
+编辑操作的锚点解析
+在服务器端一次扫描文档，定位所有编辑操作的 searchText（Aho-Corasick多模式匹配，忽略大小写），
+为每个编辑操作附上出现次数和偏移量，找不到锚点的编辑操作按配置标记或丢弃，
+前端不必为每个编辑操作单独调用一次 body.search 才发现锚点不存在。
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 锚点解析配置（从环境变量读取，如果没有则使用默认值）
+ANCHOR_RESOLUTION = os.getenv("ANCHOR_RESOLUTION", "flag").lower()  # off（不解析）、flag（标记找不到的锚点）、drop（丢弃）
+ANCHOR_MAX_OFFSETS = int(os.getenv("ANCHOR_MAX_OFFSETS", "20"))  # 每个编辑操作最多返回的偏移量个数
+ANCHOR_CACHE_SIZE = int(os.getenv("ANCHOR_CACHE_SIZE", "32"))  # 缓存的文档锚点索引数量
+# 新锚点达到这个数量时用自动机一次扫描文档，更少时逐个用 str.find（C实现，锚点少时更快）
+ANCHOR_AUTOMATON_MIN_PATTERNS = int(os.getenv("ANCHOR_AUTOMATON_MIN_PATTERNS", "8"))
+
+# 需要锚点的编辑操作类型（与前端 WordEditor 中使用 body.search 的操作一致）
+ANCHORED_TYPES = frozenset(("replace", "format", "delete", "setHeading"))
+
+
+def fold_text(text: str) -> str:
+    """
+    忽略大小写比较用的文本，保证与原文逐字符对齐（偏移量可以直接用于原文）
+
+    按Unicode码点处理，中日韩文字不受影响；小写形式不止一个字符的少数字符（如 'İ'）保持原样。
+    """
+    folded = text.lower()
+    if len(folded) != len(text):
+        folded = "".join(lower if len(lower) == 1 else ch for ch, lower in ((ch, ch.lower()) for ch in text))
+    # Word 的段落分隔符是 \r，模型返回的锚点通常用 \n
+    return folded.replace("\r", "\n")
+
+
+class AhoCorasick:
+    """多模式字符串匹配自动机，一次扫描文本找出所有模式的出现位置"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+        for pattern in patterns:
+            if pattern:
+                self._add(pattern, len(self.patterns))
+                self.patterns.append(pattern)
+        self._build()
+        # 在根状态时用正则（C实现）跳到下一个可能开始匹配的字符，大部分文本不必逐字符走自动机
+        first_chars = {pattern[0] for pattern in self.patterns}
+        self._first = re.compile("|".join(map(re.escape, sorted(first_chars)))) if first_chars else None
+
+    def _add(self, pattern: str, index: int) -> None:
+        state = 0
+        for ch in pattern:
+            next_state = self._goto[state].get(ch)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][ch] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = next_state
+        self._out[state] += (index,)
+
+    def _build(self) -> None:
+        # 按广度优先计算失败指针，并把失败链上的输出合并到每个状态
+        queue = list(self._goto[0].values())
+        head = 0
+        while head < len(queue):
+            state = queue[head]
+            head += 1
+            for ch, child in self._goto[state].items():
+                queue.append(child)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                target = self._goto[fallback].get(ch, 0)
+                self._fail[child] = target if target != child else 0
+                self._out[child] += self._out[self._fail[child]]
+
+    def finditer(self, text: str) -> Iterable[Tuple[int, int]]:
+        """依次产生 (模式序号, 起始偏移量)，包括相互重叠的匹配"""
+        if self._first is None:
+            return
+        goto, fail, out, patterns = self._goto, self._fail, self._out, self.patterns
+        state = 0
+        pos = 0
+        length = len(text)
+        while pos < length:
+            if state == 0:
+                match = self._first.search(text, pos)
+                if match is None:
+                    return
+                pos = match.start()
+            ch = text[pos]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for index in out[state]:
+                yield index, pos - len(patterns[index]) + 1
+            pos += 1
+
+
+class AnchorMatch:
+    """一个锚点在文档中的出现次数和（前若干个）起始偏移量，按不重叠的匹配计数"""
+
+    __slots__ = ("count", "offsets")
+
+    def __init__(self):
+        self.count = 0
+        self.offsets: List[int] = []
+
+
+class DocumentAnchors:
+    """单个文档的锚点索引：忽略大小写的文本和已经解析过的锚点"""
+
+    def __init__(self, document: str):
+        self.folded = fold_text(document)
+        self._lock = threading.Lock()
+        self._matches: Dict[str, AnchorMatch] = {}
+
+    def resolve(self, anchors: Iterable[str]) -> Dict[str, AnchorMatch]:
+        """
+        解析一组锚点（原始 searchText），返回 {锚点: AnchorMatch}
+
+        已解析过的锚点直接复用（流式发送的增量编辑操作和最终结果共用）；
+        新锚点较少时逐个用 str.find 查找，较多时用自动机一次扫描文档。
+        """
+        result: Dict[str, AnchorMatch] = {}
+        pending: Dict[str, List[str]] = {}
+        with self._lock:
+            for anchor in anchors:
+                if not anchor or anchor in result:
+                    continue
+                match = self._matches.get(anchor)
+                if match is not None:
+                    result[anchor] = match
+                else:
+                    pending.setdefault(fold_text(anchor), []).append(anchor)
+        if not pending:
+            return result
+
+        found: Dict[str, AnchorMatch] = {folded: AnchorMatch() for folded in pending}
+        if len(found) < ANCHOR_AUTOMATON_MIN_PATTERNS:
+            for folded, match in found.items():
+                self._scan_single(folded, match)
+        else:
+            self._scan_many(found)
+        with self._lock:
+            for folded, originals in pending.items():
+                for anchor in originals:
+                    self._matches[anchor] = found[folded]
+                    result[anchor] = found[folded]
+        return result
+
+    def _scan_single(self, pattern: str, match: AnchorMatch) -> None:
+        start = self.folded.find(pattern)
+        while start != -1:
+            match.count += 1
+            if len(match.offsets) < ANCHOR_MAX_OFFSETS:
+                match.offsets.append(start)
+            start = self.folded.find(pattern, start + len(pattern))
+
+    def _scan_many(self, found: Dict[str, AnchorMatch]) -> None:
+        automaton = AhoCorasick(found)
+        matches = [found[pattern] for pattern in automaton.patterns]
+        lengths = [len(pattern) for pattern in automaton.patterns]
+        # 与 Word 的查找一致，同一个锚点的匹配不重叠
+        next_allowed = [0] * len(matches)
+        for index, start in automaton.finditer(self.folded):
+            if start < next_allowed[index]:
+                continue
+            next_allowed[index] = start + lengths[index]
+            match = matches[index]
+            match.count += 1
+            if len(match.offsets) < ANCHOR_MAX_OFFSETS:
+                match.offsets.append(start)
+
+
+# 按文档哈希缓存（解析在线程池中执行，所以访问缓存需要加锁）
+_anchor_cache: "OrderedDict[str, DocumentAnchors]" = OrderedDict()
+_anchor_cache_lock = threading.Lock()
+# 正在构建的索引：同一文档同时到达的请求（预先构建和第一个编辑操作）只构建一次
+_building: Dict[str, threading.Lock] = {}
+
+
+def get_document_anchors(document: str, document_hash: Optional[str] = None) -> DocumentAnchors:
+    """
+    获取文档的锚点索引，不存在时构建（需要对整个文档做大小写折叠，应在线程池中调用）
+    """
+    key = document_hash or hashlib.sha256(document.encode("utf-8")).hexdigest()
+    with _anchor_cache_lock:
+        anchors = _anchor_cache.get(key)
+        if anchors is not None:
+            _anchor_cache.move_to_end(key)
+            return anchors
+        build_lock = _building.setdefault(key, threading.Lock())
+    with build_lock:
+        with _anchor_cache_lock:
+            anchors = _anchor_cache.get(key)
+        if anchors is not None:
+            return anchors
+        anchors = DocumentAnchors(document)
+        with _anchor_cache_lock:
+            _anchor_cache[key] = anchors
+            _building.pop(key, None)
+            while len(_anchor_cache) > ANCHOR_CACHE_SIZE:
+                _anchor_cache.popitem(last=False)
+    return anchors
+
+
+def uses_anchor(edit: Dict) -> bool:
+    """编辑操作是否通过 searchText 定位（setHeading 指定了 content 时在文末插入新段落，不使用锚点）"""
+    edit_type = edit.get("type")
+    if edit_type not in ANCHORED_TYPES or not edit.get("searchText"):
+        return False
+    return not (edit_type == "setHeading" and edit.get("content"))
+
+
+# 锚点解析统计
+anchor_stats = {
+    "edits": 0,
+    "resolved": 0,
+    "missing": 0,
+    "dropped": 0
+}
+
+
+def annotate_edits(
+    edits: List[Dict], document: str, document_hash: Optional[str] = None, record: bool = True
+) -> List[Dict]:
+    """
+    为编辑操作（字典）附上 anchorCount 和 anchorOffsets，返回要发送的编辑操作
+
+    ANCHOR_RESOLUTION=drop 时去掉找不到锚点的编辑操作；off 或文档为空时原样返回。
+    record=False 时不计入统计（流式发送的增量编辑操作，最终结果中还会再解析一次）。
+    第一次解析某个文档时要构建索引、扫描整个文档，应通过 asyncio.to_thread 调用。
+    """
+    if ANCHOR_RESOLUTION == "off" or not document:
+        return edits
+    anchored = [edit for edit in edits if uses_anchor(edit)]
+    if not anchored:
+        return edits
+    matches = get_document_anchors(document, document_hash).resolve(edit["searchText"] for edit in anchored)
+    kept: List[Dict] = []
+    for edit in edits:
+        if uses_anchor(edit):
+            match = matches[edit["searchText"]]
+            if record:
+                anchor_stats["edits"] += 1
+                anchor_stats["resolved" if match.count else "missing"] += 1
+            if match.count == 0:
+                if ANCHOR_RESOLUTION == "drop":
+                    if record:
+                        anchor_stats["dropped"] += 1
+                        logger.info("[Anchor] 丢弃找不到锚点的编辑操作: type=%s, searchText=%s",
+                                    edit.get("type"), edit["searchText"][:50])
+                    continue
+                if record:
+                    logger.info("[Anchor] 锚点不存在: type=%s, searchText=%s", edit.get("type"), edit["searchText"][:50])
+            edit = dict(edit, anchorCount=match.count, anchorOffsets=list(match.offsets))
+        kept.append(edit)
+    return kept
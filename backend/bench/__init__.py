@@ -0,0 +1,4 @@
+"""
+/api/process 的离线压测工具
+mock_upstream: 本地模拟的OpenAI兼容流式上游；load_generator: 并发压测客户端；run: 编排、报告和结果对比
+"""
@@ -0,0 +1,113 @@
+"""
+SSE编解码微基准：对比原来的逐行字符串路径和 sse_codec 的字节路径
+
+用法（在 backend 目录下）：python -m bench.codec_bench --payload-chars 20000 --chunk-chars 4
+"""
+import argparse
+import codecs
+import json
+import time
+from typing import Callable, List, Tuple
+
+from bench.mock_upstream import build_chunk_lines, build_payload
+from sse_codec import JSON_BACKEND, SSEDecoder, encode_event, extract_delta, is_done
+
+
+def _network_reads(lines: List[bytes], read_size: int) -> List[bytes]:
+    """把上游数据按固定大小重新切块，模拟网络读取的边界与SSE事件边界不对齐"""
+    data = b"".join(lines)
+    return [data[i:i + read_size] for i in range(0, len(data), read_size)]
+
+
+def decode_lines(reads: List[bytes]) -> str:
+    """原来的路径：解码为字符串、按行切分、完整 json.loads 每个数据块"""
+    parts = []
+    pending = ""
+    # 与 httpx 的 aiter_text 一样使用增量解码，避免多字节字符被读取边界截断
+    text_decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for raw in reads:
+        text = pending + text_decoder.decode(raw)
+        lines = text.split("\n")
+        pending = lines.pop()
+        for line in lines:
+            if not line.strip():
+                continue
+            if line.startswith("data: "):
+                data_str = line[6:]
+                if data_str.strip() == "[DONE]":
+                    return "".join(parts)
+                try:
+                    chunk_data = json.loads(data_str)
+                    choices = chunk_data.get("choices", [])
+                    if choices and len(choices) > 0:
+                        choice = choices[0]
+                        if choice.get("finish_reason") in ["stop", "length"]:
+                            return "".join(parts)
+                        content = choice.get("delta", {}).get("content", "")
+                        if content:
+                            parts.append(content)
+                except (json.JSONDecodeError, Exception):
+                    continue
+    return "".join(parts)
+
+
+def decode_bytes(reads: List[bytes]) -> str:
+    """新的路径：字节上组帧，解析数据块取出 delta.content 和 finish_reason"""
+    parts = []
+    decoder = SSEDecoder()
+    for raw in reads:
+        for payload in decoder.feed(raw):
+            if is_done(payload):
+                return "".join(parts)
+            try:
+                content, finish_reason = extract_delta(payload)
+            except (ValueError, TypeError, AttributeError, IndexError):
+                continue
+            if finish_reason in ("stop", "length"):
+                return "".join(parts)
+            if content:
+                parts.append(content)
+    return "".join(parts)
+
+
+def _time(func: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="SSE编解码微基准")
+    parser.add_argument("--payload-chars", type=int, default=20000)
+    parser.add_argument("--chunk-chars", type=int, default=4)
+    parser.add_argument("--read-size", type=int, default=4096, help="模拟的网络读取大小（字节）")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    payload = build_payload(args.payload_chars, 5)
+    lines = build_chunk_lines(payload, args.chunk_chars)
+    reads = _network_reads(lines, args.read_size)
+    assert decode_lines(reads) == decode_bytes(reads) == payload
+
+    results: List[Tuple[str, float, float]] = []
+    old = _time(lambda: decode_lines(reads), args.repeat)
+    new = _time(lambda: decode_bytes(reads), args.repeat)
+    results.append(("decode", old, new))
+
+    events = [{"type": "progress", "chunk_count": i, "content_length": i * 4, "elapsed_time": 1.5, "status": "processing"}
+              for i in range(len(lines))]
+    old = _time(lambda: [f"data: {json.dumps(e)}\n\n".encode("utf-8") for e in events], args.repeat)
+    new = _time(lambda: [encode_event(e) for e in events], args.repeat)
+    results.append(("encode", old, new))
+
+    print(f"JSON后端: {JSON_BACKEND}，数据块: {len(lines)}，每块 {args.chunk_chars} 字符")
+    print(f"{'路径':<10}{'原实现(ms)':>14}{'新实现(ms)':>14}{'每块(µs)':>12}{'加速':>8}")
+    for name, old, new in results:
+        print(f"{name:<10}{old * 1000:>14.2f}{new * 1000:>14.2f}{new / len(lines) * 1e6:>12.2f}{old / new:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""
+/api/process 压测客户端
+以固定并发持续发送请求，逐行读取SSE事件，记录每个请求的首字节、首个编辑操作和最终结果耗时；
+压测期间采样后端进程的CPU时间和RSS
+"""
+import asyncio
+import importlib.util
+import json
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+# 读取进程资源：优先使用 psutil（可选依赖），否则读取Linux的 /proc
+_HAS_PSUTIL = importlib.util.find_spec("psutil") is not None
+
+
+class RequestResult:
+    """一个请求的测量结果"""
+    __slots__ = ("ok", "status", "ttfb", "first_edit", "latency", "events", "bytes")
+
+    def __init__(self):
+        self.ok = False
+        self.status = "incomplete"  # ok | error_<状态码> | transport_<异常类型> | incomplete
+        self.ttfb: Optional[float] = None  # 第一个SSE事件到达的时间
+        self.first_edit: Optional[float] = None  # 第一个增量编辑事件到达的时间
+        self.latency: Optional[float] = None  # 最终结果或错误事件到达的时间
+        self.events = 0
+        self.bytes = 0
+
+
+class ProcessSampler:
+    """定期采样一个进程的CPU时间和RSS"""
+
+    def __init__(self, pid: int, interval: float = 0.2):
+        self.pid = pid
+        self.interval = interval
+        self.rss_samples: List[int] = []
+        self._task: Optional[asyncio.Task] = None
+        self._process = None
+        if _HAS_PSUTIL:
+            import psutil
+            self._process = psutil.Process(pid)
+        self._clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+    def cpu_seconds(self) -> Optional[float]:
+        try:
+            if self._process is not None:
+                times = self._process.cpu_times()
+                return times.user + times.system
+            with open(f"/proc/{self.pid}/stat") as f:
+                # comm 可能包含空格，从最后一个右括号之后开始切分
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / self._clock_ticks
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def rss_bytes(self) -> Optional[int]:
+        try:
+            if self._process is not None:
+                return self._process.memory_info().rss
+            with open(f"/proc/{self.pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, IndexError, ValueError):
+            return None
+        return None
+
+    async def _run(self) -> None:
+        while True:
+            rss = self.rss_bytes()
+            if rss is not None:
+                self.rss_samples.append(rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+def make_document(chars: int) -> str:
+    """生成约 chars 个字符、按段落分隔的文档"""
+    paragraph = "压测文档段落，包含一些用于检索的内容和关键词。" * 4
+    paragraphs = []
+    total = 0
+    index = 0
+    while total < chars:
+        text = f"段落{index}：{paragraph}"
+        paragraphs.append(text)
+        total += len(text) + 1
+        index += 1
+    return "\n".join(paragraphs)[:chars]
+
+
+async def _one_request(client: httpx.AsyncClient, url: str, body: Dict[str, Any]) -> RequestResult:
+    result = RequestResult()
+    start = time.perf_counter()
+    try:
+        async with client.stream("POST", url, json=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                result.status = f"error_{response.status_code}"
+                result.latency = time.perf_counter() - start
+                return result
+            async for line in response.aiter_lines():
+                result.bytes += len(line) + 1
+                if not line.startswith("data: "):
+                    continue
+                now = time.perf_counter() - start
+                result.events += 1
+                if result.ttfb is None:
+                    result.ttfb = now
+                event = json.loads(line[6:])
+                event_type = event.get("type")
+                if event_type == "edit" and result.first_edit is None:
+                    result.first_edit = now
+                elif event_type == "result":
+                    result.ok = True
+                    result.status = "ok"
+                    result.latency = now
+                elif event_type == "error":
+                    result.status = f"error_{event.get('status_code', 'unknown')}"
+                    result.latency = now
+    except httpx.HTTPError as e:
+        result.status = f"transport_{type(e).__name__}"
+    return result
+
+
+async def run_load(
+    base_url: str,
+    upstream_url: str,
+    concurrency: int,
+    total_requests: int,
+    document_chars: int = 5000,
+    keys: Optional[int] = None,
+    timeout: float = 300.0,
+    backend_pid: Optional[int] = None
+) -> Dict[str, Any]:
+    """
+    以 concurrency 个并发工作者发送 total_requests 个请求，返回原始测量数据
+
+    每个请求都设置 bypass_cache，避免响应缓存和在途合并掩盖上游路径；
+    工作者按 keys 个API密钥轮流分配，避免准入控制的按密钥并发上限成为瓶颈。
+    """
+    url = base_url.rstrip("/") + "/api/process"
+    document = make_document(document_chars)
+    keys = keys or concurrency
+    next_index = 0
+    results: List[RequestResult] = []
+
+    async def worker(worker_id: int) -> None:
+        nonlocal next_index
+        while next_index < total_requests:
+            index = next_index
+            next_index += 1
+            body = {
+                "user_request": f"压测请求 #{index}：在文档末尾添加总结段落",
+                "document_content": document,
+                "api_key": f"bench-key-{worker_id % keys}",
+                "api_url": upstream_url,
+                "model_name": "mock-model",
+                "bypass_cache": True
+            }
+            results.append(await _one_request(client, url, body))
+
+    sampler = ProcessSampler(backend_pid) if backend_pid else None
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout, connect=10.0), limits=limits) as client:
+        cpu_before = sampler.cpu_seconds() if sampler else None
+        rss_before = sampler.rss_bytes() if sampler else None
+        if sampler:
+            sampler.start()
+        wall_start = time.perf_counter()
+        await asyncio.gather(*(worker(i) for i in range(concurrency)))
+        wall_time = time.perf_counter() - wall_start
+        if sampler:
+            await sampler.stop()
+        cpu_after = sampler.cpu_seconds() if sampler else None
+
+    process: Dict[str, Any] = {}
+    if sampler and cpu_before is not None and cpu_after is not None:
+        process["cpu_seconds"] = cpu_after - cpu_before
+    if sampler and rss_before is not None:
+        process["rss_before"] = rss_before
+        process["rss_peak"] = max(sampler.rss_samples, default=rss_before)
+    return {"wall_time": wall_time, "results": results, "process": process}
@@ -0,0 +1,168 @@
+"""
+本地模拟上游：OpenAI兼容的流式 chat completions 接口
+首token延迟、数据块速率、响应大小、中途断开和错误码都可以配置；
+响应内容是可被 parse_ai_response 解析的编辑操作JSON，数据块在启动时预先序列化，模拟上游本身的开销尽量小
+
+用法：python -m bench.mock_upstream --port 9100 --ttft 0.2 --chunk-rate 100
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+class MockUpstreamConfig:
+    """模拟上游的行为参数"""
+
+    def __init__(
+        self,
+        ttft: float = 0.2,
+        chunk_rate: float = 100.0,
+        chunk_chars: int = 4,
+        payload_chars: int = 2000,
+        edits: int = 5,
+        error_rate: float = 0.0,
+        error_code: int = 503,
+        disconnect_rate: float = 0.0,
+        seed: Optional[int] = None
+    ):
+        self.ttft = ttft  # 首个数据块之前的延迟（秒）
+        self.chunk_rate = chunk_rate  # 每秒发送的数据块数，0表示不限速
+        self.chunk_chars = max(1, chunk_chars)  # 每个数据块的字符数（大约一个token）
+        self.payload_chars = payload_chars  # 每个响应的内容字符数（近似值）
+        self.edits = max(1, edits)  # 响应中的编辑操作数
+        self.error_rate = error_rate  # 直接返回 error_code 的请求比例
+        self.error_code = error_code
+        self.disconnect_rate = disconnect_rate  # 发送一半内容后断开连接的请求比例
+        self.seed = seed
+
+    def to_dict(self) -> Dict[str, float]:
+        return dict(self.__dict__)
+
+
+def build_payload(payload_chars: int, edits: int) -> str:
+    """生成约 payload_chars 个字符的编辑操作JSON"""
+    filler = "这是压测生成的段落内容。"
+    per_edit = max(1, (payload_chars - 40) // edits - 60)
+    text = (filler * (per_edit // len(filler) + 1))[:per_edit]
+    operations = [
+        {"type": "insert", "content": text, "position": "end"} if i % 2 == 0
+        else {"type": "replace", "searchText": f"段落{i}", "replaceText": text}
+        for i in range(edits)
+    ]
+    return json.dumps({"message": "已完成压测修改", "edits": operations}, ensure_ascii=False)
+
+
+def build_chunk_lines(payload: str, chunk_chars: int, model: str = "mock-model") -> List[bytes]:
+    """把内容切成SSE数据块行（已编码），最后附加 finish_reason 和 [DONE]"""
+    created = int(time.time())
+
+    def line(delta: Dict[str, str], finish_reason: Optional[str]) -> bytes:
+        chunk = {
+            "id": "chatcmpl-mock",
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8")
+
+    lines = [line({"role": "assistant", "content": ""}, None)]
+    for start in range(0, len(payload), chunk_chars):
+        lines.append(line({"content": payload[start:start + chunk_chars]}, None))
+    lines.append(line({}, "stop"))
+    lines.append(b"data: [DONE]\n\n")
+    return lines
+
+
+class _MockDisconnect(Exception):
+    """在响应中途抛出，让服务器直接断开连接"""
+
+
+def create_app(config: MockUpstreamConfig) -> FastAPI:
+    app = FastAPI(title="Mock OpenAI upstream")
+    rng = random.Random(config.seed)
+    lines = build_chunk_lines(build_payload(config.payload_chars, config.edits), config.chunk_chars)
+    stats = {"requests": 0, "errors": 0, "disconnects": 0, "completed": 0, "chunks_sent": 0}
+
+    async def stream(disconnect: bool):
+        await asyncio.sleep(config.ttft)
+        cutoff = len(lines) // 2 if disconnect else len(lines)
+        interval = 1.0 / config.chunk_rate if config.chunk_rate > 0 else 0.0
+        start = time.monotonic()
+        for index, data in enumerate(lines[:cutoff]):
+            if interval:
+                # 按计划时间发送，避免 sleep 误差累积
+                delay = start + index * interval - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            stats["chunks_sent"] += 1
+            yield data
+        if disconnect:
+            stats["disconnects"] += 1
+            raise _MockDisconnect("模拟上游中途断开")
+        stats["completed"] += 1
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions():
+        stats["requests"] += 1
+        if config.error_rate and rng.random() < config.error_rate:
+            stats["errors"] += 1
+            return JSONResponse(
+                {"error": {"message": "mock upstream error", "type": "server_error"}},
+                status_code=config.error_code
+            )
+        disconnect = bool(config.disconnect_rate) and rng.random() < config.disconnect_rate
+        return StreamingResponse(stream(disconnect), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats():
+        return {"config": config.to_dict(), **stats}
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    """模拟上游的命令行参数（run 也会复用）"""
+    parser.add_argument("--ttft", type=float, default=0.2, help="首token延迟（秒）")
+    parser.add_argument("--chunk-rate", type=float, default=100.0, help="每秒数据块数，0表示不限速")
+    parser.add_argument("--chunk-chars", type=int, default=4, help="每个数据块的字符数")
+    parser.add_argument("--payload-chars", type=int, default=2000, help="每个响应的内容字符数")
+    parser.add_argument("--edits", type=int, default=5, help="响应中的编辑操作数")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="返回错误码的请求比例")
+    parser.add_argument("--error-code", type=int, default=503, help="注入错误时返回的状态码")
+    parser.add_argument("--disconnect-rate", type=float, default=0.0, help="中途断开的请求比例")
+    parser.add_argument("--seed", type=int, default=None, help="随机种子")
+
+
+def config_from_args(args: argparse.Namespace) -> MockUpstreamConfig:
+    return MockUpstreamConfig(
+        ttft=args.ttft,
+        chunk_rate=args.chunk_rate,
+        chunk_chars=args.chunk_chars,
+        payload_chars=args.payload_chars,
+        edits=args.edits,
+        error_rate=args.error_rate,
+        error_code=args.error_code,
+        disconnect_rate=args.disconnect_rate,
+        seed=args.seed
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="本地模拟的OpenAI兼容流式上游")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
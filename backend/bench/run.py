@@ -0,0 +1,260 @@
+"""
+压测编排：启动模拟上游和后端，按场景运行压测，输出报告并保存结果以便对比
+
+用法（在 backend 目录下）：
+    python -m bench.run --scenario steady --concurrency 32 --requests 500
+    python -m bench.run --scenario fast --compare bench/results/<之前的结果>.json
+    python -m bench.run --backend-url http://127.0.0.1:3000 --backend-pid <pid>   # 压测已运行的后端
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from bench.load_generator import RequestResult, run_load
+from bench.mock_upstream import add_arguments
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = Path(__file__).resolve().parent / "results"
+
+# 预设场景：作为命令行参数的默认值（命令行显式给出的参数优先）
+SCENARIOS: Dict[str, Dict[str, Any]] = {
+    "steady": {},
+    # 不限速、无首token延迟：只测后端自身的开销
+    "fast": {"ttft": 0.0, "chunk_rate": 0.0},
+    "slow_ttft": {"ttft": 2.0},
+    "large": {"payload_chars": 20000, "document_chars": 200000},
+    "flaky": {"error_rate": 0.05, "disconnect_rate": 0.05}
+}
+
+# 报告和对比中使用的主要指标（名称, 越小越好）
+KEY_METRICS = [
+    ("latency_p50", True), ("latency_p95", True), ("latency_p99", True),
+    ("ttfb_p50", True), ("ttfb_p95", True),
+    ("first_edit_p50", True), ("first_edit_p95", True),
+    ("requests_per_second", False), ("events_per_second", False),
+    ("cpu_ms_per_stream", True), ("rss_kb_per_stream", True)
+]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR,
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+async def _wait_ready(url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient(timeout=2.0) as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"服务未能在 {timeout:.0f} 秒内就绪: {url}")
+
+
+def summarize(raw: Dict[str, Any], concurrency: int) -> Dict[str, Any]:
+    """把原始测量数据汇总成报告"""
+    results: List[RequestResult] = raw["results"]
+    wall_time = raw["wall_time"]
+    ok = [r for r in results if r.ok]
+    statuses: Dict[str, int] = {}
+    for r in results:
+        statuses[r.status] = statuses.get(r.status, 0) + 1
+
+    report: Dict[str, Any] = {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "statuses": statuses,
+        "wall_time": round(wall_time, 3),
+        "requests_per_second": round(len(ok) / wall_time, 2) if wall_time else None,
+        "events_per_second": round(sum(r.events for r in results) / wall_time, 1) if wall_time else None,
+        "sse_bytes_per_stream": round(sum(r.bytes for r in results) / len(results)) if results else None
+    }
+    for name, values in (
+        ("latency", [r.latency for r in ok]),
+        ("ttfb", [r.ttfb for r in results if r.ttfb is not None]),
+        ("first_edit", [r.first_edit for r in ok if r.first_edit is not None])
+    ):
+        for q in (0.5, 0.95, 0.99):
+            value = _percentile(values, q)
+            report[f"{name}_p{int(q * 100)}"] = round(value, 4) if value is not None else None
+
+    process = raw["process"]
+    if "cpu_seconds" in process and results:
+        report["cpu_seconds"] = round(process["cpu_seconds"], 3)
+        report["cpu_ms_per_stream"] = round(process["cpu_seconds"] * 1000 / len(results), 3)
+    if "rss_peak" in process:
+        report["rss_peak_kb"] = process["rss_peak"] // 1024
+        # 峰值相对压测前的增长，按同时进行的流数分摊
+        report["rss_kb_per_stream"] = round((process["rss_peak"] - process["rss_before"]) / 1024 / concurrency, 1)
+    return report
+
+
+def print_report(report: Dict[str, Any], baseline: Optional[Dict[str, Any]] = None) -> None:
+    print(f"请求: {report['requests']}，成功: {report['succeeded']}，耗时: {report['wall_time']} 秒")
+    print(f"状态: {json.dumps(report['statuses'], ensure_ascii=False)}")
+    print(f"{'指标':<22}{'本次':>14}" + (f"{'基线':>14}{'变化':>10}" if baseline else ""))
+    for name, lower_is_better in KEY_METRICS:
+        value = report.get(name)
+        if value is None:
+            continue
+        line = f"{name:<22}{value:>14}"
+        if baseline and baseline.get(name):
+            base = baseline[name]
+            change = (value - base) / base * 100
+            better = (change < 0) == lower_is_better
+            line += f"{base:>14}{change:>+9.1f}%" + (" ✓" if better and abs(change) >= 1 else "")
+        print(line)
+
+
+def save_result(result: Dict[str, Any], label: str) -> Path:
+    RESULTS_DIR.mkdir(parents=True, exist_ok=True)
+    stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    path = RESULTS_DIR / f"{stamp}_{label}.json"
+    path.write_text(json.dumps(result, ensure_ascii=False, indent=2), encoding="utf-8")
+    return path
+
+
+def _start_process(args: List[str], env: Dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable] + args, cwd=BACKEND_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def run(args: argparse.Namespace) -> Dict[str, Any]:
+    mock_args: List[str] = []
+    mock_config: Dict[str, Any] = {}
+    for key in ("ttft", "chunk_rate", "chunk_chars", "payload_chars", "edits",
+                "error_rate", "error_code", "disconnect_rate", "seed"):
+        value = getattr(args, key)
+        if value is not None:
+            mock_config[key] = value
+            mock_args += [f"--{key.replace('_', '-')}", str(value)]
+    document_chars = args.document_chars
+
+    processes: List[subprocess.Popen] = []
+    try:
+        mock_port = _free_port()
+        processes.append(_start_process(["-m", "bench.mock_upstream", "--port", str(mock_port)] + mock_args, dict(os.environ)))
+        upstream_url = f"http://127.0.0.1:{mock_port}/v1/chat/completions"
+        await _wait_ready(f"http://127.0.0.1:{mock_port}/stats")
+
+        backend_pid = args.backend_pid
+        if args.backend_url:
+            base_url = args.backend_url
+        else:
+            backend_port = _free_port()
+            env = dict(os.environ)
+            # 压测测量的是上游路径：关闭响应缓存，准入上限不低于并发数
+            env.setdefault("RESPONSE_CACHE_ENABLED", "false")
+            env.setdefault("DEFAULT_API_URL", upstream_url)
+            env.setdefault("ADMISSION_MAX_CONCURRENT", str(max(64, args.concurrency)))
+            env.setdefault("ADMISSION_QUEUE_SIZE", str(max(128, args.concurrency * 2)))
+            backend = _start_process(
+                ["-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(backend_port), "--log-level", "warning"],
+                env
+            )
+            processes.append(backend)
+            backend_pid = backend.pid
+            base_url = f"http://127.0.0.1:{backend_port}"
+        await _wait_ready(f"{base_url}/health")
+
+        if args.warmup:
+            await run_load(base_url, upstream_url, min(args.concurrency, args.warmup), args.warmup, document_chars)
+        raw = await run_load(base_url, upstream_url, args.concurrency, args.requests, document_chars,
+                             keys=args.keys, timeout=args.timeout, backend_pid=backend_pid)
+        async with httpx.AsyncClient(timeout=5.0) as client:
+            mock_stats = (await client.get(f"http://127.0.0.1:{mock_port}/stats")).json()
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    return {
+        "label": args.label or args.scenario,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "scenario": args.scenario,
+        "config": {
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "document_chars": document_chars,
+            "keys": args.keys or args.concurrency,
+            "mock": mock_config
+        },
+        "mock_stats": mock_stats,
+        "report": summarize(raw, args.concurrency)
+    }
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="/api/process 离线压测")
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="steady")
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求数")
+    parser.add_argument("--requests", type=int, default=200, help="总请求数")
+    parser.add_argument("--warmup", type=int, default=10, help="正式压测前的预热请求数（不计入结果）")
+    parser.add_argument("--document-chars", type=int, default=5000, help="文档字符数")
+    parser.add_argument("--keys", type=int, default=None, help="轮流使用的API密钥数（默认等于并发数）")
+    parser.add_argument("--timeout", type=float, default=300.0, help="单个请求的超时（秒）")
+    parser.add_argument("--backend-url", default=None, help="压测已运行的后端，而不是启动新的后端进程")
+    parser.add_argument("--backend-pid", type=int, default=None, help="已运行后端的进程ID（用于采样CPU和RSS）")
+    parser.add_argument("--label", default=None, help="结果标签（默认为场景名）")
+    parser.add_argument("--compare", default=None, help="与之前保存的结果文件对比")
+    parser.add_argument("--no-save", action="store_true", help="不保存结果")
+    add_arguments(parser)
+    return parser
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """先确定场景，再以场景参数作为默认值解析完整的命令行"""
+    parser = build_parser()
+    known, _ = parser.parse_known_args(argv)
+    parser.set_defaults(**SCENARIOS[known.scenario])
+    return parser.parse_args(argv)
+
+
+def main() -> None:
+    args = parse_args()
+    result = asyncio.run(run(args))
+    baseline = None
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))["report"]
+    print_report(result["report"], baseline)
+    if not args.no_save:
+        print(f"结果已保存: {save_result(result, result['label'])}")
+
+
+if __name__ == "__main__":
+    main()
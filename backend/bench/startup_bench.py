@@ -0,0 +1,152 @@
+"""
+冷启动基准：测量导入耗时（按 main 直接导入的模块拆分）和从启动进程到 /health 可用的时间，
+超出预算时以非零状态码退出，可以放在CI中作为启动耗时的门槛
+
+用法（在 backend 目录下）：python -m bench.startup_bench --runs 5 --budget 2.0
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from startup_profile import STARTUP_BUDGET_SECONDS
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+
+# -X importtime 的输出行：import time: self [us] | cumulative | imported package
+_IMPORT_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def import_profile() -> Tuple[float, Dict[str, float]]:
+    """在新进程中导入 main，返回 (总导入耗时, main 直接导入的各模块的累计耗时)，单位秒"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, timeout=120
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"导入 main 失败:\n{result.stderr[-2000:]}")
+    total = 0.0
+    components: Dict[str, float] = {}
+    for line in result.stderr.splitlines():
+        match = _IMPORT_LINE.match(line)
+        if match is None:
+            continue
+        cumulative = int(match.group(2)) / 1e6
+        depth = len(match.group(3)) // 2
+        name = match.group(4)
+        if name == "main" and depth == 0:
+            total = cumulative
+        elif depth == 1:
+            # main 直接导入的模块按顶层包合计（如 fastapi 和 fastapi.responses）
+            top = name.split(".")[0]
+            components[top] = components.get(top, 0.0) + cumulative
+    return total, components
+
+
+def _get_json(url: str, timeout: float = 2.0) -> Optional[Dict[str, Any]]:
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+    except (urllib.error.URLError, OSError, ValueError):
+        return None
+
+
+def ready_profile(timeout: float = 60.0) -> Tuple[float, Dict[str, Any]]:
+    """启动 uvicorn main:app，返回 (从启动进程到 /health 返回的耗时, 应用自己的 startup 报告)"""
+    port = _free_port()
+    env = dict(os.environ)
+    env.setdefault("UPSTREAM_PREWARM", "false")
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=BACKEND_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    try:
+        url = f"http://127.0.0.1:{port}/health"
+        while time.perf_counter() - start < timeout:
+            health = _get_json(url)
+            if health is not None:
+                return time.perf_counter() - start, health.get("startup", {})
+            if process.poll() is not None:
+                raise RuntimeError(f"后端进程已退出，状态码 {process.returncode}")
+            time.sleep(0.02)
+        raise RuntimeError(f"后端未能在 {timeout:.0f} 秒内就绪")
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="后端冷启动基准")
+    parser.add_argument("--runs", type=int, default=5, help="重复次数（取中位数）")
+    parser.add_argument("--budget", type=float, default=STARTUP_BUDGET_SECONDS, help="冷启动预算（秒）")
+    parser.add_argument("--top", type=int, default=12, help="列出导入最慢的模块数")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args()
+
+    import_totals: List[float] = []
+    import_components: Dict[str, List[float]] = {}
+    ready_times: List[float] = []
+    reports: List[Dict[str, Any]] = []
+    for _ in range(args.runs):
+        total, components = import_profile()
+        import_totals.append(total)
+        for name, seconds in components.items():
+            import_components.setdefault(name, []).append(seconds)
+        ready, report = ready_profile()
+        ready_times.append(ready)
+        reports.append(report)
+
+    ready_median = statistics.median(ready_times)
+    components_median = sorted(
+        ((name, statistics.median(values)) for name, values in import_components.items()),
+        key=lambda item: item[1], reverse=True
+    )
+    result = {
+        "runs": args.runs,
+        "budget_seconds": args.budget,
+        "import_seconds": round(statistics.median(import_totals), 4),
+        "ready_seconds": round(ready_median, 4),
+        "ready_seconds_max": round(max(ready_times), 4),
+        "within_budget": ready_median <= args.budget,
+        "imports": {name: round(seconds, 4) for name, seconds in components_median[:args.top]},
+        # 最后一次启动时应用自己记录的各组件初始化耗时
+        "app_report": reports[-1] if reports else {}
+    }
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print(f"导入 main: {result['import_seconds'] * 1000:.1f} ms（中位数，{args.runs} 次）")
+        for name, seconds in components_median[:args.top]:
+            print(f"  {name:<28}{seconds * 1000:>10.1f} ms")
+        print("应用初始化:")
+        for component in result["app_report"].get("components", []):
+            print(f"  {component['component']:<28}{component['ms']:>10.1f} ms  ({component['phase']})")
+        print(f"启动到 /health 可用: {ready_median * 1000:.1f} ms（中位数，最大 {result['ready_seconds_max'] * 1000:.1f} ms），"
+              f"预算 {args.budget * 1000:.0f} ms")
+    if not result["within_budget"]:
+        print(f"超出冷启动预算: {ready_median:.3f} 秒 > {args.budget:.3f} 秒", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+文档上下文选择
+把文档切分为段落块并建立轻量的BM25倒排索引，按与用户需求的相关度选取内容装入字符预算
+"""
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 上下文配置（从环境变量读取，如果没有则使用默认值）
+DOCUMENT_CONTEXT_BUDGET = int(os.getenv("DOCUMENT_CONTEXT_BUDGET", "2000"))  # 提示词中文档内容的字符预算
+CONTEXT_CHUNK_SIZE = int(os.getenv("CONTEXT_CHUNK_SIZE", "400"))  # 段落块的目标长度（字符）
+CONTEXT_INDEX_CACHE_SIZE = int(os.getenv("CONTEXT_INDEX_CACHE_SIZE", "32"))  # 缓存的文档索引数量
+
+# 省略内容的标记
+ELLIPSIS = "..."
+
+# BM25参数
+_BM25_K1 = 1.5
+_BM25_B = 0.75
+
+# 中日韩字符按二元组切分，其他文字按单词切分
+# 平假名/片假名、CJK扩展A、CJK统一汉字、韩文音节、CJK兼容汉字
+_CJK_RANGES = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+_TOKEN_RE = re.compile(f"[{_CJK_RANGES}]+|[0-9A-Za-z\u00c0-\u024f]+")
+_CJK_RE = re.compile(f"[{_CJK_RANGES}]")
+# Word文档的段落分隔符可能是 \r、\n 或 \r\n
+_PARAGRAPH_RE = re.compile(r"[\r\n]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """CJK感知的分词：中日韩连续字符产出单字和二元组，拉丁文字产出小写单词"""
+    tokens: List[str] = []
+    for match in _TOKEN_RE.finditer(text):
+        run = match.group()
+        if _CJK_RE.match(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run.lower())
+    return tokens
+
+
+def split_chunks(document: str, chunk_size: int = CONTEXT_CHUNK_SIZE) -> List[Tuple[int, str]]:
+    """
+    按段落切分文档，短段落合并、超长段落截断为多块
+
+    Returns:
+        [(在原文中的起始位置, 块文本), ...]，按文档顺序排列
+    """
+    chunks: List[Tuple[int, str]] = []
+    current_start = -1
+    current_end = 0
+    pos = 0
+    for sep in _PARAGRAPH_RE.finditer(document + "\n"):
+        para_start, para_end = pos, sep.start()
+        pos = sep.end()
+        if para_end <= para_start or not document[para_start:para_end].strip():
+            continue
+        # 超长段落：先结束当前块，再按固定长度切开
+        if para_end - para_start > chunk_size:
+            if current_start >= 0:
+                chunks.append((current_start, document[current_start:current_end]))
+                current_start = -1
+            for start in range(para_start, para_end, chunk_size):
+                chunks.append((start, document[start:min(start + chunk_size, para_end)]))
+            continue
+        if current_start >= 0 and para_end - current_start > chunk_size:
+            chunks.append((current_start, document[current_start:current_end]))
+            current_start = -1
+        if current_start < 0:
+            current_start = para_start
+        current_end = para_end
+    if current_start >= 0:
+        chunks.append((current_start, document[current_start:current_end]))
+    return chunks
+
+
+class DocumentIndex:
+    """单个文档的BM25索引"""
+
+    def __init__(self, document: str, chunk_size: int = CONTEXT_CHUNK_SIZE):
+        self.chunks = split_chunks(document, chunk_size)
+        self.term_freqs: List[Counter] = []
+        self.lengths: List[int] = []
+        doc_freq: Counter = Counter()
+        for _, text in self.chunks:
+            tf = Counter(tokenize(text))
+            self.term_freqs.append(tf)
+            self.lengths.append(sum(tf.values()))
+            doc_freq.update(tf.keys())
+        n = len(self.chunks)
+        self.avg_length = (sum(self.lengths) / n) if n else 0.0
+        self.idf: Dict[str, float] = {
+            term: math.log(1 + (n - df + 0.5) / (df + 0.5)) for term, df in doc_freq.items()
+        }
+
+    def score(self, query: str) -> List[float]:
+        """计算每个块与查询的BM25得分"""
+        terms = set(tokenize(query))
+        scores = [0.0] * len(self.chunks)
+        if not terms or not self.avg_length:
+            return scores
+        for i, tf in enumerate(self.term_freqs):
+            norm = _BM25_K1 * (1 - _BM25_B + _BM25_B * self.lengths[i] / self.avg_length)
+            total = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    total += self.idf[term] * freq * (_BM25_K1 + 1) / (freq + norm)
+            scores[i] = total
+        return scores
+
+
+# 按文档哈希缓存索引，同一文档的后续请求无需重新建立索引
+# （build_prompt 可能在线程池中执行，所以访问缓存需要加锁）
+_index_cache: "OrderedDict[str, DocumentIndex]" = OrderedDict()
+_index_cache_lock = threading.Lock()
+
+
+def get_document_index(document: str, document_hash: Optional[str] = None) -> DocumentIndex:
+    key = document_hash or hashlib.sha256(document.encode("utf-8")).hexdigest()
+    with _index_cache_lock:
+        index = _index_cache.get(key)
+        if index is not None:
+            _index_cache.move_to_end(key)
+            return index
+    index = DocumentIndex(document)
+    with _index_cache_lock:
+        _index_cache[key] = index
+        while len(_index_cache) > CONTEXT_INDEX_CACHE_SIZE:
+            _index_cache.popitem(last=False)
+    logger.info("[Context] 建立文档索引: %d 个段落块", len(index.chunks))
+    return index
+
+
+def select_context(
+    user_request: str,
+    document: str,
+    budget: int = DOCUMENT_CONTEXT_BUDGET,
+    document_hash: Optional[str] = None
+) -> str:
+    """
+    选取与用户需求最相关的文档内容，总长度不超过预算
+
+    文档不超过预算时原样返回；没有任何相关块时退回到截取开头。
+    选中的块按原文顺序排列，不相邻的块之间用省略标记分隔。
+    """
+    if len(document) <= budget:
+        return document
+
+    index = get_document_index(document, document_hash)
+    scores = index.score(user_request)
+    if not any(scores):
+        return document[:budget] + ELLIPSIS
+
+    # 开头的块通常是标题和引言，给予少量加权
+    ranked = sorted(
+        range(len(index.chunks)),
+        key=lambda i: scores[i] + (0.1 if i == 0 else 0.0),
+        reverse=True
+    )
+    selected: List[int] = []
+    used = 0
+    for i in ranked:
+        if scores[i] <= 0 and selected:
+            break
+        length = len(index.chunks[i][1]) + len(ELLIPSIS) + 1
+        if used + length > budget:
+            continue
+        selected.append(i)
+        used += length
+    if not selected:
+        return document[:budget] + ELLIPSIS
+
+    selected.sort()
+    parts: List[str] = []
+    previous_end = 0
+    for i in selected:
+        start, text = index.chunks[i]
+        if start > previous_end and document[previous_end:start].strip():
+            parts.append(ELLIPSIS)
+        parts.append(text)
+        previous_end = start + len(text)
+    if document[previous_end:].strip():
+        parts.append(ELLIPSIS)
+    return "\n".join(parts)
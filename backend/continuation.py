@@ -0,0 +1,199 @@
+"""
+上游流中断后的续写
+上游连接在生成过程中断开（已经收到部分内容）时，保留已收到的内容，带上它再请求一次上游，
+要求模型从中断处继续输出；续写内容与已有内容衔接（去掉模型重复输出的部分）后继续产出，
+对SSE消费方来说像是同一个上游流。连接中断只需要重新生成剩余部分，而不是整个回答。
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 续写配置（从环境变量读取，如果没有则使用默认值）
+CONTINUATION_MAX_ATTEMPTS = int(os.getenv("CONTINUATION_MAX_ATTEMPTS", "2"))  # 一次请求最多续写几次，0表示不续写
+CONTINUATION_BACKOFF = float(os.getenv("CONTINUATION_BACKOFF", "0.5"))  # 第一次续写前的等待时间（秒），之后每次翻倍
+CONTINUATION_PROBE_CHARS = int(os.getenv("CONTINUATION_PROBE_CHARS", "64"))  # 用续写开头多少字符判断与已有内容的重叠
+
+# 对齐续写内容与已有内容时，匹配至少这么长才认为是模型在重复输出（避免误判）
+_MIN_ALIGN_CHARS = 8
+
+CONTINUATION_PROMPT = (
+    "你的上一条回复在传输过程中被截断了。请从截断处继续输出剩余内容："
+    "不要重复已经输出的部分，不要添加任何说明或代码块标记，直接接着最后一个字符往下写。"
+)
+
+
+class UpstreamTruncated(Exception):
+    """上游流在已经产出部分内容后中断（call_ai_api_with_progress 抛出，由 stream_with_continuation 处理）"""
+
+    def __init__(self, detail: str):
+        super().__init__(detail)
+        self.detail = detail
+
+
+# 续写统计
+continuation_stats = {
+    "truncated": 0,     # 上游流中断（已有部分内容）的次数
+    "attempts": 0,      # 发起的续写请求数
+    "recovered": 0,     # 续写后正常结束的请求数
+    "gave_up": 0,       # 用完续写次数后使用不完整内容的请求数
+    "overlap_chars": 0  # 续写时去掉的重复字符数
+}
+
+
+class _Stitcher:
+    """
+    把续写内容接到已有内容后面
+
+    模型续写时可能重复一段已经输出的内容，甚至从头开始；先缓存续写开头的若干字符，
+    在已有内容中找到对齐位置，跳过与已有内容相同的部分，只输出新的内容。
+    """
+
+    def __init__(self, previous: str):
+        self.previous = previous
+        self.buffer = ""
+        self.decided = False
+        self.skip_pos: Optional[int] = None  # 正在跳过与 previous[skip_pos:] 相同的续写内容
+        self.skipped = 0
+
+    def feed(self, text: str) -> str:
+        if not self.decided:
+            self.buffer += text
+            if len(self.buffer) < CONTINUATION_PROBE_CHARS:
+                return ""
+            return self._decide()
+        if self.skip_pos is not None:
+            return self._skip(text)
+        return text
+
+    def flush(self) -> str:
+        """续写结束时输出仍在缓存中的内容"""
+        return "" if self.decided else self._decide()
+
+    def _decide(self) -> str:
+        self.decided = True
+        buffer, self.buffer = self.buffer, ""
+        # 模型无视要求重新加了代码块标记时去掉它（已有内容已经在JSON中间）
+        stripped = buffer.lstrip()
+        if stripped.startswith("```") and "{" in self.previous:
+            newline = stripped.find("\n")
+            if newline != -1:
+                buffer = stripped[newline + 1:]
+        probe = buffer[:CONTINUATION_PROBE_CHARS]
+        if len(probe) >= _MIN_ALIGN_CHARS:
+            position = self.previous.rfind(probe)
+            if position != -1:
+                # 续写从 previous[position:] 开始重复输出
+                self.skip_pos = position
+                return self._skip(buffer)
+        # 续写开头与已有内容结尾重叠（开头过短无法定位时也检查）
+        for overlap in range(min(len(buffer), len(self.previous)), _MIN_ALIGN_CHARS - 1, -1):
+            if self.previous.endswith(buffer[:overlap]):
+                self.skipped += overlap
+                return buffer[overlap:]
+        return buffer
+
+    def _skip(self, text: str) -> str:
+        tail = self.previous[self.skip_pos:]
+        matched = 0
+        limit = min(len(text), len(tail))
+        while matched < limit and text[matched] == tail[matched]:
+            matched += 1
+        self.skipped += matched
+        self.skip_pos += matched
+        if matched < len(text):
+            # 已有内容已经全部重复过，或者续写与已有内容出现分歧，之后的内容原样输出
+            self.skip_pos = None
+        return text[matched:]
+
+
+def continuation_messages(messages: List[Dict[str, str]], partial: str) -> List[Dict[str, str]]:
+    """续写请求的消息：原始消息 + 已收到的部分回复 + 续写要求"""
+    return messages + [
+        {"role": "assistant", "content": partial},
+        {"role": "user", "content": CONTINUATION_PROMPT}
+    ]
+
+
+async def stream_with_continuation(
+    start: Callable[[List[Dict[str, str]], Optional[Dict[str, Any]]], AsyncGenerator[Tuple[str, int, int, float], None]],
+    messages: List[Dict[str, str]],
+    response_format: Optional[Dict[str, Any]] = None,
+    max_attempts: int = CONTINUATION_MAX_ATTEMPTS
+) -> AsyncGenerator[Tuple[str, int, int, float], None]:
+    """
+    调用 start(messages, response_format) 得到上游流并转发其数据块；流中断时续写
+
+    产出的 (content_chunk, chunk_count, content_length, elapsed_time) 在多次上游调用之间连续计数。
+    续写请求不带 response_format（结构化输出要求完整的JSON，不适用于续写）。
+    续写次数用完或续写请求本身失败时，和以前一样以已收到的内容结束，由调用方解析。
+    """
+    parts: List[str] = []
+    chunk_base = 0
+    content_length = 0
+    start_time = time.time()
+    attempt = 0
+    current_messages, current_format = messages, response_format
+    stitcher: Optional[_Stitcher] = None
+
+    while True:
+        stream = start(current_messages, current_format)
+        last_count = 0
+        try:
+            async for chunk_content, chunk_count, _, _ in stream:
+                last_count = chunk_count
+                if stitcher is not None:
+                    chunk_content = stitcher.feed(chunk_content)
+                    if not chunk_content:
+                        continue
+                parts.append(chunk_content)
+                content_length += len(chunk_content)
+                yield chunk_content, chunk_base + chunk_count, content_length, time.time() - start_time
+            if stitcher is not None:
+                tail = stitcher.flush()
+                if tail:
+                    parts.append(tail)
+                    content_length += len(tail)
+                    yield tail, chunk_base + last_count, content_length, time.time() - start_time
+                continuation_stats["recovered"] += 1
+                continuation_stats["overlap_chars"] += stitcher.skipped
+                logger.info("[Continuation] 续写完成，共 %d 次续写，去掉重复内容 %d 字符", attempt, stitcher.skipped)
+            return
+        except UpstreamTruncated as e:
+            continuation_stats["truncated"] += 1
+            error: BaseException = e
+        except Exception as e:
+            # 续写请求本身失败（首个数据块之前）；第一次调用失败原样抛出
+            if stitcher is None:
+                raise
+            error = e
+        finally:
+            await stream.aclose()
+
+        if stitcher is not None:
+            # 上一次续写在确定对齐位置之前就中断了，缓存的内容也保留下来
+            tail = stitcher.flush()
+            if tail:
+                parts.append(tail)
+                content_length += len(tail)
+                yield tail, chunk_base + last_count, content_length, time.time() - start_time
+            continuation_stats["overlap_chars"] += stitcher.skipped
+        chunk_base += last_count
+        if attempt >= max_attempts:
+            continuation_stats["gave_up"] += 1
+            logger.warning("[Continuation] 上游流中断且续写次数已用完（%d 次），使用已接收的 %d 字符: %s",
+                           attempt, content_length, getattr(error, "detail", error))
+            return
+        attempt += 1
+        continuation_stats["attempts"] += 1
+        delay = CONTINUATION_BACKOFF * (2 ** (attempt - 1))
+        logger.warning("[Continuation] 上游流中断（已接收 %d 字符），%.1f 秒后第 %d 次续写: %s",
+                       content_length, delay, attempt, getattr(error, "detail", error))
+        await asyncio.sleep(delay)
+        partial = "".join(parts)
+        parts = [partial]
+        current_messages, current_format = continuation_messages(messages, partial), None
+        stitcher = _Stitcher(partial)
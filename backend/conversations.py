@@ -0,0 +1,444 @@
+"""
+对话会话
+保存每轮对话的用户需求和AI返回的编辑操作，后续请求（"把刚才那个表格加粗"）带上会话ID即可引用之前的对话。
+提示词中的历史控制在token预算内：最近几轮原样放入（滑动窗口），移出窗口的轮次折叠为摘要；
+摘要在轮次移出窗口时增量更新并缓存，对话再长，每次请求的提示词大小和延迟也保持不变。
+重试（与上一轮相同的需求、相同的文档）沿用上一轮的历史和缓存键，结果替换上一轮而不是再追加一轮。
+多进程模式下会话保存在共享状态中，任一工作进程都能读取和追加。
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+
+from shared_state import SharedState, get_shared_state
+
+logger = logging.getLogger(__name__)
+
+# 对话会话配置（从环境变量读取，如果没有则使用默认值）
+CONVERSATION_HISTORY_TOKENS = int(os.getenv("CONVERSATION_HISTORY_TOKENS", "2000"))  # 提示词中历史（摘要 + 最近几轮）的token预算
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "500"))  # 摘要的token上限，超出时省略最早的轮次
+CONVERSATION_MAX_COUNT = int(os.getenv("CONVERSATION_MAX_COUNT", "1000"))  # 最多保存的会话数
+CONVERSATION_TTL = float(os.getenv("CONVERSATION_TTL", "7200"))  # 会话闲置多久后过期（秒）
+
+# 摘要中每轮对话的用户需求和回复说明最多保留的字符数
+_DIGEST_REQUEST_CHARS = 80
+_DIGEST_MESSAGE_CHARS = 60
+# 摘要中每轮最多列出的编辑操作数，以及锚点/内容的字符数
+_DIGEST_EDITS = 4
+_DIGEST_ANCHOR_CHARS = 20
+# 只和当前文档有关、不放入历史的字段
+_EDIT_SKIP_FIELDS = ("anchorCount", "anchorOffsets")
+
+# 中日韩文字、全角标点大约每个字符一个token，其他文字大约每4个字符一个token
+_WIDE_CHAR_RE = re.compile(r"[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """估算文本的token数（不依赖具体模型的分词器，用于预算控制）"""
+    wide = len(_WIDE_CHAR_RE.findall(text))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    return text if len(text) <= limit else text[:limit] + "…"
+
+
+class ConversationTurn:
+    """一轮对话：用户需求和AI返回的结果（message + edits）"""
+    __slots__ = ("user_request", "message", "edits", "tokens")
+
+    def __init__(self, user_request: str, message: str, edits: List[Dict[str, Any]]):
+        self.user_request = user_request
+        self.message = message
+        self.edits = [
+            {key: value for key, value in edit.items() if value is not None and key not in _EDIT_SKIP_FIELDS}
+            for edit in edits
+        ]
+        self.tokens = estimate_tokens(self.user_request) + estimate_tokens(self.assistant_content())
+
+    def assistant_content(self) -> str:
+        # 与模型的输出格式一致，模型可以直接引用之前的编辑操作
+        return json.dumps({"message": self.message, "edits": self.edits}, ensure_ascii=False, separators=(",", ":"))
+
+    def digest(self, number: int) -> str:
+        """折叠进摘要时的一行文字"""
+        line = f"第{number}轮 用户：{_clip(self.user_request, _DIGEST_REQUEST_CHARS)}"
+        if self.message:
+            line += f" → {_clip(self.message, _DIGEST_MESSAGE_CHARS)}"
+        if self.edits:
+            described = []
+            for edit in self.edits[:_DIGEST_EDITS]:
+                target = edit.get("searchText") or edit.get("content") or ""
+                described.append(f"{edit.get('type')}「{_clip(target, _DIGEST_ANCHOR_CHARS)}」" if target else str(edit.get("type")))
+            more = f"等{len(self.edits)}个" if len(self.edits) > _DIGEST_EDITS else ""
+            line += f"（编辑：{'、'.join(described)}{more}）"
+        return line
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"user_request": self.user_request, "message": self.message, "edits": self.edits}
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ConversationTurn":
+        return cls(data["user_request"], data.get("message", ""), data.get("edits", []))
+
+
+class Conversation:
+    """
+    一个对话会话：最近几轮（滑动窗口）和更早轮次的摘要
+
+    添加一轮后，窗口和摘要的token数超出 CONVERSATION_HISTORY_TOKENS 时，最早的轮次移出窗口并折叠为摘要中的一行；
+    摘要超出 CONVERSATION_SUMMARY_TOKENS 时省略最早的摘要行。历史消息和指纹在会话变化前缓存。
+
+    last_request 记录最近一轮的需求、文档哈希和当时所用历史的指纹，用于识别重试。
+    """
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.window: List[ConversationTurn] = []
+        self.summary_lines: List[str] = []
+        self.summary_tokens = 0
+        self.summarized = 0  # 已折叠为摘要的轮次数
+        self.omitted = 0     # 摘要中已省略的轮次数
+        self.turn_count = 0
+        self.version = 0
+        self.last_access = time.time()
+        self.last_request: Optional[Dict[str, str]] = None
+        self._messages: Optional[List[Dict[str, str]]] = None
+        self._fingerprint = ""
+
+    @property
+    def window_tokens(self) -> int:
+        return sum(turn.tokens for turn in self.window)
+
+    def is_retry(self, user_request: str, document_hash: str) -> bool:
+        """是否是上一轮的重试：需求相同且文档没有变化（上一轮的编辑操作没有应用）"""
+        last = self.last_request
+        return last is not None and last["user_request"] == user_request and last["document_hash"] == document_hash
+
+    def prompt_history(self, user_request: str, document_hash: str) -> Tuple[List[Dict[str, str]], str]:
+        """
+        本次请求使用的 (历史消息, 指纹)
+
+        重试时去掉上一轮本身（仍在窗口中时），指纹沿用上一轮的，这样重试与上一轮使用同一个缓存键。
+        """
+        if not self.is_retry(user_request, document_hash):
+            return self.history_messages(), self.fingerprint()
+        messages = self.history_messages()
+        if self.window:
+            # 窗口中最后一轮就是上一轮（折叠总是从最早的轮次开始）
+            messages = messages[:-2]
+        return messages, self.last_request["fingerprint"]
+
+    def add_turn(self, turn: ConversationTurn, document_hash: str = "", fingerprint: str = "") -> int:
+        """
+        追加一轮对话，返回本次折叠为摘要的轮次数
+
+        重试时替换上一轮（结果相同时不做任何改动）；上一轮已经折叠为摘要时不再记录。
+        """
+        if self.is_retry(turn.user_request, document_hash):
+            if not self.window or self.window[-1].to_dict() == turn.to_dict():
+                return 0
+            self.window[-1] = turn
+        else:
+            self.window.append(turn)
+            self.turn_count += 1
+            self.last_request = {"user_request": turn.user_request, "document_hash": document_hash, "fingerprint": fingerprint}
+        self.version += 1
+        self._messages = None
+        folded = 0
+        window_tokens = self.window_tokens
+        while self.window and window_tokens + self.summary_tokens > CONVERSATION_HISTORY_TOKENS:
+            oldest = self.window.pop(0)
+            window_tokens -= oldest.tokens
+            self.summarized += 1
+            self._append_summary(oldest.digest(self.summarized))
+            folded += 1
+        return folded
+
+    def _append_summary(self, line: str) -> None:
+        self.summary_lines.append(line)
+        self.summary_tokens += estimate_tokens(line)
+        while len(self.summary_lines) > 1 and self.summary_tokens > CONVERSATION_SUMMARY_TOKENS:
+            self.summary_tokens -= estimate_tokens(self.summary_lines.pop(0))
+            self.omitted += 1
+
+    def summary(self) -> str:
+        if not self.summary_lines:
+            return ""
+        header = f"（更早的 {self.omitted} 轮对话已省略）\n" if self.omitted else ""
+        return header + "\n".join(self.summary_lines)
+
+    def history_messages(self) -> List[Dict[str, str]]:
+        """放在系统消息之后、当前用户消息之前的历史消息（缓存到会话下次变化）"""
+        if self._messages is None:
+            messages: List[Dict[str, str]] = []
+            summary = self.summary()
+            if summary:
+                messages.append({"role": "system", "content": f"之前对话的摘要：\n{summary}"})
+            for turn in self.window:
+                messages.append({"role": "user", "content": f"用户需求：{turn.user_request}"})
+                messages.append({"role": "assistant", "content": turn.assistant_content()})
+            self._messages = messages
+            self._fingerprint = hashlib.sha256(
+                json.dumps(messages, ensure_ascii=False).encode("utf-8")
+            ).hexdigest() if messages else ""
+        return self._messages
+
+    def fingerprint(self) -> str:
+        """历史内容的哈希（参与响应缓存键，历史不同的请求不会命中同一个缓存），没有历史时为空字符串"""
+        self.history_messages()
+        return self._fingerprint
+
+    def history_tokens(self) -> int:
+        return self.window_tokens + self.summary_tokens
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "window": [turn.to_dict() for turn in self.window],
+            "summary_lines": self.summary_lines,
+            "summarized": self.summarized,
+            "omitted": self.omitted,
+            "turn_count": self.turn_count,
+            "version": self.version,
+            "last_request": self.last_request
+        }, ensure_ascii=False)
+
+    @classmethod
+    def from_json(cls, conversation_id: str, data: str) -> "Conversation":
+        state = json.loads(data)
+        conversation = cls(conversation_id)
+        conversation.window = [ConversationTurn.from_dict(turn) for turn in state["window"]]
+        conversation.summary_lines = state["summary_lines"]
+        conversation.summary_tokens = sum(estimate_tokens(line) for line in conversation.summary_lines)
+        conversation.summarized = state["summarized"]
+        conversation.omitted = state["omitted"]
+        conversation.turn_count = state["turn_count"]
+        conversation.version = state["version"]
+        conversation.last_request = state.get("last_request")
+        return conversation
+
+    def describe(self) -> Dict[str, Any]:
+        return {
+            "conversation_id": self.conversation_id,
+            "turns": self.turn_count,
+            "window_turns": len(self.window),
+            "summarized_turns": self.summarized,
+            "history_tokens": self.history_tokens(),
+            "summary": self.summary(),
+            "recent": [turn.to_dict() for turn in self.window]
+        }
+
+
+class ConversationStore:
+    """
+    对话会话，按会话数量和闲置时间淘汰（LRU）
+
+    启用共享状态时以共享数据库为准（会话整体序列化为JSON），内存中的会话只是按版本号校验的缓存
+    """
+
+    def __init__(
+        self,
+        max_count: int = CONVERSATION_MAX_COUNT,
+        ttl: float = CONVERSATION_TTL,
+        shared: Callable[[], Optional[SharedState]] = get_shared_state
+    ):
+        self.max_count = max_count
+        self.ttl = ttl
+        self._shared = shared
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+        self.evicted = 0
+        self.turns = 0
+        self.duplicate_turns = 0
+        self.summarized = 0
+        self.history_requests = 0
+        self.history_tokens = 0
+
+    @property
+    def shared(self) -> Optional[SharedState]:
+        """共享状态（第一次使用时才打开数据库），未启用时为None"""
+        return self._shared()
+
+    def _not_found(self, conversation_id: str) -> HTTPException:
+        self._conversations.pop(conversation_id, None)
+        return HTTPException(status_code=404, detail=f"对话会话不存在或已过期: {conversation_id}")
+
+    @staticmethod
+    def _unavailable(e: sqlite3.Error) -> HTTPException:
+        logger.error("[Conversation] 共享会话存储操作失败: %s", e)
+        return HTTPException(status_code=503, detail="对话会话存储暂时不可用，请稍后重试")
+
+    def _cache(self, conversation: Conversation) -> None:
+        self._conversations[conversation.conversation_id] = conversation
+        self._conversations.move_to_end(conversation.conversation_id)
+        now = time.time()
+        # 最久未访问的会话在最前面
+        while self._conversations:
+            conversation_id, oldest = next(iter(self._conversations.items()))
+            if now - oldest.last_access <= self.ttl and len(self._conversations) <= self.max_count:
+                break
+            del self._conversations[conversation_id]
+            if self.shared is None:
+                self.evicted += 1
+
+    def _evict_shared(self, conn: sqlite3.Connection) -> None:
+        cursor = conn.execute("DELETE FROM conversations WHERE last_access < ?", (time.time() - self.ttl,))
+        self.evicted += max(cursor.rowcount, 0)
+        count = conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        if count > self.max_count:
+            cursor = conn.execute(
+                "DELETE FROM conversations WHERE conversation_id IN "
+                "(SELECT conversation_id FROM conversations ORDER BY last_access LIMIT ?)",
+                (count - self.max_count,)
+            )
+            self.evicted += max(cursor.rowcount, 0)
+
+    def create(self) -> Conversation:
+        conversation = Conversation(secrets.token_urlsafe(16))
+        if self.shared is not None:
+            try:
+                with self.shared.transaction() as conn:
+                    conn.execute(
+                        "INSERT INTO conversations (conversation_id, state, version, last_access) VALUES (?, ?, ?, ?)",
+                        (conversation.conversation_id, conversation.to_json(), conversation.version, conversation.last_access)
+                    )
+                    self._evict_shared(conn)
+            except sqlite3.Error as e:
+                raise self._unavailable(e)
+        self._cache(conversation)
+        logger.info("[Conversation] 创建对话会话: %s", conversation.conversation_id)
+        return conversation
+
+    def _load_shared(self, conn: sqlite3.Connection, conversation_id: str, now: float) -> Conversation:
+        row = conn.execute(
+            "SELECT version, last_access FROM conversations WHERE conversation_id = ?", (conversation_id,)
+        ).fetchone()
+        if row is None or now - row[1] > self.ttl:
+            raise self._not_found(conversation_id)
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None or conversation.version != row[0]:
+            # 本进程没有缓存，或者会话已被其他进程追加
+            state = conn.execute(
+                "SELECT state FROM conversations WHERE conversation_id = ?", (conversation_id,)
+            ).fetchone()[0]
+            conversation = Conversation.from_json(conversation_id, state)
+        conn.execute("UPDATE conversations SET last_access = ? WHERE conversation_id = ?", (now, conversation_id))
+        return conversation
+
+    def get(self, conversation_id: str) -> Conversation:
+        """获取会话（不存在或已过期时抛出404）"""
+        now = time.time()
+        if self.shared is not None:
+            try:
+                with self.shared.transaction() as conn:
+                    conversation = self._load_shared(conn, conversation_id, now)
+            except sqlite3.Error as e:
+                raise self._unavailable(e)
+        else:
+            conversation = self._conversations.get(conversation_id)
+            if conversation is None or now - conversation.last_access > self.ttl:
+                raise self._not_found(conversation_id)
+        conversation.last_access = now
+        self._cache(conversation)
+        return conversation
+
+    def history(self, conversation_id: str) -> Conversation:
+        """获取会话用于构建提示词，并记录历史的token数"""
+        conversation = self.get(conversation_id)
+        self.history_requests += 1
+        self.history_tokens += conversation.history_tokens()
+        return conversation
+
+    def record(
+        self,
+        conversation_id: str,
+        user_request: str,
+        response_data: Dict[str, Any],
+        document_hash: str = "",
+        fingerprint: str = ""
+    ) -> None:
+        """
+        把一轮对话（用户需求和AI返回的 AIResponse 字典）追加到会话
+
+        document_hash 为请求所针对的文档，fingerprint 为本轮提示词中历史的指纹（用于识别和处理重试）。
+        会话在请求处理期间过期或被删除时只记录日志（结果已经发给客户端）
+        """
+        turn = ConversationTurn(user_request, response_data.get("message", ""), response_data.get("edits", []))
+        now = time.time()
+        try:
+            if self.shared is not None:
+                # 读取、追加和写回在同一个写事务中，多个进程同时追加同一个会话时不会丢失轮次
+                with self.shared.transaction() as conn:
+                    conversation = self._load_shared(conn, conversation_id, now)
+                    version = conversation.version
+                    folded = conversation.add_turn(turn, document_hash, fingerprint)
+                    if conversation.version != version:
+                        conn.execute(
+                            "UPDATE conversations SET state = ?, version = ?, last_access = ? WHERE conversation_id = ?",
+                            (conversation.to_json(), conversation.version, now, conversation_id)
+                        )
+            else:
+                conversation = self.get(conversation_id)
+                version = conversation.version
+                folded = conversation.add_turn(turn, document_hash, fingerprint)
+        except HTTPException as e:
+            logger.warning("[Conversation] 无法记录对话: %s", e.detail)
+            return
+        except sqlite3.Error as e:
+            logger.error("[Conversation] 记录对话失败: %s", e)
+            return
+        conversation.last_access = now
+        self._cache(conversation)
+        if conversation.version == version:
+            self.duplicate_turns += 1
+            logger.info("[Conversation] 会话 %s 重试上一轮，不再追加新的一轮", conversation_id)
+            return
+        self.turns += 1
+        self.summarized += folded
+        logger.info("[Conversation] 会话 %s 第 %d 轮，窗口 %d 轮，历史约 %d token%s",
+                    conversation_id, conversation.turn_count, len(conversation.window), conversation.history_tokens(),
+                    f"，{folded} 轮折叠为摘要" if folded else "")
+
+    def delete(self, conversation_id: str) -> bool:
+        existed = self._conversations.pop(conversation_id, None) is not None
+        if self.shared is not None:
+            try:
+                with self.shared.transaction() as conn:
+                    existed = conn.execute(
+                        "DELETE FROM conversations WHERE conversation_id = ?", (conversation_id,)
+                    ).rowcount > 0
+            except sqlite3.Error as e:
+                raise self._unavailable(e)
+        return existed
+
+    def stats(self) -> Dict[str, Any]:
+        if self.shared is not None:
+            try:
+                count = self.shared.read("SELECT COUNT(*) FROM conversations")[0][0]
+            except sqlite3.Error:
+                count = -1
+        else:
+            count = len(self._conversations)
+        return {
+            "conversations": count,
+            "turns": self.turns,
+            "duplicate_turns": self.duplicate_turns,
+            "summarized_turns": self.summarized,
+            "evicted": self.evicted,
+            "history_requests": self.history_requests,
+            "avg_history_tokens": round(self.history_tokens / self.history_requests, 1) if self.history_requests else 0.0,
+            "shared": self.shared is not None
+        }
+
+
+# 全局会话存储
+conversations = ConversationStore()
@@ -0,0 +1,297 @@
+"""
+文档会话存储
+文档只需上传一次，之后的请求通过会话ID + 文本补丁引用文档，避免每轮对话重复上传整个文档
+多进程模式下会话保存在共享状态中，任一工作进程都能读取和更新；进程内只缓存最近用过的文档内容
+"""
+import hashlib
+import logging
+import os
+import secrets
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+
+from shared_state import SharedState, get_shared_state
+
+logger = logging.getLogger(__name__)
+
+# 会话存储配置（从环境变量读取，如果没有则使用默认值）
+DOCUMENT_SESSION_MAX_BYTES = int(os.getenv("DOCUMENT_SESSION_MAX_BYTES", str(256 * 1024 * 1024)))
+DOCUMENT_SESSION_MAX_COUNT = int(os.getenv("DOCUMENT_SESSION_MAX_COUNT", "1000"))
+DOCUMENT_SESSION_TTL = float(os.getenv("DOCUMENT_SESSION_TTL", "7200"))  # 会话闲置多久后过期（秒）
+DOCUMENT_MAX_BYTES = int(os.getenv("DOCUMENT_MAX_BYTES", str(16 * 1024 * 1024)))  # 单个文档的最大字节数
+
+
+class DocumentPatch(BaseModel):
+    """文本补丁：把基准文档中 [start, end) 的内容替换为 text（偏移量以Unicode字符计）"""
+    start: int
+    end: int
+    text: str = ""
+
+
+def hash_document(content: str) -> Tuple[str, int]:
+    """计算文档内容的SHA-256，同时返回UTF-8字节数"""
+    data = content.encode("utf-8")
+    return hashlib.sha256(data).hexdigest(), len(data)
+
+
+def apply_patches(content: str, patches: List[DocumentPatch]) -> str:
+    """把一组互不重叠的补丁应用到文档上（偏移量均相对于原文档）"""
+    if not patches:
+        return content
+    ordered = sorted(patches, key=lambda p: (p.start, p.end))
+    parts: List[str] = []
+    cursor = 0
+    for patch in ordered:
+        if patch.start < cursor or patch.end < patch.start or patch.end > len(content):
+            raise HTTPException(
+                status_code=400,
+                detail=f"文档补丁无效: start={patch.start}, end={patch.end}, 文档长度={len(content)}"
+            )
+        parts.append(content[cursor:patch.start])
+        parts.append(patch.text)
+        cursor = patch.end
+    parts.append(content[cursor:])
+    return "".join(parts)
+
+
+class DocumentSession:
+    """一个已注册的文档"""
+    __slots__ = ("session_id", "content", "content_hash", "size", "last_access")
+
+    def __init__(self, session_id: str, content: str, content_hash: str, size: int):
+        self.session_id = session_id
+        self.content = content
+        self.content_hash = content_hash
+        self.size = size
+        self.last_access = time.time()
+
+
+class DocumentSessionStore:
+    """
+    文档会话，按总字节数、会话数量和闲置时间淘汰（LRU）
+
+    启用共享状态时以共享数据库为准，内存中的会话只是按内容哈希校验的缓存
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DOCUMENT_SESSION_MAX_BYTES,
+        max_count: int = DOCUMENT_SESSION_MAX_COUNT,
+        ttl: float = DOCUMENT_SESSION_TTL,
+        shared: Callable[[], Optional[SharedState]] = get_shared_state
+    ):
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        self.ttl = ttl
+        self._shared = shared
+        self._sessions: "OrderedDict[str, DocumentSession]" = OrderedDict()
+        self._bytes = 0
+        self.evicted = 0
+
+    @property
+    def shared(self) -> Optional[SharedState]:
+        """共享状态（第一次使用时才打开数据库），未启用时为None"""
+        return self._shared()
+
+    def _drop(self, session_id: str) -> None:
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self._bytes -= session.size
+
+    def _evict(self) -> None:
+        now = time.time()
+        # 最久未访问的会话在最前面
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            expired = now - session.last_access > self.ttl
+            over_limit = len(self._sessions) > self.max_count or self._bytes > self.max_bytes
+            if not expired and not over_limit:
+                break
+            self._drop(session_id)
+            self.evicted += 1
+
+    def _set_content(self, session: DocumentSession, content: str, known_hash: Optional[Tuple[str, int]] = None) -> None:
+        content_hash, size = known_hash or hash_document(content)
+        if size > DOCUMENT_MAX_BYTES:
+            raise HTTPException(status_code=413, detail=f"文档过大: {size} 字节（上限 {DOCUMENT_MAX_BYTES} 字节）")
+        self._bytes += size - session.size
+        session.content = content
+        session.content_hash = content_hash
+        session.size = size
+
+    def _cache(self, session: DocumentSession) -> None:
+        self._sessions[session.session_id] = session
+        self._sessions.move_to_end(session.session_id)
+        self._evict()
+
+    @staticmethod
+    def _unavailable(e: sqlite3.Error) -> HTTPException:
+        logger.error("[DocSession] 共享会话存储操作失败: %s", e)
+        return HTTPException(status_code=503, detail="文档会话存储暂时不可用，请稍后重试")
+
+    def _evict_shared(self, conn: sqlite3.Connection) -> None:
+        """在共享数据库中删除过期会话，超出数量或字节上限时删除最久未访问的会话"""
+        cursor = conn.execute("DELETE FROM documents WHERE last_access < ?", (time.time() - self.ttl,))
+        self.evicted += max(cursor.rowcount, 0)
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents").fetchone()
+        if count <= self.max_count and total <= self.max_bytes:
+            return
+        for session_id, size in conn.execute(
+            "SELECT session_id, size FROM documents ORDER BY last_access"
+        ).fetchall():
+            if count <= self.max_count and total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM documents WHERE session_id = ?", (session_id,))
+            count -= 1
+            total -= size
+            self.evicted += 1
+
+    def create(self, content: str, known_hash: Optional[Tuple[str, int]] = None) -> DocumentSession:
+        """注册一个新文档，返回会话（known_hash 为接收请求体时已经算出的 (哈希, 字节数)）"""
+        session = DocumentSession(secrets.token_urlsafe(16), "", "", 0)
+        self._set_content(session, content, known_hash)
+        if self.shared is not None:
+            try:
+                with self.shared.transaction() as conn:
+                    conn.execute(
+                        "INSERT INTO documents (session_id, content, content_hash, size, last_access) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (session.session_id, session.content, session.content_hash, session.size, session.last_access)
+                    )
+                    self._evict_shared(conn)
+            except sqlite3.Error as e:
+                self._bytes -= session.size
+                raise self._unavailable(e)
+        self._cache(session)
+        logger.info("[DocSession] 注册文档会话: %s (%d 字节)", session.session_id, session.size)
+        return session
+
+    def _get_shared(self, session_id: str) -> DocumentSession:
+        now = time.time()
+        try:
+            with self.shared.transaction() as conn:
+                row = conn.execute(
+                    "SELECT content_hash, last_access FROM documents WHERE session_id = ?", (session_id,)
+                ).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    conn.execute("UPDATE documents SET last_access = ? WHERE session_id = ?", (now, session_id))
+            if row is None or now - row[1] > self.ttl:
+                self._drop(session_id)
+                raise HTTPException(status_code=404, detail=f"文档会话不存在或已过期: {session_id}")
+            session = self._sessions.get(session_id)
+            if session is None or session.content_hash != row[0]:
+                # 本进程没有缓存，或者文档已被其他进程更新
+                content = self.shared.read("SELECT content FROM documents WHERE session_id = ?", (session_id,))
+                if not content:
+                    raise HTTPException(status_code=404, detail=f"文档会话不存在或已过期: {session_id}")
+                if session is None:
+                    session = DocumentSession(session_id, "", "", 0)
+                self._set_content(session, content[0][0])
+        except sqlite3.Error as e:
+            raise self._unavailable(e)
+        session.last_access = now
+        self._cache(session)
+        return session
+
+    def get(self, session_id: str) -> DocumentSession:
+        """获取会话（不存在或已过期时抛出404）"""
+        if self.shared is not None:
+            return self._get_shared(session_id)
+        session = self._sessions.get(session_id)
+        if session is None or time.time() - session.last_access > self.ttl:
+            if session is not None:
+                self._drop(session_id)
+            raise HTTPException(status_code=404, detail=f"文档会话不存在或已过期: {session_id}")
+        session.last_access = time.time()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def update(
+        self,
+        session_id: str,
+        base_hash: Optional[str],
+        patches: Optional[List[DocumentPatch]]
+    ) -> DocumentSession:
+        """
+        对会话中的文档应用补丁
+
+        带补丁时必须提供 base_hash（缺少时返回400），且必须与服务器当前保存的文档哈希一致，
+        否则返回409，客户端应重新注册文档；补丁的偏移量只有相对于确定的版本才有意义
+        """
+        if patches and not base_hash:
+            raise HTTPException(status_code=400, detail="应用文档补丁时必须提供 base_hash")
+        session = self.get(session_id)
+        if base_hash and base_hash != session.content_hash:
+            raise HTTPException(
+                status_code=409,
+                detail=f"文档版本不匹配: 服务器为 {session.content_hash}，请求基于 {base_hash}"
+            )
+        if patches:
+            old_hash = session.content_hash
+            self._set_content(session, apply_patches(session.content, patches))
+            if self.shared is not None:
+                self._store_shared(session, old_hash)
+            self._evict()
+        return session
+
+    def _store_shared(self, session: DocumentSession, old_hash: str) -> None:
+        """写回共享数据库；文档在此期间被其他进程更新时返回409"""
+        try:
+            with self.shared.transaction() as conn:
+                cursor = conn.execute(
+                    "UPDATE documents SET content = ?, content_hash = ?, size = ?, last_access = ? "
+                    "WHERE session_id = ? AND content_hash = ?",
+                    (session.content, session.content_hash, session.size, time.time(), session.session_id, old_hash)
+                )
+                updated = cursor.rowcount > 0
+                if updated:
+                    self._evict_shared(conn)
+        except sqlite3.Error as e:
+            self._drop(session.session_id)
+            raise self._unavailable(e)
+        if not updated:
+            self._drop(session.session_id)
+            raise HTTPException(
+                status_code=409,
+                detail=f"文档版本不匹配: 会话 {session.session_id} 已被其他请求更新，请重新获取文档"
+            )
+
+    def delete(self, session_id: str) -> bool:
+        existed = session_id in self._sessions
+        self._drop(session_id)
+        if self.shared is not None:
+            try:
+                with self.shared.transaction() as conn:
+                    existed = conn.execute("DELETE FROM documents WHERE session_id = ?", (session_id,)).rowcount > 0
+            except sqlite3.Error as e:
+                raise self._unavailable(e)
+        return existed
+
+    def stats(self) -> Dict[str, int]:
+        if self.shared is not None:
+            try:
+                count, total = self.shared.read("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM documents")[0]
+            except sqlite3.Error:
+                count, total = -1, -1
+            return {
+                "sessions": count,
+                "bytes": total,
+                "cached_sessions": len(self._sessions),
+                "cached_bytes": self._bytes,
+                "evicted": self.evicted,
+                "shared": True
+            }
+        return {
+            "sessions": len(self._sessions),
+            "bytes": self._bytes,
+            "evicted": self.evicted
+        }
+
+
+# 全局会话存储
+document_sessions = DocumentSessionStore()
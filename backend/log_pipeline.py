@@ -0,0 +1,256 @@
+"""
+非阻塞日志管道
+调用方只把日志记录放进有界队列，由后台线程格式化并写入控制台和日志文件；
+高频类别（数据块、心跳）按比例采样，文件日志为带请求ID的JSON行，按大小和日期轮转并压缩
+"""
+import atexit
+import contextvars
+import glob
+import gzip
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+# 日志配置（从环境变量读取，如果没有则使用默认值）
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FILE_FORMAT = os.getenv("LOG_FILE_FORMAT", "json").lower()  # json 或 text
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))  # 单个日志文件最大字节数，0表示不按大小轮转
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "14"))  # 保留的已轮转日志文件数
+LOG_COMPRESS = os.getenv("LOG_COMPRESS", "true").lower() in ("1", "true", "yes")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # 等待写入的日志记录上限，超出时丢弃
+# 各类别的采样率（0~1），未列出的类别全部保留
+LOG_SAMPLE_RATES = {
+    "chunk": float(os.getenv("LOG_SAMPLE_CHUNK", "0.01")),
+    "heartbeat": float(os.getenv("LOG_SAMPLE_HEARTBEAT", "0.1"))
+}
+
+TEXT_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(request_tag)s%(message)s"
+
+# 当前请求的ID（由请求入口设置，随 asyncio 任务的上下文传播到其创建的子任务）
+request_id_var: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+# 日志类别（通过 extra 传入），供采样使用
+CHUNK = {"category": "chunk"}
+HEARTBEAT = {"category": "heartbeat"}
+
+
+class SamplingFilter(logging.Filter):
+    """按类别确定性采样：每个类别累积采样率，满1时放行一条"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._credit: Dict[str, float] = {}
+        self.sampled_out = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        category = getattr(record, "category", None)
+        if category is None:
+            return True
+        rate = self.rates.get(category)
+        if rate is None or rate >= 1:
+            return True
+        credit = self._credit.get(category, 1.0) + rate
+        if credit >= 1:
+            self._credit[category] = credit - 1
+            return True
+        self._credit[category] = credit
+        self.sampled_out += 1
+        return False
+
+
+class _AsyncQueueHandler(logging.handlers.QueueHandler):
+    """
+    只在调用线程上做最少的工作：附加请求ID并入队
+
+    与标准 QueueHandler 不同，消息格式化留给后台线程（记录只在进程内传递，不需要提前序列化）；
+    队列满时丢弃记录并计数，不阻塞调用方。
+    """
+
+    def __init__(self, log_queue: "queue.Queue[logging.LogRecord]"):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        if record.exc_info and not record.exc_text:
+            # 异常信息引用调用栈，在当前线程格式化后释放
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class _TextFormatter(logging.Formatter):
+    """控制台和文本日志：带请求ID时附加在消息前"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        request_id = getattr(record, "request_id", None)
+        record.request_tag = f"[{request_id}] " if request_id else ""
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """每条记录一行JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage()
+        }
+        request_id = getattr(record, "request_id", None)
+        if request_id:
+            entry["request_id"] = request_id
+        category = getattr(record, "category", None)
+        if category:
+            entry["category"] = category
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.BaseRotatingHandler):
+    """
+    按大小和日期轮转的日志文件
+
+    当前日志始终写入 filename；跨过午夜或超过 max_bytes 时，旧文件重命名为
+    <名称>_<开始时间>.log（可选gzip压缩），只保留最近 backup_count 个。
+    """
+
+    def __init__(self, filename: str, max_bytes: int, backup_count: int, compress: bool):
+        super().__init__(filename, "a", encoding="utf-8", delay=False)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        stem, self._suffix = os.path.splitext(self.baseFilename)
+        self._stem = stem
+        # 沿用已有文件时，从它最后写入的时间开始计算轮转时刻
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            self._period_start = os.path.getmtime(self.baseFilename)
+        else:
+            self._period_start = time.time()
+        self._rollover_at = self._next_midnight(self._period_start)
+
+    @staticmethod
+    def _next_midnight(timestamp: float) -> float:
+        day = datetime.fromtimestamp(timestamp).date() + timedelta(days=1)
+        return datetime(day.year, day.month, day.day).timestamp()
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if time.time() >= self._rollover_at:
+            return True
+        # 超过上限后的下一条记录触发轮转（避免为计算长度重复格式化）
+        return self.max_bytes > 0 and self.stream is not None and self.stream.tell() >= self.max_bytes
+
+    def _rotated_name(self) -> str:
+        base = f"{self._stem}_{datetime.fromtimestamp(self._period_start).strftime('%Y%m%d_%H%M%S')}"
+        name = f"{base}{self._suffix}"
+        counter = 1
+        while os.path.exists(name) or os.path.exists(name + ".gz"):
+            name = f"{base}_{counter}{self._suffix}"
+            counter += 1
+        return name
+
+    def rotated_files(self) -> List[str]:
+        """已轮转的日志文件，按时间从旧到新"""
+        files = glob.glob(glob.escape(self._stem) + "_*" + self._suffix + "*")
+        return sorted(files, key=os.path.getmtime)
+
+    def doRollover(self) -> None:
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            rotated = self._rotated_name()
+            os.replace(self.baseFilename, rotated)
+            if self.compress:
+                with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+        if self.backup_count > 0:
+            for old in self.rotated_files()[:-self.backup_count]:
+                os.remove(old)
+        self.stream = self._open()
+        self._period_start = time.time()
+        self._rollover_at = self._next_midnight(self._period_start)
+
+
+class LogPipeline:
+    """日志队列、后台写入线程和采样统计"""
+
+    def __init__(self):
+        self.log_file: Optional[str] = None
+        self._handler: Optional[_AsyncQueueHandler] = None
+        self._sampler: Optional[SamplingFilter] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._lock = threading.Lock()
+
+    def start(self, log_dir: Optional[str], name: str = "backend") -> None:
+        """替换根日志器的处理器：调用方只入队，后台线程写入控制台和轮转日志文件（log_dir 为None时只写控制台）"""
+        with self._lock:
+            if self._listener is not None:
+                return
+            console = logging.StreamHandler(sys.stdout)
+            console.setFormatter(_TextFormatter(TEXT_FORMAT))
+            handlers: List[logging.Handler] = [console]
+            if log_dir is not None:
+                os.makedirs(log_dir, exist_ok=True)
+                self.log_file = os.path.join(log_dir, f"{name}.log")
+                file_handler = SizedTimedRotatingFileHandler(self.log_file, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_COMPRESS)
+                file_handler.setFormatter(JsonFormatter() if LOG_FILE_FORMAT == "json" else _TextFormatter(TEXT_FORMAT))
+                handlers.append(file_handler)
+
+            log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+            self._sampler = SamplingFilter(LOG_SAMPLE_RATES)
+            self._handler = _AsyncQueueHandler(log_queue)
+            self._handler.addFilter(self._sampler)
+            self._listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+
+            root = logging.getLogger()
+            for handler in root.handlers[:]:
+                root.removeHandler(handler)
+            root.addHandler(self._handler)
+            root.setLevel(LOG_LEVEL)
+            self._listener.start()
+            # 退出时写完队列中剩余的记录
+            atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """写完队列中剩余的记录后停止后台线程"""
+        with self._lock:
+            if self._listener is None:
+                return
+            self._listener.stop()
+            self._listener = None
+            for handler in logging.getLogger().handlers[:]:
+                if handler is self._handler:
+                    logging.getLogger().removeHandler(handler)
+            self._handler = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "queue_depth": self._handler.queue.qsize() if self._handler is not None else 0,
+            "dropped": self._handler.dropped if self._handler is not None else 0,
+            "sampled_out": self._sampler.sampled_out if self._sampler is not None else 0
+        }
+
+
+# 全局实例
+log_pipeline = LogPipeline()
@@ -1,44 +1,61 @@
 """
 FastAPI 后端服务
 作为前端和AI API之间的代理服务器
+
+应用由 create_app(settings) 创建；导入本模块没有副作用（不配置日志、不访问文件系统），
+模块属性 app 在第一次访问时才用默认配置创建（uvicorn main:app）。
 """
-from fastapi import FastAPI, HTTPException
+from startup_profile import startup_profile
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi.responses import StreamingResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
-from typing import Optional, List, Dict, Any, AsyncGenerator, Tuple
+from pydantic import BaseModel, ValidationError
+from typing import Optional, List, Dict, Any, AsyncGenerator, AsyncIterator, Awaitable, Callable, Tuple
 import httpx
+import asyncio
 import logging
 import os
 import json
 import time
-import sys
+import uuid
 from pathlib import Path
-from datetime import datetime
+from urllib.parse import urlsplit
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
 
-# 加载环境变量
+# 加载环境变量（必须在导入读取环境变量的模块之前）
 load_dotenv()
 
-# 创建日志目录
-log_dir = os.path.join(os.path.dirname(__file__), 'logs')
-os.makedirs(log_dir, exist_ok=True)
-
-# 日志文件名（带日期）
-log_file = os.path.join(log_dir, f'backend_{datetime.now().strftime("%Y%m%d")}.log')
-
-# 配置日志：同时输出到文件和控制台
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file, encoding='utf-8'),
-        logging.StreamHandler(sys.stdout)
-    ]
+from upstream_client import upstream_clients, prewarm_targets, UPSTREAM_PREWARM
+from stream_parser import IncrementalEditParser, EVENT_EDIT
+from response_cache import response_cache, make_cache_key
+from single_flight import single_flight
+from context_selector import select_context
+from document_sessions import document_sessions, DocumentPatch, hash_document
+from conversations import conversations
+from admission import admission, AdmissionRejected, AdmissionWait
+from upstream_router import upstream_router
+from anchor_index import annotate_edits, anchor_stats, get_document_anchors, ANCHOR_RESOLUTION
+from continuation import UpstreamTruncated, stream_with_continuation, continuation_stats
+from request_body import read_json_body, body_stats
+from map_reduce import split_sections, section_instruction, merge_section_results, MAP_REDUCE_AUTO_CHARS, MAP_REDUCE_MAX_CONCURRENCY
+from sse_codec import SSEDecoder, extract_delta, is_done, encode_event, tag_event
+from static_assets import AssetStore, asset_store
+from shared_state import get_shared_state, close_shared_state, SERVER_WORKERS, SHARED_STATE_DB
+from log_pipeline import log_pipeline, request_id_var, CHUNK, HEARTBEAT
+from tracing import (
+    current_trace, trace_scope, trace_sink, span, record_span, timing_summary, set_trace_attrs, start_trace, finish_trace
+)
+from metrics import (
+    metrics, REQUEST_BODY_BYTES, PROMPT_CHARS, UPSTREAM_CONNECT_SECONDS, UPSTREAM_HEADERS_SECONDS,
+    UPSTREAM_TTFT_SECONDS, UPSTREAM_CHUNK_GAP_SECONDS, GENERATION_SECONDS, GENERATION_CHARS_PER_SECOND,
+    GENERATION_CHUNKS_PER_SECOND, UPSTREAM_REQUESTS, PARSE_SECONDS, SSE_BYTES, SSE_BYTES_SENT,
+    PROCESS_ERRORS, ACTIVE_STREAMS
 )
+
 logger = logging.getLogger(__name__)
-logger.info(f"日志文件: {log_file}")
 
 # 获取项目根目录和dist目录
 BACKEND_DIR = Path(__file__).parent
@@ -46,38 +63,118 @@ PROJECT_ROOT = BACKEND_DIR.parent
 DIST_DIR = PROJECT_ROOT / "dist"
 ASSETS_DIR = PROJECT_ROOT / "assets"
 
-logger.info(f"[Server] 项目根目录: {PROJECT_ROOT}")
-logger.info(f"[Server] 前端构建目录: {DIST_DIR}")
-logger.info(f"[Server] 资源目录: {ASSETS_DIR}")
-logger.info(f"[Server] dist目录是否存在: {DIST_DIR.exists()}")
 
-# 创建FastAPI应用
-app = FastAPI(
-    title="Word AI助手服务",
-    description="Word/WPS AI助手插件的完整服务（API + 前端）",
-    version="1.0.0"
-)
+class AppSettings:
+    """create_app 的配置；默认值对应正常运行的服务，测试可以关闭日志文件、静态资源预加载和连接预热"""
+
+    def __init__(
+        self,
+        dist_dir: Path = DIST_DIR,
+        assets_dir: Path = ASSETS_DIR,
+        log_dir: Optional[str] = os.path.join(os.path.dirname(__file__), 'logs'),
+        configure_logging: bool = True,
+        preload_static: bool = True,
+        prewarm: Optional[bool] = None
+    ):
+        self.dist_dir = dist_dir
+        self.assets_dir = assets_dir
+        self.log_dir = log_dir  # None 表示只输出到控制台
+        self.configure_logging = configure_logging  # False 时不改动日志配置（沿用调用方的配置）
+        self.preload_static = preload_static  # 启动后在后台加载 dist/；False 时在第一个静态请求时加载
+        self.prewarm = UPSTREAM_PREWARM if prewarm is None else prewarm  # 启动后在后台预热上游连接
 
-# 配置CORS（允许前端跨域请求）
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # 生产环境应该指定具体域名
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-# 注意：静态文件挂载将在所有API路由定义之后进行
-# 这样可以确保API路由（如 /api/process）优先匹配，不会被静态文件路由拦截
+async def _prewarm_upstreams() -> None:
+    with startup_profile.measure("upstream_prewarm", phase="background"):
+        await upstream_clients.prewarm(prewarm_targets(DEFAULT_API_URL) + upstream_router.urls())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动时登记工作进程，在后台加载静态资源和预热上游连接；关闭时释放连接池
+
+    后台任务不阻塞启动，静态请求会等待首次加载完成，上游请求在预热完成前照常建立连接。
+    """
+    settings: AppSettings = app.state.settings
+    # 配置的上游的连接池一直保留，请求中临时指定的上游数量有上限
+    upstream_clients.pin(prewarm_targets(DEFAULT_API_URL) + upstream_router.urls())
+    # 共享状态数据库在工作进程启动时打开（导入时不打开，多进程模式的主进程也不打开）
+    shared_state = get_shared_state()
+    if shared_state is not None:
+        with startup_profile.measure("shared_state_register"):
+            shared_state.register()
+    background: List[asyncio.Task] = []
+    if settings.preload_static:
+        app.state.assets.start()
+    if settings.prewarm:
+        background.append(asyncio.create_task(_prewarm_upstreams()))
+    startup_profile.mark_ready()
+    yield
+    for task in background:
+        task.cancel()
+    await upstream_clients.aclose()
+    response_cache.close()
+    trace_sink.close()
+    close_shared_state()
+
+
+# 路由先注册到 router，由 create_app 加入应用
+# 静态文件的通配路由最后注册，确保API路由（如 /api/process）优先匹配，不会被静态文件路由拦截
+router = APIRouter()
 
 # 请求模型
 class ProcessRequest(BaseModel):
     """处理请求的模型"""
     user_request: str
-    document_content: str
+    document_content: str = ""  # 使用文档会话时可以省略
+    api_key: Optional[str] = None
+    api_url: Optional[str] = None
+    model_name: Optional[str] = None
+    bypass_cache: bool = False  # 为True时跳过响应缓存和在途请求合并，强制重新调用AI API
+    compact_output: Optional[bool] = None  # 紧凑结构化输出模式，None表示使用服务器默认值
+    # 文档会话：通过 /api/documents 注册文档后，只需传会话ID和相对于 base_hash 的补丁
+    document_session_id: Optional[str] = None
+    base_hash: Optional[str] = None
+    document_patch: Optional[List[DocumentPatch]] = None
+    # 分段处理：把长文档切分为多个部分并发调用AI API再合并结果；None表示按 MAP_REDUCE_AUTO_CHARS 自动决定
+    map_reduce: Optional[bool] = None
+    # 对话会话：通过 /api/conversations 创建，提示词带上之前的对话，结果追加到会话
+    conversation_id: Optional[str] = None
+
+
+class BatchInstruction(BaseModel):
+    """批量请求中的一条指令"""
+    id: Optional[str] = None  # 指令ID，事件中的 instruction_id；省略时使用序号
+    user_request: str
+    bypass_cache: Optional[bool] = None  # None表示沿用批量请求的设置
+    compact_output: Optional[bool] = None
+
+
+class BatchProcessRequest(BaseModel):
+    """批量处理请求的模型：文档只上传一次，多条指令分别调用AI API"""
+    instructions: List[BatchInstruction]
+    document_content: str = ""  # 使用文档会话时可以省略
     api_key: Optional[str] = None
     api_url: Optional[str] = None
     model_name: Optional[str] = None
+    bypass_cache: bool = False
+    compact_output: Optional[bool] = None
+    max_concurrency: Optional[int] = None  # 同时进行的上游调用数，不超过服务器的 BATCH_MAX_CONCURRENCY
+    document_session_id: Optional[str] = None
+    base_hash: Optional[str] = None
+    document_patch: Optional[List[DocumentPatch]] = None
+
+
+class DocumentRegisterRequest(BaseModel):
+    """注册文档会话的请求模型"""
+    content: str
+
+
+class DocumentUpdateRequest(BaseModel):
+    """更新文档会话的请求模型"""
+    base_hash: Optional[str] = None
+    patches: List[DocumentPatch] = []
 
 
 class EditOperation(BaseModel):
@@ -94,6 +191,11 @@ class EditOperation(BaseModel):
     tableData: Optional[List[List[str]]] = None  # 表格数据，二维数组，第一行通常是表头
     # 段落样式相关参数
     style: Optional[str] = None  # 段落样式，如 "Heading1", "Heading2", "Heading3", "Normal"
+    # 服务器端解析的锚点：searchText 在 document_content 中（忽略大小写）的出现次数和起始偏移量，0次表示找不到
+    anchorCount: Optional[int] = None
+    anchorOffsets: Optional[List[int]] = None
+    # 在模型输出的 edits 数组中的位置，与增量 edit 事件的 index 一致（分段处理合并后的结果没有）
+    index: Optional[int] = None
 
 
 class AIResponse(BaseModel):
@@ -105,46 +207,84 @@ class AIResponse(BaseModel):
 # 默认配置（从环境变量读取，如果没有则使用默认值）
 DEFAULT_API_URL = os.getenv("DEFAULT_API_URL", "https://api.openai.com/v1/chat/completions")
 DEFAULT_MODEL_NAME = os.getenv("DEFAULT_MODEL_NAME", "gpt-3.5-turbo")
+AI_MAX_TOKENS = int(os.getenv("AI_MAX_TOKENS", "8000"))  # 单次调用允许生成的最大token数
 
+# SSE转发配置
+SSE_HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", "10"))  # 空闲多久发送一次心跳（秒）
+SSE_PROGRESS_INTERVAL = float(os.getenv("SSE_PROGRESS_INTERVAL", "3"))  # 进度更新的最小间隔（秒）
+SSE_RELAY_QUEUE_SIZE = int(os.getenv("SSE_RELAY_QUEUE_SIZE", "64"))  # 上游与SSE之间的缓冲块数
+SSE_DISCONNECT_POLL_INTERVAL = float(os.getenv("SSE_DISCONNECT_POLL_INTERVAL", "1"))  # 检查客户端是否断开的间隔（秒）
 
-def build_prompt(user_request: str, document_content: str) -> str:
-    """构建AI提示词"""
-    # 限制文档内容长度
-    doc_preview = document_content[:2000]
-    if len(document_content) > 2000:
-        doc_preview += "..."
-    
-    return f"""你是一个Word文档编辑助手。用户想要对文档进行编辑，请根据用户需求生成编辑操作。
+# 批量处理配置
+BATCH_MAX_INSTRUCTIONS = int(os.getenv("BATCH_MAX_INSTRUCTIONS", "10"))  # 一个批量请求最多包含的指令数
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "3"))  # 一个批量请求同时进行的上游调用数
 
-当前文档内容：
-{doc_preview}
+# 转发队列中的控制事件（预先构造，避免每次唤醒时分配）
+_RELAY_DONE = ('done', None, None, None, None)
+_RELAY_ERROR = ('error', None, None, None, None)
+_RELAY_HEARTBEAT = ('heartbeat', None, None, None, None)
+_RELAY_DISCONNECTED = ('disconnected', None, None, None, None)
+
+# 客户端断开统计：断开时仍在生成的请求数、因此取消的上游调用数和估算节省的token数
+# （OpenAI兼容的流式响应大约每个数据块一个token，节省量按 max_tokens - 已接收块数 估算，是上限）
+disconnect_stats = {
+    "cancelled_streams": 0,
+    "upstream_cancelled": 0,
+    "tokens_saved_estimate": 0
+}
+
+# 批量请求统计
+batch_stats = {
+    "batches": 0,
+    "instructions": 0,
+    "completed": 0,
+    "failed": 0
+}
+
+# 分段处理统计
+map_reduce_stats = {
+    "requests": 0,
+    "sections": 0,
+    "failed_sections": 0,
+    "duplicates": 0,
+    "conflicts": 0
+}
 
-用户需求：{user_request}
 
-请以JSON格式返回编辑操作，格式如下：
-{{
+# 提示词版本：修改 build_prompt 的内容时需要递增，使旧的缓存响应失效
+PROMPT_VERSION = "2"
+
+# 提示词布局：prefix（静态指令在系统消息中，便于前缀缓存）或 legacy（全部在用户消息中）
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "prefix").lower()
+# 默认是否使用紧凑的结构化输出模式（需要上游支持 response_format 的 json_schema）
+PROMPT_COMPACT_DEFAULT = os.getenv("PROMPT_COMPACT", "false").lower() in ("1", "true", "yes")
+
+
+# 输出格式、操作类型说明和示例（静态内容，legacy布局和prefix布局共用）
+PROMPT_INSTRUCTIONS = """请以JSON格式返回编辑操作，格式如下：
+{
   "message": "操作说明",
   "edits": [
-    {{
+    {
       "type": "insert|replace|format|delete|addParagraph|insertTable|setHeading",
       "content": "文本内容（如果需要）",
       "position": "start|end|数字",
       "searchText": "要搜索的文本（如果需要）",
       "replaceText": "替换的文本（如果需要）",
-      "format": {{
+      "format": {
         "bold": true/false,
         "italic": true/false,
         "underline": true/false,
         "fontSize": 数字,
         "fontColor": "颜色代码"
-      }},
+      },
       "tableRows": 行数（仅当type为insertTable时）,
       "tableColumns": 列数（仅当type为insertTable时）,
       "tableData": [["表头1", "表头2", ...], ["数据1", "数据2", ...], ...]（表格数据，二维数组，第一行是表头）,
       "style": "Heading1|Heading2|Heading3|Normal"（段落样式，用于标题或段落）
-    }}
+    }
   ]
-}}
+}
 
 支持的编辑操作类型：
 - insert: 插入文本
@@ -162,22 +302,22 @@ def build_prompt(user_request: str, document_content: str) -> str:
 - "Normal": 正文样式
 
 示例1：如果用户要求"在文档末尾插入三行四列的表格"，应返回：
-{{
+{
   "message": "已在文档末尾插入三行四列的表格",
   "edits": [
-    {{
+    {
       "type": "insertTable",
       "tableRows": 3,
       "tableColumns": 4
-    }}
+    }
   ]
-}}
+}
 
 示例2：如果用户要求"用表格的形式整理南宋的最后七位皇帝,需要包含以下信息:称号、名字、生卒年月、在位时间、主要辅佐的宰相、与崖山之战的关系、去世的年纪"，应返回：
-{{
+{
   "message": "已在文档末尾插入包含南宋最后七位皇帝信息的表格",
   "edits": [
-    {{
+    {
       "type": "insertTable",
       "tableRows": 8,
       "tableColumns": 7,
@@ -191,9 +331,9 @@ def build_prompt(user_request: str, document_content: str) -> str:
         ["宋度宗", "赵禥", "1240-1274", "1264-1274", "贾似道", "无关", "35"],
         ["宋恭帝", "赵㬎", "1271-1323", "1274-1276", "陈宜中", "1279年崖山之战前已退位", "53"]
       ]
-    }}
+    }
   ]
-}}
+}
 
 注意：
 1. tableData的第一行必须是表头，后续行是数据行。tableRows应该等于tableData的行数，tableColumns应该等于tableData每行的列数。
@@ -203,173 +343,298 @@ def build_prompt(user_request: str, document_content: str) -> str:
 只返回JSON，不要其他内容。"""
 
 
+def build_prompt(user_request: str, document_content: str, document_hash: Optional[str] = None) -> str:
+    """构建AI提示词（legacy布局：指令、文档和需求都在同一条用户消息中）"""
+    # 按与用户需求的相关度选取文档内容，控制在字符预算内
+    doc_preview = select_context(user_request, document_content, document_hash=document_hash)
+    
+    return f"""你是一个Word文档编辑助手。用户想要对文档进行编辑，请根据用户需求生成编辑操作。
+
+当前文档内容：
+{doc_preview}
+
+用户需求：{user_request}
+
+""" + PROMPT_INSTRUCTIONS
+
+
+# 系统角色说明
+SYSTEM_ROLE_PROMPT = "你是一个专业的Word文档编辑助手，能够理解用户需求并生成准确的编辑操作。"
+
+# prefix布局的系统消息：只包含静态内容且逐字节稳定，使上游的提示词前缀缓存可以命中
+PREFIX_SYSTEM_PROMPT = SYSTEM_ROLE_PROMPT + "\n\n" + PROMPT_INSTRUCTIONS
+
+# 紧凑模式的系统消息：输出结构由 response_format 中的JSON Schema约束，不再附带格式说明和示例
+COMPACT_SYSTEM_PROMPT = SYSTEM_ROLE_PROMPT + """
+根据用户需求生成编辑操作，按给定的JSON Schema返回。
+操作类型：insert 插入文本；replace 替换文本（searchText替换为replaceText）；format 格式化文本（format可包含bold、italic、underline、fontSize、fontColor）；delete 删除文本；addParagraph 添加段落（可指定style）；insertTable 插入表格（tableRows、tableColumns、tableData，tableData第一行为表头）；setHeading 设置标题样式（searchText或content，以及style）。
+style取值：Heading1 一级标题/主标题，Heading2 二级标题/章节标题/段落标题，Heading3 三级标题，Normal 正文。"""
+
+# 由 AIResponse 模型生成的响应格式（只生成一次，保证每次请求的内容完全一致）
+COMPACT_RESPONSE_FORMAT: Dict[str, Any] = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "ai_response",
+        "schema": AIResponse.model_json_schema()
+    }
+}
+
+# 提示词统计（累计值，通过 /health 查看）
+prompt_stats = {"requests": 0, "system_chars": 0, "user_chars": 0, "history_chars": 0}
+
+
+def build_messages(
+    user_request: str,
+    document_content: str,
+    document_hash: Optional[str] = None,
+    compact: bool = False,
+    history: Optional[List[Dict[str, str]]] = None
+) -> Tuple[List[Dict[str, str]], Optional[Dict[str, Any]]]:
+    """
+    构建发送给AI API的消息列表和响应格式
+
+    prefix布局（默认）把静态指令放在系统消息中，可变的文档内容和用户需求放在最后；
+    compact为True时改用简短的系统消息，并通过 response_format 要求结构化输出。
+    history 为对话会话的历史消息，放在系统消息之后、当前用户消息之前（系统消息仍可命中前缀缓存）。
+    
+    Returns:
+        (messages, response_format)，response_format 为None表示不指定
+    """
+    history = history or []
+    if not compact and PROMPT_LAYOUT == "legacy":
+        return [
+            {"role": "system", "content": SYSTEM_ROLE_PROMPT},
+            *history,
+            {"role": "user", "content": build_prompt(user_request, document_content, document_hash)}
+        ], None
+    
+    doc_preview = select_context(user_request, document_content, document_hash=document_hash)
+    messages = [
+        {"role": "system", "content": COMPACT_SYSTEM_PROMPT if compact else PREFIX_SYSTEM_PROMPT},
+        *history,
+        {"role": "user", "content": f"当前文档内容：\n{doc_preview}\n\n用户需求：{user_request}"}
+    ]
+    return messages, COMPACT_RESPONSE_FORMAT if compact else None
+
+
 async def call_ai_api_with_progress(
-    prompt: str,
+    messages: List[Dict[str, str]],
     api_key: str,
     api_url: str,
-    model_name: str
+    model_name: str,
+    response_format: Optional[Dict[str, Any]] = None
 ) -> AsyncGenerator[tuple[str, int, int, float], None]:
     """
     调用AI API并流式返回内容
     
-    Yields:
-        (content_chunk, chunk_count, content_length, elapsed_time)
-    """
-    """
-    调用AI API并流式返回内容，支持进度回调
-    
     Args:
-        prompt: 提示词
+        messages: 消息列表（由 build_messages 构建）
         api_key: API密钥
         api_url: API URL
         model_name: 模型名称
-        progress_callback: 进度回调函数 (chunk_count, content_length, elapsed_time)
+        response_format: 结构化输出格式（由 build_messages 返回，None表示不指定）
     
     Yields:
-        内容块字符串
+        (内容块, 已接收块数, 累计内容长度, 已耗时秒数)
     """
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}"
     }
+    # 把请求ID传给上游，便于对照上游的日志
+    request_id = request_id_var.get()
+    if request_id:
+        headers["X-Request-ID"] = request_id
     
     request_body = {
         "model": model_name,
-        "messages": [
-            {
-                "role": "system",
-                "content": "你是一个专业的Word文档编辑助手，能够理解用户需求并生成准确的编辑操作。"
-            },
-            {
-                "role": "user",
-                "content": prompt
-            }
-        ],
+        "messages": messages,
         "temperature": 0.7,
-        "max_tokens": 8000,
+        "max_tokens": AI_MAX_TOKENS,
         "stream": True
     }
+    if response_format is not None:
+        request_body["response_format"] = response_format
     
     logger.info("调用AI API (流式): %s, 模型: %s", api_url, model_name)
     
-    timeout_config = httpx.Timeout(
-        connect=10.0,
-        read=300.0,
-        write=10.0,
-        pool=10.0
-    )
+    # 指标：标签按上游主机区分，每个请求只绑定一次
+    upstream_label = urlsplit(api_url).netloc or api_url
+    outcome: Optional[str] = None
+    request_start = time.monotonic()
+    first_chunk_time: Optional[float] = None
+    connect_started: Optional[float] = None
+    chunk_count = 0
+    content_length = 0
+    # 追踪的阶段用 perf_counter 计时
+    span_start = time.perf_counter()
+    first_chunk_span: Optional[float] = None
+    
+    async def trace(event_name: str, info: Dict[str, Any]) -> None:
+        # 只有新建连接时才会出现connect事件（复用keep-alive连接时没有）
+        nonlocal connect_started
+        if event_name == "connection.connect_tcp.started":
+            connect_started = time.monotonic()
+        elif event_name in ("connection.connect_tcp.complete", "connection.start_tls.complete") and connect_started is not None:
+            if event_name == "connection.start_tls.complete" or not api_url.startswith("https"):
+                connect_seconds = time.monotonic() - connect_started
+                UPSTREAM_CONNECT_SECONDS.labels(upstream_label).observe(connect_seconds)
+                now = time.perf_counter()
+                record_span("upstream_connect", now - connect_seconds, now, upstream=upstream_label)
     
     try:
-        async with httpx.AsyncClient(timeout=timeout_config) as client:
-            async with client.stream("POST", api_url, headers=headers, json=request_body) as response:
-                if response.status_code != 200:
-                    error_text = ""
-                    try:
-                        error_bytes = await response.aread()
-                        error_text = error_bytes.decode('utf-8', errors='ignore')
-                    except Exception:
-                        pass
-                    
-                    error_detail = f"AI API调用失败 (状态码: {response.status_code})"
-                    if error_text:
-                        error_detail += f". 错误信息: {error_text[:500]}"
-                    
-                    raise HTTPException(
-                        status_code=response.status_code,
-                        detail=error_detail
-                    )
+        # 复用共享连接池（keep-alive），避免每次请求重新进行DNS/TCP/TLS握手；请求期间连接池不会被关闭
+        async with upstream_clients.lease(api_url) as client, \
+                client.stream("POST", api_url, headers=headers, json=request_body, extensions={"trace": trace}) as response:
+            UPSTREAM_HEADERS_SECONDS.labels(upstream_label).observe(time.monotonic() - request_start)
+            if response.status_code != 200:
+                error_text = ""
+                try:
+                    error_bytes = await response.aread()
+                    error_text = error_bytes.decode('utf-8', errors='ignore')
+                except Exception:
+                    pass
                 
-                content_parts: List[str] = []
-                chunk_count = 0
-                start_time = time.time()
+                error_detail = f"AI API调用失败 (状态码: {response.status_code})"
+                if error_text:
+                    error_detail += f". 错误信息: {error_text[:500]}"
                 
-                try:
-                    async for line in response.aiter_lines():
-                        if not line.strip():
+                outcome = f"http_{response.status_code}"
+                raise HTTPException(
+                    status_code=response.status_code,
+                    detail=error_detail
+                )
+            
+            content_parts: List[str] = []
+            start_time = time.time()
+            chunk_gap = UPSTREAM_CHUNK_GAP_SECONDS.labels(upstream_label)
+            last_chunk_time = 0.0
+            
+            try:
+                # 直接在字节上切分SSE事件并提取增量内容，不逐行解码字符串、不构建整个数据块对象
+                decoder = SSEDecoder()
+                finished = False
+                async for raw in response.aiter_bytes():
+                    for payload in decoder.feed(raw):
+                        if is_done(payload):
+                            logger.info("[SSE] 收到 [DONE] 标记，流式响应正常结束")
+                            finished = True
+                            break
+                        
+                        try:
+                            chunk_content, finish_reason = extract_delta(payload)
+                        except (ValueError, TypeError, AttributeError, IndexError) as e:
+                            logger.debug("[SSE] 解析数据块失败: %s", e)
                             continue
+                        chunk_count += 1
                         
-                        if line.startswith("data: "):
-                            data_str = line[6:]
-                            
-                            if data_str.strip() == "[DONE]":
-                                logger.info("[SSE] 收到 [DONE] 标记，流式响应正常结束")
-                                break
+                        if finish_reason in ("stop", "length"):
+                            logger.info("[SSE] 收到 finish_reason: %s，流式响应正常结束", finish_reason)
+                            finished = True
+                            break
+                        
+                        if chunk_content:
+                            content_parts.append(chunk_content)
+                            content_length += len(chunk_content)
+                            elapsed_time = time.time() - start_time
+                            now = time.monotonic()
+                            if first_chunk_time is None:
+                                first_chunk_time = now
+                                UPSTREAM_TTFT_SECONDS.labels(upstream_label, model_name).observe(now - request_start)
+                                # 首个token之前：连接、上游排队和处理提示词
+                                first_chunk_span = time.perf_counter()
+                                record_span("upstream_ttft", span_start, first_chunk_span, upstream=upstream_label)
+                            else:
+                                chunk_gap.observe(now - last_chunk_time)
+                            last_chunk_time = now
                             
-                            try:
-                                chunk_data = json.loads(data_str)
-                                chunk_count += 1
-                                
-                                choices = chunk_data.get("choices", [])
-                                if choices and len(choices) > 0:
-                                    choice = choices[0]
-                                    finish_reason = choice.get("finish_reason")
-                                    if finish_reason in ["stop", "length"]:
-                                        logger.info(f"[SSE] 收到 finish_reason: {finish_reason}，流式响应正常结束")
-                                        break
-                                    
-                                    delta = choice.get("delta", {})
-                                    chunk_content = delta.get("content", "")
-                                    if chunk_content:
-                                        content_parts.append(chunk_content)
-                                        current_time = time.time()
-                                        elapsed_time = current_time - start_time
-                                        content_length = sum(len(p) for p in content_parts)
-                                        
-                                        yield (chunk_content, chunk_count, content_length, elapsed_time)
-                            except (json.JSONDecodeError, Exception) as e:
-                                logger.debug(f"[SSE] 解析数据块失败: {e}")
-                                continue
+                            yield (chunk_content, chunk_count, content_length, elapsed_time)
+                    if finished:
+                        break
+            
+            except httpx.RemoteProtocolError as e:
+                # 连接在流式传输过程中被关闭
+                error_msg = str(e)
+                logger.warning("[SSE] 流式传输过程中连接被关闭: %s", error_msg)
+                logger.warning("[SSE] 已接收 %d 个数据块，内容长度: %d 字符", chunk_count, content_length)
                 
-                except httpx.RemoteProtocolError as e:
-                    # 连接在流式传输过程中被关闭
-                    error_msg = str(e)
-                    logger.warning(f"[SSE] 流式传输过程中连接被关闭: {error_msg}")
-                    logger.warning(f"[SSE] 已接收 {chunk_count} 个数据块，内容长度: {sum(len(p) for p in content_parts)} 字符")
-                    
-                    # 如果已经接收到部分内容，记录警告但继续处理
-                    if content_parts:
-                        logger.warning("[SSE] 连接中断但已接收到部分内容，将使用已接收的内容继续处理")
-                    else:
-                        # 如果没有接收到任何内容，抛出异常
-                        logger.error("[SSE] 连接中断且未接收到任何内容")
-                        raise HTTPException(
-                            status_code=503,
-                            detail=f"AI API连接中断: {error_msg} (连接在传输过程中被关闭，可能是服务器端问题或网络中断)"
-                        )
-                except Exception as e:
-                    # 其他流式读取错误
-                    error_msg = str(e)
-                    logger.error(f"[SSE] 流式读取时发生错误: {type(e).__name__}: {error_msg}", exc_info=True)
-                    
-                    # 如果已经接收到部分内容，记录警告但继续处理
-                    if content_parts:
-                        logger.warning(f"[SSE] 读取错误但已接收到部分内容 ({len(content_parts)} 块)，将使用已接收的内容继续处理")
-                    else:
-                        # 如果没有接收到任何内容，抛出异常
-                        logger.error("[SSE] 读取错误且未接收到任何内容")
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"读取AI API流式响应失败: {error_msg}"
-                        )
+                # 如果已经接收到部分内容，由 stream_with_continuation 续写（或使用已接收的内容）
+                if content_parts:
+                    logger.warning("[SSE] 连接中断但已接收到部分内容")
+                    outcome = "truncated"
+                    raise UpstreamTruncated(f"AI API连接中断: {error_msg}")
+                else:
+                    # 如果没有接收到任何内容，抛出异常
+                    logger.error("[SSE] 连接中断且未接收到任何内容")
+                    outcome = "connection_closed"
+                    raise HTTPException(
+                        status_code=503,
+                        detail=f"AI API连接中断: {error_msg} (连接在传输过程中被关闭，可能是服务器端问题或网络中断)"
+                    )
+            except Exception as e:
+                # 其他流式读取错误
+                error_msg = str(e)
+                logger.error("[SSE] 流式读取时发生错误: %s: %s", type(e).__name__, error_msg, exc_info=True)
+                
+                # 如果已经接收到部分内容，由 stream_with_continuation 续写（或使用已接收的内容）
+                if content_parts:
+                    logger.warning("[SSE] 读取错误但已接收到部分内容 (%d 块)", len(content_parts))
+                    outcome = "truncated"
+                    raise UpstreamTruncated(f"读取AI API流式响应失败: {error_msg}")
+                else:
+                    # 如果没有接收到任何内容，抛出异常
+                    logger.error("[SSE] 读取错误且未接收到任何内容")
+                    outcome = "read_error"
+                    raise HTTPException(
+                        status_code=500,
+                        detail=f"读取AI API流式响应失败: {error_msg}"
+                    )
+            
+            # 最终内容已通过yield返回
+            if outcome is None:
+                outcome = "ok"
                 
-                # 最终内容已通过yield返回
-                    
     except httpx.TimeoutException as e:
-        logger.error(f"AI API调用超时: {e}", exc_info=True)
+        logger.error("AI API调用超时: %s", e, exc_info=True)
+        outcome = "timeout"
         raise HTTPException(status_code=504, detail=f"AI API调用超时: {str(e)}")
     except httpx.RequestError as e:
-        logger.error(f"AI API请求错误: {type(e).__name__}: {e}", exc_info=True)
+        logger.error("AI API请求错误: %s: %s", type(e).__name__, e, exc_info=True)
+        outcome = "request_error"
         error_detail = f"AI API请求错误: {str(e)}"
         if "peer closed connection" in str(e) or "incomplete chunked read" in str(e):
             error_detail += " (连接在传输过程中被关闭，可能是服务器端问题或网络中断)"
         raise HTTPException(status_code=503, detail=error_detail)
+    except (HTTPException, UpstreamTruncated):
+        # 上面已经分类好的错误（包括上游返回的非200状态码和流中断）原样抛出
+        raise
     except Exception as e:
-        logger.error(f"AI API调用时发生未知错误: {type(e).__name__}: {e}", exc_info=True)
+        logger.error("AI API调用时发生未知错误: %s: %s", type(e).__name__, e, exc_info=True)
+        outcome = "unknown"
         raise HTTPException(status_code=500, detail=f"AI API调用失败: {str(e)}")
+    finally:
+        # 没有设置结果说明生成器被提前关闭（客户端断开、对冲落败等）
+        UPSTREAM_REQUESTS.labels(upstream_label, model_name, outcome or "cancelled").inc()
+        if first_chunk_span is not None:
+            record_span("upstream_generation", first_chunk_span, time.perf_counter(),
+                        upstream=upstream_label, outcome=outcome or "cancelled", chunks=chunk_count)
+        else:
+            record_span("upstream_ttft", span_start, time.perf_counter(), upstream=upstream_label, outcome=outcome or "cancelled")
+        if outcome in ("ok", "truncated"):
+            end_time = time.monotonic()
+            GENERATION_SECONDS.labels(upstream_label, model_name).observe(end_time - request_start)
+            if first_chunk_time is not None and end_time > first_chunk_time:
+                generation_time = end_time - first_chunk_time
+                GENERATION_CHARS_PER_SECOND.labels(model_name).observe(content_length / generation_time)
+                GENERATION_CHUNKS_PER_SECOND.labels(model_name).observe(chunk_count / generation_time)
 
 
 def parse_ai_response(response_text: str) -> AIResponse:
-    """解析AI响应"""
+    """
+    解析AI响应
+
+    无效的编辑操作被跳过（与增量解析时相同），保留下来的编辑操作带有它在 edits 数组中的原始位置。
+    """
     import json
     import re
     
@@ -378,14 +643,23 @@ def parse_ai_response(response_text: str) -> AIResponse:
         json_match = re.search(r'\{[\s\S]*\}', response_text)
         if json_match:
             parsed = json.loads(json_match.group())
+            edits: List[EditOperation] = []
+            for index, edit in enumerate(parsed.get("edits", [])):
+                if not isinstance(edit, dict):
+                    logger.warning("跳过无效的编辑操作 #%d: 不是对象", index)
+                    continue
+                try:
+                    edits.append(EditOperation(**dict(edit, index=index)))
+                except ValidationError as e:
+                    logger.warning("跳过无效的编辑操作 #%d: %s", index, e)
             return AIResponse(
                 message=parsed.get("message", "操作完成"),
-                edits=[EditOperation(**edit) for edit in parsed.get("edits", [])]
+                edits=edits
             )
         raise ValueError("无法从响应中提取JSON")
     except (json.JSONDecodeError, ValueError) as e:
-        logger.error(f"解析AI响应失败: {e}")
-        logger.error(f"响应内容: {response_text[:500]}")
+        logger.error("解析AI响应失败: %s", e)
+        logger.error("响应内容: %s", response_text[:500])
         raise HTTPException(status_code=500, detail=f"AI响应格式错误: {str(e)}")
 
 
@@ -414,6 +688,9 @@ def get_mock_response(user_request: str) -> AIResponse:
             replaceText="新文本"
         ))
     
+    for index, edit in enumerate(edits):
+        edit.index = index
+    
     message = (
         "已根据您的要求完成编辑操作。"
         if edits
@@ -423,294 +700,714 @@ def get_mock_response(user_request: str) -> AIResponse:
     return AIResponse(message=message, edits=edits)
 
 
-@app.get("/")
-async def root():
+async def serve_asset(request: Request, path: str) -> Optional[Response]:
+    """从静态资源存储返回 dist/ 中的文件（压缩版本、ETag、304），文件不存在时返回None"""
+    assets: AssetStore = request.app.state.assets
+    await assets.ensure_loaded()
+    asset = assets.get(path)
+    if asset is None:
+        assets.miss()
+        return None
+    return assets.respond(
+        asset,
+        accept_encoding=request.headers.get("accept-encoding", ""),
+        if_none_match=request.headers.get("if-none-match", "")
+    )
+
+
+@router.get("/")
+async def root(request: Request):
     """根路径，返回服务信息或前端页面"""
     # 如果dist目录存在且有taskpane.html，返回前端页面
-    taskpane_html = DIST_DIR / "taskpane.html"
-    if taskpane_html.exists():
-        logger.info("[Server] 返回前端页面: taskpane.html")
-        return FileResponse(str(taskpane_html))
-    else:
-        # 否则返回API信息
-        return {
-            "service": "Word AI助手服务",
-            "version": "1.0.0",
-            "status": "running",
-            "note": "前端文件未找到，请先运行 'npm run build' 构建前端代码"
-        }
+    response = await serve_asset(request, "taskpane.html")
+    if response is not None:
+        logger.debug("[Server] 返回前端页面: taskpane.html")
+        return response
+    # 否则返回API信息
+    return {
+        "service": "Word AI助手服务",
+        "version": "1.0.0",
+        "status": "running",
+        "note": "前端文件未找到，请先运行 'npm run build' 构建前端代码"
+    }
 
 
-@app.get("/taskpane.html")
-async def taskpane_html():
+@router.get("/taskpane.html")
+async def taskpane_html(request: Request):
     """返回taskpane.html页面"""
-    taskpane_file = DIST_DIR / "taskpane.html"
-    if taskpane_file.exists():
-        logger.info("[Server] 返回taskpane.html")
-        return FileResponse(str(taskpane_file))
-    else:
-        logger.error("[Server] taskpane.html不存在: %s", taskpane_file)
-        raise HTTPException(status_code=404, detail="taskpane.html not found. Please run 'npm run build' first.")
+    response = await serve_asset(request, "taskpane.html")
+    if response is not None:
+        logger.debug("[Server] 返回taskpane.html")
+        return response
+    logger.error("[Server] taskpane.html不存在: %s", request.app.state.settings.dist_dir / "taskpane.html")
+    raise HTTPException(status_code=404, detail="taskpane.html not found. Please run 'npm run build' first.")
 
 
-@app.get("/commands.html")
-async def commands_html():
+@router.get("/commands.html")
+async def commands_html(request: Request):
     """返回commands.html页面"""
-    commands_file = DIST_DIR / "commands.html"
-    if commands_file.exists():
-        logger.info("[Server] 返回commands.html")
-        return FileResponse(str(commands_file))
-    else:
-        logger.error("[Server] commands.html不存在: %s", commands_file)
-        raise HTTPException(status_code=404, detail="commands.html not found. Please run 'npm run build' first.")
+    response = await serve_asset(request, "commands.html")
+    if response is not None:
+        logger.debug("[Server] 返回commands.html")
+        return response
+    logger.error("[Server] commands.html不存在: %s", request.app.state.settings.dist_dir / "commands.html")
+    raise HTTPException(status_code=404, detail="commands.html not found. Please run 'npm run build' first.")
 
 
-@app.get("/health")
-async def health_check():
+@router.get("/health")
+async def health_check(request: Request):
     """健康检查"""
-    dist_exists = DIST_DIR.exists()
-    taskpane_exists = (DIST_DIR / "taskpane.html").exists() if dist_exists else False
+    assets: AssetStore = request.app.state.assets
+    dist_exists = request.app.state.settings.dist_dir.exists()
+    taskpane_exists = assets.exists("taskpane.html")
+    shared_state = get_shared_state()
     return {
         "status": "healthy",
         "frontend_built": dist_exists,
-        "taskpane_available": taskpane_exists
+        "taskpane_available": taskpane_exists,
+        "upstream": upstream_clients.stats(),
+        "response_cache": response_cache.stats(),
+        "single_flight": single_flight.stats(),
+        "document_sessions": document_sessions.stats(),
+        "conversations": conversations.stats(),
+        "prompt": prompt_stats,
+        "admission": admission.stats(),
+        "router": upstream_router.stats(),
+        "disconnects": disconnect_stats,
+        "batch": batch_stats,
+        "map_reduce": map_reduce_stats,
+        "request_body": body_stats,
+        "anchors": anchor_stats,
+        "continuation": continuation_stats,
+        "tracing": trace_sink.stats(),
+        "logging": log_pipeline.stats(),
+        "static": assets.stats(),
+        "startup": startup_profile.report(),
+        # 多进程模式下除 shared_state 和共享的会话/名额外，其余统计都只是处理本次请求的进程的
+        "worker_pid": os.getpid(),
+        "shared_state": shared_state.stats() if shared_state is not None else {"enabled": False}
     }
 
 
-# 添加静态文件路由（在mount之前，作为显式路由）
-@app.get("/taskpane.js")
-async def serve_taskpane_js():
+# 导出时读取的仪表（准入队列、在途合并调用、日志队列）
+metrics.gauge("admission_active", "Upstream calls currently admitted", callback=lambda: admission.stats()["active"])
+metrics.gauge("admission_queue_depth", "Requests waiting for admission", callback=lambda: admission.stats()["queue_depth"])
+metrics.gauge("single_flight_in_flight", "Coalesced upstream calls in flight", callback=lambda: single_flight.stats()["in_flight"])
+metrics.gauge("log_queue_depth", "Log records waiting for the background writer", callback=lambda: log_pipeline.stats()["queue_depth"])
+
+
+@router.get("/debug/traces")
+async def debug_traces(order: str = "recent", limit: int = 20, request_id: Optional[str] = None):
+    """
+    最近完成的请求追踪（order=recent，最新的在前）或保留的最慢请求（order=slowest）；
+    指定 request_id 时返回该请求的追踪
+    """
+    if request_id:
+        return {"traces": trace_sink.find(request_id)}
+    if order not in ("recent", "slowest"):
+        raise HTTPException(status_code=400, detail="order 只能是 recent 或 slowest")
+    traces = trace_sink.slowest(limit) if order == "slowest" else trace_sink.recent(limit)
+    return {"order": order, "traces": traces, "stats": trace_sink.stats()}
+
+
+@router.get("/metrics")
+async def metrics_endpoint():
+    """Prometheus文本格式的指标"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# 添加静态文件路由（在通配路由之前，作为显式路由）
+@router.get("/taskpane.js")
+async def serve_taskpane_js(request: Request):
     """返回taskpane.js文件"""
-    js_file = DIST_DIR / "taskpane.js"
-    if js_file.exists():
-        logger.debug("[Server] 返回taskpane.js")
-        return FileResponse(str(js_file), media_type="application/javascript")
+    response = await serve_asset(request, "taskpane.js")
+    if response is not None:
+        return response
     raise HTTPException(status_code=404, detail="taskpane.js not found")
 
 
-@app.get("/commands.js")
-async def serve_commands_js():
+@router.get("/commands.js")
+async def serve_commands_js(request: Request):
     """返回commands.js文件"""
-    js_file = DIST_DIR / "commands.js"
-    if js_file.exists():
-        logger.debug("[Server] 返回commands.js")
-        return FileResponse(str(js_file), media_type="application/javascript")
+    response = await serve_asset(request, "commands.js")
+    if response is not None:
+        return response
     raise HTTPException(status_code=404, detail="commands.js not found")
 
 
-async def process_request_stream(request: ProcessRequest) -> AsyncGenerator[str, None]:
+def cached_response_events(response_data: Dict[str, Any], timing: Optional[Dict[str, float]] = None) -> List[bytes]:
+    """把缓存的 AIResponse 按正常流程的事件顺序重放（message、edit、result）"""
+    events = [encode_event({'type': 'message', 'message': response_data.get('message', '')})]
+    for position, edit in enumerate(response_data.get("edits", [])):
+        index = edit.get("index")
+        events.append(encode_event({'type': 'edit', 'index': position if index is None else index, 'data': edit}))
+    result_data = {'type': 'result', 'data': response_data, 'cached': True}
+    if timing is not None:
+        result_data['timing'] = timing
+    events.append(encode_event(result_data))
+    return events
+
+
+def admission_rejected_event(rejection: AdmissionRejected) -> bytes:
+    """准入拒绝的错误事件（带 error_code，客户端可据此区分繁忙和其他错误）"""
+    error_data = {
+        'type': 'error',
+        'status_code': rejection.status_code,
+        'error_code': rejection.reason,
+        'detail': rejection.detail
+    }
+    if rejection.retry_after is not None:
+        error_data['retry_after'] = rejection.retry_after
+    return encode_event(error_data)
+
+
+async def admitted_upstream(
+    api_key: Optional[str],
+    factory: Callable[[], AsyncIterator[Any]]
+) -> AsyncGenerator[Any, None]:
+    """
+    在准入名额内执行一次上游调用：先申请名额（排队期间产出 AdmissionWait），放行后转发 factory() 的数据块
+
+    由实际发起上游调用的一方执行（在途合并的领导者、每个分段、每条批量指令各自的调用），
+    合并到在途调用的请求不占用名额。名额在上游调用结束、出错或被取消时释放。
+    """
+    ticket = admission.submit(api_key)
+    try:
+        queue_start_time = time.monotonic()
+        while not ticket.admitted:
+            queued_time = time.monotonic() - queue_start_time
+            if queued_time >= admission.queue_timeout:
+                admission.expire(ticket)
+                logger.warning("[SSE] 排队超时: %.1f 秒", queued_time)
+                raise AdmissionRejected("queue_timeout", f"排队超时（{admission.queue_timeout:.0f}秒），请稍后重试")
+            yield AdmissionWait(admission.position(ticket), queued_time)
+            await ticket.wait(min(SSE_HEARTBEAT_INTERVAL, admission.queue_timeout - queued_time))
+        if ticket.waited > 0.001:
+            logger.info("[SSE] 排队 %.2f 秒后开始调用上游", ticket.waited)
+            admitted_at = time.perf_counter()
+            record_span("admission_queue", admitted_at - ticket.waited, admitted_at)
+        upstream = factory()
+        try:
+            async for item in upstream:
+                yield item
+        finally:
+            await upstream.aclose()
+    finally:
+        admission.release(ticket)
+
+
+async def process_request_stream(
+    request: ProcessRequest,
+    document_hash: Optional[str] = None,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+) -> AsyncGenerator[bytes, None]:
     """
     流式处理用户请求，通过SSE发送进度更新和最终结果
+    
+    Args:
+        request: 请求（document_content 已解析为完整文档）
+        document_hash: 文档内容的哈希（来自文档会话时已知，否则在此计算）
+        is_disconnected: 检查客户端是否已断开的回调；断开后立即取消上游调用
     """
-    logger.info(f"[SSE] 开始处理请求: {request.user_request[:50]}...")
-    logger.info(f"[SSE] API URL: {request.api_url}, Model: {request.model_name}")
+    logger.info("[SSE] 开始处理请求: %s...", request.user_request[:50])
+    logger.info("[SSE] API URL: %s, Model: %s", request.api_url, request.model_name)
     
-    # 检查API密钥
+    # 未指定api_url且配置了上游池时，通过上游池路由
+    use_pool = upstream_router.enabled and not request.api_url
+    
+    # 检查API密钥（上游池自带密钥时请求可以不传）
     api_key = request.api_key
-    if not api_key or not api_key.strip():
+    if (not api_key or not api_key.strip()) and not (use_pool and upstream_router.has_credentials()):
         logger.warning("[SSE] API密钥未配置，返回模拟响应")
-        mock_response = get_mock_response(request.user_request)
-        result_event = f"data: {json.dumps({'type': 'result', 'data': mock_response.model_dump()})}\n\n"
-        logger.info(f"[SSE] 发送模拟响应事件: {len(result_event)} 字节")
+        mock_response = get_mock_response(request.user_request).model_dump()
+        # 与正常结果相同，附上锚点解析结果
+        mock_response["edits"] = await asyncio.to_thread(
+            annotate_edits, mock_response["edits"], request.document_content, document_hash
+        )
+        result_event = encode_event({'type': 'result', 'data': mock_response})
+        logger.info("[SSE] 发送模拟响应事件: %d 字节", len(result_event))
         yield result_event
         logger.info("[SSE] 模拟响应发送完成")
         return
     
     # 使用请求中的配置
-    api_url = request.api_url or DEFAULT_API_URL
+    api_url = request.api_url or (upstream_router.pool_id if use_pool else DEFAULT_API_URL)
     model_name = request.model_name or DEFAULT_MODEL_NAME
     
+    ai_api_task: Optional[asyncio.Task] = None
+    heartbeat_task: Optional[asyncio.Task] = None
+    disconnect_task: Optional[asyncio.Task] = None
+    anchor_index_task: Optional[asyncio.Task] = None
+    cache_key: Optional[str] = None
+    chunk_received_count = 0
+    abandon_recorded = False
+    
     try:
         # 发送开始事件
         start_event = {'type': 'start', 'message': '开始处理请求...'}
-        start_event_str = f"data: {json.dumps(start_event)}\n\n"
-        logger.info(f"[SSE] 发送开始事件: {start_event_str.strip()}")
-        yield start_event_str
-        logger.info("[SSE] 开始事件已发送")
+        yield encode_event(start_event)
+        logger.debug("[SSE] 开始事件已发送")
+        
+        # 查找响应缓存（相同的需求 + 文档 + 模型 + API地址 + 提示词版本 + API密钥）
+        if document_hash is None:
+            document_hash = hash_document(request.document_content)[0]
+        compact = PROMPT_COMPACT_DEFAULT if request.compact_output is None else request.compact_output
+        prompt_variant = f"{PROMPT_VERSION}:{'compact' if compact else PROMPT_LAYOUT}"
+        # 对话会话：历史在请求开始时取一次快照；只有实际放入提示词的历史才参与缓存键，历史不同的请求不共用缓存
+        # 重试上一轮（需求和文档都相同）时沿用上一轮的历史和指纹，与上一轮命中同一个缓存
+        history: List[Dict[str, str]] = []
+        history_fingerprint = ""
+        if request.conversation_id:
+            conversation = conversations.history(request.conversation_id)
+            history, history_fingerprint = conversation.prompt_history(request.user_request, document_hash)
+            if history_fingerprint:
+                prompt_variant += f":history:{history_fingerprint}"
+        cache_key = make_cache_key(request.user_request, document_hash, model_name, api_url, prompt_variant, api_key)
+        set_trace_attrs(model=model_name, compact=compact, history_messages=len(history))
+        if request.bypass_cache:
+            response_cache.record_bypass()
+            logger.info("[SSE] 请求要求跳过响应缓存")
+        else:
+            with span("cache_lookup"):
+                cached_response = await response_cache.get(cache_key)
+            if cached_response is not None:
+                logger.info("[SSE] 命中响应缓存，直接返回结果")
+                set_trace_attrs(cached=True)
+                if request.conversation_id:
+                    conversations.record(request.conversation_id, request.user_request, cached_response,
+                                         document_hash, history_fingerprint)
+                with span("annotate_anchors"):
+                    cached_response = dict(cached_response, edits=await asyncio.to_thread(
+                        annotate_edits, cached_response.get("edits", []), request.document_content, document_hash
+                    ))
+                for event in cached_response_events(cached_response, timing_summary()):
+                    yield event
+                return
         
         # 构建提示词
         logger.info("[SSE] 构建提示词...")
-        prompt = build_prompt(request.user_request, request.document_content)
-        logger.info(f"[SSE] 提示词长度: {len(prompt)} 字符")
+        # 长文档首次建立索引较耗时，放到线程池中执行，避免阻塞事件循环
+        with span("build_prompt"):
+            messages, response_format = await asyncio.to_thread(
+                build_messages, request.user_request, request.document_content, document_hash, compact, history
+            )
+        system_chars = len(messages[0]["content"])
+        user_chars = len(messages[-1]["content"])
+        history_chars = sum(len(message["content"]) for message in history)
+        prompt_stats["requests"] += 1
+        prompt_stats["system_chars"] += system_chars
+        prompt_stats["user_chars"] += user_chars
+        prompt_stats["history_chars"] += history_chars
+        PROMPT_CHARS.observe(system_chars + user_chars + history_chars)
+        logger.info("[SSE] 提示词: 模式=%s, 系统消息 %d 字符, 历史 %d 条 %d 字符, 用户消息 %d 字符, 总计 %d 字符",
+                    prompt_variant, system_chars, len(history), history_chars, user_chars,
+                    system_chars + history_chars + user_chars)
         
-        # 收集所有内容块
+        # 收集所有内容块（计数器增量维护，避免每次唤醒重新求和）
         content_parts: List[str] = []
-        last_progress_time = time.time()
-        last_heartbeat_time = time.time()
-        chunk_received_count = 0
-        api_call_start_time = time.time()
+        edit_parser = IncrementalEditParser()
+        total_content_length = 0
+        api_call_start_time = time.monotonic()
+        last_progress_time = api_call_start_time
+        last_sent_time = api_call_start_time
         
         logger.info("[SSE] 开始调用AI API...")
         
-        # 使用asyncio来同时处理AI API流和心跳
-        import asyncio
-        
-        # 创建一个队列来接收AI API数据
-        ai_api_queue: asyncio.Queue[Tuple[str, Optional[str], Optional[int], Optional[int], Optional[float]]] = asyncio.Queue()
-        ai_api_done = False
+        # 有界队列：客户端消费慢时生产者会在put处等待，从而对上游读取形成背压
+        relay_queue: asyncio.Queue[Tuple[str, Optional[str], Optional[int], Optional[int], Optional[float]]] = asyncio.Queue(maxsize=SSE_RELAY_QUEUE_SIZE)
         ai_api_error: Optional[Exception] = None
         
         async def ai_api_consumer():
             """消费AI API流式数据"""
-            nonlocal ai_api_done, ai_api_error
+            nonlocal ai_api_error
             try:
-                async for chunk_content, chunk_count, content_length, elapsed_time in call_ai_api_with_progress(prompt, api_key, api_url, model_name):
-                    await ai_api_queue.put(('chunk', chunk_content, chunk_count, content_length, elapsed_time))
-                await ai_api_queue.put(('done', None, None, None, None))
+                def call_upstream(call_messages, call_format):
+                    if use_pool:
+                        return upstream_router.stream(call_ai_api_with_progress, call_messages, api_key, model_name, call_format)
+                    return call_ai_api_with_progress(call_messages, api_key, api_url, model_name, call_format)
+                
+                def start_upstream():
+                    # 准入控制只作用于实际发起的上游调用：排队期间产出排队状态，合并的订阅者一起看到
+                    # 上游流中途断开时自动续写，合并的订阅者看到的是同一个连续的流
+                    return admitted_upstream(
+                        api_key, lambda: stream_with_continuation(call_upstream, messages, response_format)
+                    )
+                
+                if request.bypass_cache:
+                    upstream = start_upstream()
+                else:
+                    # 相同指纹的在途请求共享同一个上游流
+                    upstream = single_flight.stream(cache_key, start_upstream)
+                try:
+                    async for item in upstream:
+                        if isinstance(item, AdmissionWait):
+                            await relay_queue.put(('queued', None, item.position, None, item.waited))
+                            continue
+                        chunk_content, chunk_count, content_length, elapsed_time = item
+                        await relay_queue.put(('chunk', chunk_content, chunk_count, content_length, elapsed_time))
+                finally:
+                    # 被取消时也立即关闭，释放准入名额或退出在途合并
+                    await upstream.aclose()
+                await relay_queue.put(_RELAY_DONE)
             except Exception as e:
                 ai_api_error = e
-                await ai_api_queue.put(('error', None, None, None, None))
+                await relay_queue.put(_RELAY_ERROR)
+        
+        async def heartbeat_ticker():
+            """只在连接空闲达到心跳间隔时唤醒，向队列投递一次心跳"""
+            while True:
+                delay = last_sent_time + SSE_HEARTBEAT_INTERVAL - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+                # 队列已满说明数据正在流动，此时不需要心跳
+                if not relay_queue.full():
+                    relay_queue.put_nowait(_RELAY_HEARTBEAT)
+                await asyncio.sleep(SSE_HEARTBEAT_INTERVAL)
+        
+        async def disconnect_watcher():
+            """客户端断开后取消上游调用，不再为无人接收的响应继续生成"""
+            nonlocal abandon_recorded
+            while True:
+                await asyncio.sleep(SSE_DISCONNECT_POLL_INTERVAL)
+                if ai_api_task.done():
+                    return
+                if await is_disconnected():
+                    break
+            logger.info("[SSE] 客户端已断开，取消AI API调用")
+            # 在取消之前统计：此时本请求仍是上游调用的订阅者之一
+            record_abandoned_stream(request.bypass_cache, cache_key, chunk_received_count)
+            abandon_recorded = True
+            ai_api_task.cancel()
+            await relay_queue.put(_RELAY_DISCONNECTED)
         
-        # 启动AI API消费者任务（保存任务引用，防止被垃圾回收）
+        # 等待上游的同时在线程池中构建文档的锚点索引（按文档哈希缓存），第一个增量编辑操作到达时通常已经就绪
+        if ANCHOR_RESOLUTION != "off" and request.document_content:
+            anchor_index_task = asyncio.create_task(
+                asyncio.to_thread(get_document_anchors, request.document_content, document_hash)
+            )
+        
+        # 启动AI API消费者任务和心跳任务（保存任务引用，防止被垃圾回收）
         ai_api_task = asyncio.create_task(ai_api_consumer())
+        heartbeat_task = asyncio.create_task(heartbeat_ticker())
+        if is_disconnected is not None:
+            disconnect_task = asyncio.create_task(disconnect_watcher())
         
-        # 循环处理：同时等待AI API数据和发送心跳
-        while not ai_api_done:
-            current_time = time.time()
-            elapsed_since_start = current_time - api_call_start_time
+        # 事件驱动：只在有数据、完成、出错或需要心跳时才唤醒
+        while True:
+            event_type, chunk_content, chunk_count, content_length, elapsed_time = await relay_queue.get()
+            
+            if event_type == 'chunk':
+                chunk_received_count += 1
+                total_content_length = content_length
+                content_parts.append(chunk_content)
+                
+                logger.debug("[SSE] 收到内容块 #%d: %d 字符, 累计: %d 字符, 耗时: %.2f 秒", chunk_received_count, len(chunk_content), content_length, elapsed_time, extra=CHUNK)
+                
+                # 增量解析：每个编辑操作一旦完整就立即发送，不必等待整个响应
+                for parsed_type, parsed_payload in edit_parser.feed(chunk_content):
+                    if parsed_type == EVENT_EDIT:
+                        edit_index, edit_dict = parsed_payload
+                        try:
+                            edit = EditOperation(**dict(edit_dict, index=edit_index))
+                        except ValidationError as e:
+                            logger.debug("[SSE] 增量编辑操作校验失败: %s", e)
+                            continue
+                        # 在线程池中解析：索引尚未构建完成时要扫描整个文档，不能阻塞事件循环中的其他流
+                        annotated = await asyncio.to_thread(
+                            annotate_edits, [edit.model_dump()], request.document_content, document_hash, False
+                        )
+                        if not annotated:
+                            continue
+                        partial_data = {
+                            'type': 'edit',
+                            'index': edit_index,
+                            'data': annotated[0]
+                        }
+                    else:
+                        partial_data = {'type': 'message', 'message': parsed_payload}
+                    logger.info("[SSE] 发送增量事件: %s", partial_data['type'], extra=CHUNK)
+                    yield encode_event(partial_data)
+                    last_sent_time = time.monotonic()
+                
+                # 每3秒发送一次进度更新（缩短间隔，更频繁地保持连接活跃）
+                current_time = time.monotonic()
+                if current_time - last_progress_time >= SSE_PROGRESS_INTERVAL:
+                    progress_data = {
+                        'type': 'progress',
+                        'chunk_count': chunk_count,
+                        'content_length': content_length,
+                        'elapsed_time': round(elapsed_time, 2),
+                        'status': 'processing'
+                    }
+                    logger.info("[SSE] 发送进度更新: chunk_count=%d, content_length=%d, elapsed_time=%.2f秒", chunk_count, content_length, elapsed_time, extra=CHUNK)
+                    yield encode_event(progress_data)
+                    last_progress_time = current_time
+                    last_sent_time = current_time
+            
+            elif event_type == 'queued':
+                # 上游调用在等待准入名额（chunk_count 为排队位置，elapsed_time 为已排队的秒数）
+                queued_data = {
+                    'type': 'progress',
+                    'chunk_count': 0,
+                    'content_length': 0,
+                    'elapsed_time': round(elapsed_time, 2),
+                    'status': 'queued',
+                    'queue_position': chunk_count
+                }
+                yield encode_event(queued_data)
+                last_sent_time = time.monotonic()
             
-            # 检查是否需要发送心跳（每10秒一次，确保在60秒超时前有足够的心跳）
-            if current_time - last_heartbeat_time >= 10.0:
+            elif event_type == 'heartbeat':
+                # 心跳（每10秒空闲一次，确保在60秒超时前有足够的心跳）
+                elapsed_since_start = time.monotonic() - api_call_start_time
                 heartbeat_data = {
                     'type': 'progress',
                     'chunk_count': chunk_received_count,
-                    'content_length': sum(len(p) for p in content_parts),
+                    'content_length': total_content_length,
                     'elapsed_time': round(elapsed_since_start, 2),
                     'status': 'waiting' if chunk_received_count == 0 else 'processing'
                 }
-                heartbeat_event_str = f"data: {json.dumps(heartbeat_data)}\n\n"
-                logger.info(f"[SSE] 发送心跳/进度更新: chunk_count={chunk_received_count}, content_length={sum(len(p) for p in content_parts)}, elapsed_time={elapsed_since_start:.2f}秒, status={heartbeat_data['status']}")
-                yield heartbeat_event_str
-                logger.info("[SSE] 心跳/进度更新已发送")
-                last_heartbeat_time = current_time
-                last_progress_time = current_time
+                logger.info("[SSE] 发送心跳/进度更新: chunk_count=%d, content_length=%d, elapsed_time=%.2f秒, status=%s", chunk_received_count, total_content_length, elapsed_since_start, heartbeat_data['status'], extra=HEARTBEAT)
+                yield encode_event(heartbeat_data)
+                last_sent_time = time.monotonic()
             
-            # 尝试从队列获取AI API数据（非阻塞，超时0.5秒）
-            try:
-                event_type, chunk_content, chunk_count, content_length, elapsed_time = await asyncio.wait_for(ai_api_queue.get(), timeout=0.5)
-                
-                if event_type == 'chunk' and chunk_content is not None and chunk_count is not None and content_length is not None and elapsed_time is not None:
-                    chunk_received_count += 1
-                    content_parts.append(chunk_content)
-                    
-                    logger.debug(f"[SSE] 收到内容块 #{chunk_received_count}: {len(chunk_content)} 字符, 累计: {content_length} 字符, 耗时: {elapsed_time:.2f} 秒")
-                    
-                    # 每3秒发送一次进度更新（缩短间隔，更频繁地保持连接活跃）
-                    if current_time - last_progress_time >= 3.0:
-                        progress_data = {
-                            'type': 'progress',
-                            'chunk_count': chunk_count,
-                            'content_length': content_length,
-                            'elapsed_time': round(elapsed_time, 2),
-                            'status': 'processing'
-                        }
-                        progress_event_str = f"data: {json.dumps(progress_data)}\n\n"
-                        logger.info(f"[SSE] 发送进度更新: chunk_count={chunk_count}, content_length={content_length}, elapsed_time={elapsed_time:.2f}秒")
-                        logger.debug(f"[SSE] 进度事件内容: {progress_event_str.strip()}")
-                        yield progress_event_str
-                        logger.info("[SSE] 进度更新已发送")
-                        last_progress_time = current_time
-                        last_heartbeat_time = current_time
-                
-                elif event_type == 'done':
-                    ai_api_done = True
-                    break
-                
-                elif event_type == 'error':
-                    if ai_api_error:
-                        raise ai_api_error
-                    else:
-                        raise Exception("AI API调用出错")
-                        
-            except asyncio.TimeoutError:
-                # 超时是正常的，继续循环等待并发送心跳
-                continue
+            elif event_type == 'done':
+                break
+            
+            elif event_type == 'disconnected':
+                # 清理在 finally 中进行
+                return
+            
+            elif event_type == 'error':
+                if ai_api_error:
+                    raise ai_api_error
+                else:
+                    raise Exception("AI API调用出错")
         
+
         # 确保AI API任务完成（等待任务结束，捕获任何未处理的异常）
         try:
             await ai_api_task
         except Exception as e:
-            logger.error(f"[SSE] AI API任务出错: {e}", exc_info=True)
+            logger.error("[SSE] AI API任务出错: %s", e, exc_info=True)
             if not ai_api_error:
                 raise
         
-        logger.info(f"[SSE] AI API调用完成，共接收 {chunk_received_count} 个内容块")
+        logger.info("[SSE] AI API调用完成，共接收 %d 个内容块", chunk_received_count)
         
         # 合并所有内容
         ai_response_text = "".join(content_parts)
-        logger.info(f"[SSE] 合并内容完成，总长度: {len(ai_response_text)} 字符")
+        logger.info("[SSE] 合并内容完成，总长度: %d 字符", len(ai_response_text))
         
         # 解析响应
-        logger.info("[SSE] 开始解析AI响应...")
+        logger.debug("[SSE] 开始解析AI响应...")
+        parse_start = time.perf_counter()
         ai_response = parse_ai_response(ai_response_text)
-        logger.info(f"[SSE] 解析完成，编辑操作数量: {len(ai_response.edits)}")
+        parse_end = time.perf_counter()
+        PARSE_SECONDS.observe(parse_end - parse_start)
+        record_span("parse_response", parse_start, parse_end, chars=len(ai_response_text))
+        logger.info("[SSE] 解析完成，编辑操作数量: %d", len(ai_response.edits))
+        
+        response_data = ai_response.model_dump()
+        # 缓存未解析锚点的结果（锚点解析按当前配置在发送时进行）
+        await response_cache.put(cache_key, response_data)
+        if request.conversation_id:
+            conversations.record(request.conversation_id, request.user_request, response_data,
+                                 document_hash, history_fingerprint)
         
-        # 发送最终结果
+        # 一次扫描文档解析所有编辑操作的锚点
+        with span("annotate_anchors"):
+            response_data = dict(response_data, edits=await asyncio.to_thread(
+                annotate_edits, response_data["edits"], request.document_content, document_hash
+            ))
+        
+        # 发送最终结果（带上到目前为止的阶段耗时）
         result_data = {
             'type': 'result',
-            'data': ai_response.model_dump()
+            'data': response_data
         }
-        result_event_str = f"data: {json.dumps(result_data)}\n\n"
-        logger.info(f"[SSE] 准备发送最终结果，事件大小: {len(result_event_str)} 字节")
-        logger.debug(f"[SSE] 结果事件内容: {result_event_str[:500]}...")
-        yield result_event_str
+        timing = timing_summary()
+        if timing is not None:
+            result_data['timing'] = timing
+        result_event = encode_event(result_data)
+        logger.info("[SSE] 准备发送最终结果，事件大小: %d 字节", len(result_event))
+        logger.debug("[SSE] 结果事件内容: %s...", result_event[:500].decode("utf-8", errors="ignore"))
+        yield result_event
         logger.info("[SSE] 最终结果已发送")
         
-        logger.info(f"[SSE] 成功处理请求: {request.user_request[:50]}...")
+        logger.info("[SSE] 成功处理请求: %s...", request.user_request[:50])
         
+    except AdmissionRejected as e:
+        logger.warning("[SSE] 上游调用被准入控制拒绝: %s", e.reason)
+        yield admission_rejected_event(e)
     except HTTPException as e:
-        logger.error(f"[SSE] HTTP异常: 状态码={e.status_code}, 详情={e.detail}")
+        logger.error("[SSE] HTTP异常: 状态码=%s, 详情=%s", e.status_code, e.detail)
+        PROCESS_ERRORS.labels(e.status_code).inc()
         error_data = {
             'type': 'error',
             'status_code': e.status_code,
             'detail': e.detail
         }
-        error_event_str = f"data: {json.dumps(error_data)}\n\n"
-        logger.error(f"[SSE] 发送错误事件: {error_event_str.strip()}")
-        yield error_event_str
+        logger.error("[SSE] 发送错误事件: %s", error_data)
+        yield encode_event(error_data)
         logger.error("[SSE] 错误事件已发送")
     except Exception as e:
-        logger.error(f"[SSE] 处理请求时出错: {e}", exc_info=True)
+        logger.error("[SSE] 处理请求时出错: %s", e, exc_info=True)
+        PROCESS_ERRORS.labels(500).inc()
         error_data = {
             'type': 'error',
             'status_code': 500,
             'detail': str(e)
         }
-        error_event_str = f"data: {json.dumps(error_data)}\n\n"
-        logger.error(f"[SSE] 发送错误事件: {error_event_str.strip()}")
-        yield error_event_str
+        logger.error("[SSE] 发送错误事件: %s", error_data)
+        yield encode_event(error_data)
         logger.error("[SSE] 错误事件已发送")
+    finally:
+        # 生成器结束（正常完成、出错或被关闭）时清理后台任务（准入名额随上游调用释放）
+        # 上游仍在生成说明客户端已经离开（服务器关闭了生成器）
+        if not abandon_recorded and ai_api_task is not None and not ai_api_task.done():
+            record_abandoned_stream(request.bypass_cache, cache_key, chunk_received_count)
+        for task in (heartbeat_task, disconnect_task, ai_api_task):
+            if task is not None and not task.done():
+                task.cancel()
+
+
+def record_abandoned_stream(bypass_cache: bool, cache_key: Optional[str], chunk_count: int) -> None:
+    """记录一次客户端提前离开的请求（上游调用被其他合并的请求共享时不会被取消）"""
+    disconnect_stats["cancelled_streams"] += 1
+    if not bypass_cache and cache_key is not None and single_flight.subscribers(cache_key) > 1:
+        logger.info("[SSE] 客户端已离开，上游调用仍有其他订阅者，继续执行")
+        return
+    saved = max(AI_MAX_TOKENS - chunk_count, 0)
+    disconnect_stats["upstream_cancelled"] += 1
+    disconnect_stats["tokens_saved_estimate"] += saved
+    logger.info("[SSE] 客户端已离开，取消上游调用（已接收 %d 块，估算节省最多 %d token）", chunk_count, saved)
+
+
+def resolve_document_session(
+    session_id: str, base_hash: Optional[str], patches: Optional[List[DocumentPatch]]
+) -> Tuple[str, str]:
+    """用会话中的文档和补丁重建完整文档，返回 (文档内容, 文档哈希)"""
+    session = document_sessions.update(session_id, base_hash, patches)
+    logger.info("[API] 使用文档会话: %s (%d 字节)", session.session_id, session.size)
+    return session.content, session.content_hash
+
+
+async def read_request_model(
+    http_request: Request, model: type, hash_field: Optional[str] = None
+) -> Tuple[Any, Optional[Tuple[str, int]]]:
+    """
+    流式读取请求体（支持压缩）并校验为 model，返回 (模型实例, hash_field 字段的 (哈希, 字节数) 或None)
+
+    大请求体不经过 FastAPI 的整体缓冲：边接收边解压、边计算文档哈希，超出上限时立即返回413。
+    哈希在请求体全部接收并解析后才返回，缓存查找不会提前开始，只是不必再对文档算一遍哈希。
+    """
+    body, field_hash = await read_json_body(http_request, hash_field)
+    try:
+        instance = model.model_validate(body)
+    except ValidationError as e:
+        raise RequestValidationError(e.errors())
+    return instance, field_hash
+
 
+def request_id_from(http_request: Request) -> str:
+    """沿用客户端传入的 X-Request-ID，否则生成一个"""
+    return http_request.headers.get("x-request-id", "")[:64] or uuid.uuid4().hex[:12]
 
-@app.post("/api/process")
-async def process_request(request: ProcessRequest):
+
+@router.post("/api/process")
+async def process_request(http_request: Request):
     """
     处理用户请求（SSE流式响应）
     
-    接收前端请求，调用AI API，通过SSE流式返回进度更新和最终结果
+    接收前端请求（ProcessRequest，可以 gzip/zstd 压缩），调用AI API，通过SSE流式返回进度更新和最终结果
     """
-    logger.info("[API] 收到请求: %s...", request.user_request[:50])
-    logger.info("[API] 请求头检查: Content-Type应该为application/json")
-    logger.info("[API] 请求时间: %s", time.time())
+    # 请求ID：沿用客户端传入的 X-Request-ID，否则生成一个；所有日志记录都会带上它
+    request_id = request_id_from(http_request)
+    request_id_var.set(request_id)
+    trace = start_trace(request_id, "/api/process")
+    content_length = http_request.headers.get("content-length")
+    if content_length and content_length.isdigit():
+        REQUEST_BODY_BYTES.observe(int(content_length))
+    try:
+        # 文档哈希在接收请求体的同时算出，响应缓存查找不必再扫描一遍文档
+        with span("read_body", encoding=http_request.headers.get("content-encoding", "identity")):
+            request, body_hash = await read_request_model(http_request, ProcessRequest, "document_content")
+        document_hash = body_hash[0] if body_hash is not None else None
+        logger.info("[API] 收到请求: %s...", request.user_request[:50])
+        
+        # 文档会话：在服务器端用会话中的文档和补丁重建完整文档
+        if request.document_session_id:
+            with span("document_session"):
+                request.document_content, document_hash = resolve_document_session(
+                    request.document_session_id, request.base_hash, request.document_patch
+                )
+        # 对话会话不存在或已过期时直接返回404，客户端可以创建新会话后重试
+        if request.conversation_id:
+            conversations.get(request.conversation_id)
+    except Exception:
+        finish_trace(trace, "rejected")
+        raise
     
     # 创建一个包装函数，确保立即发送响应头
     async def stream_with_immediate_response():
+        # 响应体可能在另一个任务中迭代，这里重新设置请求ID和追踪
+        request_id_var.set(request_id)
+        current_trace.set(trace)
+        bytes_sent = 0
+        status = "cancelled"
+        ACTIVE_STREAMS.inc()
         try:
-            logger.info("[API] StreamingResponse generator开始执行")
+            logger.debug("[API] StreamingResponse generator开始执行")
             # 立即发送一个初始事件，确保响应头被发送
             initial_event = {'type': 'start', 'message': '连接已建立，开始处理...'}
-            initial_event_str = f"data: {json.dumps(initial_event)}\n\n"
-            logger.info(f"[API] 立即发送初始事件: {initial_event_str.strip()}")
-            yield initial_event_str
-            logger.info("[API] 初始事件已发送，响应头应该已经发送到客户端")
+            initial_event_bytes = encode_event(initial_event)
+            logger.debug("[API] 立即发送初始事件: %s", initial_event)
+            bytes_sent += len(initial_event_bytes)
+            yield initial_event_bytes
+            logger.debug("[API] 初始事件已发送，响应头应该已经发送到客户端")
+            
+            # 限流按客户端请求计（分段处理的各部分不再单独计）；并发名额由实际的上游调用占用
+            try:
+                admission.check_rate(request.api_key)
+            except AdmissionRejected as e:
+                logger.warning("[API] 请求被限流: %s", e.detail)
+                status = "rejected"
+                yield admission_rejected_event(e)
+                return
             
             # 然后继续处理请求流
-            async for chunk in process_request_stream(request):
-                yield chunk
+            # （客户端断开时Starlette会取消响应任务，但生成器要等到被回收才关闭，这里显式关闭）
+            if use_map_reduce(request):
+                stream = process_map_reduce_stream(request, document_hash, http_request.is_disconnected)
+            else:
+                stream = process_request_stream(request, document_hash, http_request.is_disconnected)
+            try:
+                async for chunk in stream:
+                    bytes_sent += len(chunk)
+                    if chunk.startswith(_RESULT_EVENT_PREFIX):
+                        status = "ok"
+                    elif chunk.startswith(_ERROR_EVENT_PREFIX):
+                        status = "error"
+                    # yield 挂起的时间就是把事件写给客户端的时间（客户端读得慢时会变长）
+                    send_start = time.perf_counter()
+                    yield chunk
+                    if trace is not None:
+                        trace.accumulate("sse_send", time.perf_counter() - send_start)
+            finally:
+                await stream.aclose()
         except Exception as e:
-            logger.error(f"[API] Stream generator出错: {e}", exc_info=True)
+            logger.error("[API] Stream generator出错: %s", e, exc_info=True)
+            PROCESS_ERRORS.labels(500).inc()
+            status = "error"
             error_event = {'type': 'error', 'status_code': 500, 'detail': str(e)}
-            yield f"data: {json.dumps(error_event)}\n\n"
+            yield encode_event(error_event)
+        finally:
+            ACTIVE_STREAMS.dec()
+            SSE_BYTES.observe(bytes_sent)
+            SSE_BYTES_SENT.inc(bytes_sent)
+            finish_trace(trace, status)
     
     response = StreamingResponse(
         stream_with_immediate_response(),
@@ -721,37 +1418,512 @@ async def process_request(request: ProcessRequest):
             "X-Accel-Buffering": "no",  # 禁用nginx缓冲
             "Access-Control-Allow-Origin": "*",  # CORS支持
             "Access-Control-Allow-Methods": "POST, OPTIONS",
-            "Access-Control-Allow-Headers": "Content-Type"
+            "Access-Control-Allow-Headers": "Content-Type",
+            "Access-Control-Expose-Headers": "X-Document-Hash, X-Request-ID, Server-Timing",
+            "Timing-Allow-Origin": "*",
+            "X-Request-ID": request_id
         }
     )
+    if document_hash:
+        # 客户端用它作为下一次补丁的 base_hash
+        response.headers["X-Document-Hash"] = document_hash
+    if trace is not None:
+        # 响应头在流式响应开始前发送，只包含此前完成的阶段；完整的阶段耗时在 result 事件的 timing 中
+        response.headers["Server-Timing"] = trace.server_timing()
     
-    logger.info("[API] 返回StreamingResponse，媒体类型: text/event-stream")
-    logger.info("[API] 响应头已设置，应该立即发送到客户端")
+    logger.debug("[API] 返回StreamingResponse，媒体类型: text/event-stream")
     return response
 
 
-# 在所有API路由定义之后，挂载静态文件目录
-# 这样可以确保API路由优先匹配，静态文件作为后备
-if DIST_DIR.exists():
-    # 挂载到根路径，这样HTML中的相对路径引用（如taskpane.js）能正常工作
-    # html=True 表示对于目录请求，返回index.html（如果有）
-    app.mount("/", StaticFiles(directory=str(DIST_DIR), html=True), name="static")
-    logger.info("[Server] 已挂载静态文件目录到根路径: %s", DIST_DIR)
-else:
-    logger.warning("[Server] 警告: dist目录不存在，静态文件服务将不可用")
-    logger.warning("[Server] 请先运行 'npm run build' 构建前端代码")
+# 子请求的结果和错误事件（encode_event 输出的对象以 type 字段开头）
+_RESULT_EVENT_PREFIX = encode_event({'type': 'result'})[:-3]
+_ERROR_EVENT_PREFIX = encode_event({'type': 'error'})[:-3]
+_START_EVENT_PREFIX = encode_event({'type': 'start'})[:-3]
 
-# 挂载资源目录（图标等）
-if ASSETS_DIR.exists():
-    app.mount("/assets", StaticFiles(directory=str(ASSETS_DIR)), name="assets")
-    logger.info("[Server] 已挂载资源目录: %s", ASSETS_DIR)
-else:
-    logger.warning("[Server] 警告: assets目录不存在")
 
+async def multiplex_request_streams(
+    jobs: List[Tuple[str, ProcessRequest, Optional[str]]],
+    max_concurrency: int,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+) -> AsyncGenerator[Tuple[str, Optional[bytes]], None]:
+    """
+    并发运行多个 process_request_stream，把各自的事件流合并为一个
 
-if __name__ == "__main__":
+    jobs 为 [(任务ID, 请求, 文档哈希), ...]；每个请求都走完整流程（响应缓存、在途合并、准入控制），
+    同时进行的最多 max_concurrency 个。按到达顺序产出 (任务ID, 事件)，某个任务结束时产出 (任务ID, None)。
+    """
+    relay_queue: asyncio.Queue[Tuple[str, Optional[bytes]]] = asyncio.Queue(maxsize=SSE_RELAY_QUEUE_SIZE)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def run_job(job_id: str, job_request: ProcessRequest, document_hash: Optional[str]) -> None:
+        # 每个任务有自己的上下文，子请求的阶段在追踪中按任务ID分开
+        trace_scope.set(job_id)
+        try:
+            async with semaphore:
+                stream = process_request_stream(job_request, document_hash, is_disconnected)
+                try:
+                    async for event in stream:
+                        await relay_queue.put((job_id, event))
+                finally:
+                    await stream.aclose()
+        except Exception as e:
+            # process_request_stream 自己会把错误转换为 error 事件，这里只兜底
+            logger.error("[SSE] 子请求 %s 出错: %s", job_id, e, exc_info=True)
+            await relay_queue.put((job_id, encode_event({'type': 'error', 'status_code': 500, 'detail': str(e)})))
+        # 被取消时（整个请求结束）不再投递结束标记，避免在无人消费的满队列上等待
+        await relay_queue.put((job_id, None))
+
+    tasks = [asyncio.create_task(run_job(*job)) for job in jobs]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            job_id, event = await relay_queue.get()
+            if event is None:
+                remaining -= 1
+            yield job_id, event
+    finally:
+        # 客户端断开或出错时取消所有子请求（子请求的生成器在各自的任务中关闭，释放准入名额）
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def process_batch_stream(
+    request: BatchProcessRequest,
+    instruction_ids: List[str],
+    document_hash: str,
+    max_concurrency: int,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+) -> AsyncGenerator[bytes, None]:
+    """
+    并发处理批量请求中的每条指令，把各自的事件流合并为一个
+
+    同时进行的最多 max_concurrency 条；事件按到达顺序转发，并带上 instruction_id。
+    """
+    jobs = [
+        (instruction_id, ProcessRequest(
+            user_request=instruction.user_request,
+            document_content=request.document_content,
+            api_key=request.api_key,
+            api_url=request.api_url,
+            model_name=request.model_name,
+            bypass_cache=request.bypass_cache if instruction.bypass_cache is None else instruction.bypass_cache,
+            compact_output=request.compact_output if instruction.compact_output is None else instruction.compact_output
+        ), document_hash)
+        for instruction_id, instruction in zip(instruction_ids, request.instructions)
+    ]
+    outcomes: Dict[str, str] = {}
+    finished: Dict[str, str] = {}
+    # 显式关闭合并流，本生成器被关闭时才会取消仍在进行的子请求
+    stream = multiplex_request_streams(jobs, max_concurrency, is_disconnected)
+    try:
+        async for instruction_id, event in stream:
+            if event is None:
+                finished[instruction_id] = outcomes.get(instruction_id, "failed")
+                batch_stats[finished[instruction_id]] += 1
+                continue
+            if event.startswith(_RESULT_EVENT_PREFIX):
+                outcomes[instruction_id] = "completed"
+            elif event.startswith(_ERROR_EVENT_PREFIX):
+                outcomes[instruction_id] = "failed"
+            yield tag_event(event, 'instruction_id', instruction_id)
+    finally:
+        await stream.aclose()
+    completed = sum(1 for outcome in finished.values() if outcome == "completed")
+    logger.info("[Batch] 批量请求完成: %d 条成功, %d 条失败", completed, len(finished) - completed)
+    complete_data = {
+        'type': 'batch_complete',
+        'completed': completed,
+        'failed': len(finished) - completed,
+        'instructions': {instruction_id: finished.get(instruction_id, "failed") for instruction_id in instruction_ids}
+    }
+    timing = timing_summary()
+    if timing is not None:
+        complete_data['timing'] = timing
+    yield encode_event(complete_data)
+
+
+def use_map_reduce(request: ProcessRequest) -> bool:
+    """是否分段处理：请求中指定时按请求，否则文档超过 MAP_REDUCE_AUTO_CHARS 时自动使用"""
+    if request.map_reduce is not None:
+        return request.map_reduce
+    return MAP_REDUCE_AUTO_CHARS > 0 and len(request.document_content) > MAP_REDUCE_AUTO_CHARS
+
+
+async def process_map_reduce_stream(
+    request: ProcessRequest,
+    document_hash: Optional[str] = None,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None
+) -> AsyncGenerator[bytes, None]:
+    """
+    分段处理：把文档切分为多个部分，并发地对每个部分调用AI API，再合并为一个结果
+
+    每个部分都是一个完整的 process_request_stream（各部分单独缓存，文档只改动一部分时其余部分命中缓存）。
+    各部分的 progress/edit 事件带上 section 转发，部分完成时发送 status 为 section_done 的 progress 事件；
+    单个部分失败不会中断整个请求，最终的 result 事件中 sections 列出各部分的状态，所有部分都失败时发送 error 事件。
+    """
+    with span("split_sections"):
+        sections = await asyncio.to_thread(split_sections, request.document_content)
+    if len(sections) <= 1:
+        # 文档不需要切分，按普通请求处理
+        stream = process_request_stream(request, document_hash, is_disconnected)
+        try:
+            async for event in stream:
+                yield event
+        finally:
+            await stream.aclose()
+        return
+
+    total = len(sections)
+    map_reduce_stats["requests"] += 1
+    map_reduce_stats["sections"] += total
+    logger.info("[MapReduce] 文档 %d 字符，分为 %d 个部分处理", len(request.document_content), total)
+    start_time = time.monotonic()
+    yield encode_event({'type': 'start', 'message': f'文档较长，分为 {total} 个部分并发处理...'})
+    yield encode_event({
+        'type': 'progress',
+        'chunk_count': 0,
+        'content_length': 0,
+        'elapsed_time': 0.0,
+        'status': 'sections',
+        'sections': total,
+        'completed': 0
+    })
+
+    jobs = [
+        (str(index), ProcessRequest(
+            user_request=section_instruction(request.user_request, index, total),
+            document_content=text,
+            api_key=request.api_key,
+            api_url=request.api_url,
+            model_name=request.model_name,
+            bypass_cache=request.bypass_cache,
+            compact_output=request.compact_output
+        ), None)
+        for index, (_, text) in enumerate(sections)
+    ]
+    results: List[Optional[Dict[str, Any]]] = [None] * total
+    errors: Dict[int, Dict[str, Any]] = {}
+    finished = 0
+    stream = multiplex_request_streams(jobs, MAP_REDUCE_MAX_CONCURRENCY, is_disconnected)
+    try:
+        async for job_id, event in stream:
+            index = int(job_id)
+            if event is None:
+                finished += 1
+                if results[index] is None:
+                    map_reduce_stats["failed_sections"] += 1
+                yield encode_event({
+                    'type': 'progress',
+                    'chunk_count': 0,
+                    'content_length': 0,
+                    'elapsed_time': round(time.monotonic() - start_time, 2),
+                    'status': 'section_done',
+                    'section': index,
+                    'section_ok': results[index] is not None,
+                    'sections': total,
+                    'completed': finished
+                })
+                continue
+            if event.startswith(_RESULT_EVENT_PREFIX):
+                results[index] = json.loads(event[6:])['data']
+            elif event.startswith(_ERROR_EVENT_PREFIX):
+                # 单个部分的错误不作为整个请求的 error 事件转发（客户端收到 error 会放弃整个请求）
+                errors[index] = json.loads(event[6:])
+                logger.warning("[MapReduce] 第 %d 部分失败: %s", index + 1, errors[index].get('detail'))
+            elif not event.startswith(_START_EVENT_PREFIX):
+                yield tag_event(event, 'section', index)
+    finally:
+        await stream.aclose()
+
+    if all(result is None for result in results):
+        first_error = next(iter(errors.values()), {'status_code': 500, 'detail': "所有部分都处理失败"})
+        yield encode_event({'type': 'error', 'status_code': first_error.get('status_code', 500), 'detail': first_error.get('detail')})
+        return
+
+    with span("merge_sections"):
+        merged, merge_stats = merge_section_results(sections, results)
+    map_reduce_stats["duplicates"] += merge_stats["duplicates"]
+    map_reduce_stats["conflicts"] += merge_stats["conflicts"]
+    if request.conversation_id:
+        # 各部分不带对话历史（每个部分只看到文档的一部分），合并后的结果作为一轮对话记录
+        conversations.record(request.conversation_id, request.user_request, merged,
+                             document_hash or hash_document(request.document_content)[0])
+    # 锚点按整个文档重新解析（各部分的偏移量只相对于部分本身）
+    with span("annotate_anchors"):
+        merged["edits"] = await asyncio.to_thread(annotate_edits, merged["edits"], request.document_content, document_hash)
+    failed = [index for index, result in enumerate(results) if result is None]
+    logger.info("[MapReduce] 合并完成: %d 个编辑操作（去重 %d，冲突 %d），失败部分 %s，耗时 %.2f 秒",
+                len(merged["edits"]), merge_stats["duplicates"], merge_stats["conflicts"], failed,
+                time.monotonic() - start_time)
+    result_data = {
+        'type': 'result',
+        'data': merged,
+        'sections': {
+            'total': total,
+            'failed': failed,
+            'errors': {str(index): error.get('detail') for index, error in errors.items()},
+            'duplicates': merge_stats["duplicates"],
+            'conflicts': merge_stats["conflicts"]
+        }
+    }
+    timing = timing_summary()
+    if timing is not None:
+        result_data['timing'] = timing
+    yield encode_event(result_data)
+
+
+@router.post("/api/process/batch")
+async def process_batch(http_request: Request):
+    """
+    批量处理（SSE流式响应）
+
+    文档只上传一次，多条指令并发调用AI API，所有事件在同一个SSE流中返回，
+    每个事件带 instruction_id，全部结束后发送 batch_complete 事件。
+    """
+    request_id = request_id_from(http_request)
+    request_id_var.set(request_id)
+    trace = start_trace(request_id, "/api/process/batch")
+    try:
+        with span("read_body", encoding=http_request.headers.get("content-encoding", "identity")):
+            request, body_hash = await read_request_model(http_request, BatchProcessRequest, "document_content")
+        if not request.instructions:
+            raise HTTPException(status_code=400, detail="instructions 不能为空")
+        if len(request.instructions) > BATCH_MAX_INSTRUCTIONS:
+            raise HTTPException(
+                status_code=400, detail=f"一次最多 {BATCH_MAX_INSTRUCTIONS} 条指令，实际 {len(request.instructions)} 条"
+            )
+        instruction_ids = [instruction.id or str(index) for index, instruction in enumerate(request.instructions)]
+        if len(set(instruction_ids)) != len(instruction_ids):
+            raise HTTPException(status_code=400, detail="指令ID不能重复")
+        max_concurrency = min(request.max_concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY)
+        if max_concurrency < 1:
+            raise HTTPException(status_code=400, detail="max_concurrency 必须大于0")
+        logger.info("[Batch] 收到批量请求: %d 条指令, 并发 %d", len(instruction_ids), max_concurrency)
+        set_trace_attrs(instructions=len(instruction_ids), max_concurrency=max_concurrency)
+        content_length = http_request.headers.get("content-length")
+        if content_length and content_length.isdigit():
+            REQUEST_BODY_BYTES.observe(int(content_length))
+
+        # 文档只解析和哈希一次，所有指令共用（提示词中的文档索引也按哈希复用）
+        if request.document_session_id:
+            with span("document_session"):
+                request.document_content, document_hash = resolve_document_session(
+                    request.document_session_id, request.base_hash, request.document_patch
+                )
+        else:
+            document_hash = body_hash[0] if body_hash is not None else hash_document(request.document_content)[0]
+    except Exception:
+        finish_trace(trace, "rejected")
+        raise
+    batch_stats["batches"] += 1
+    batch_stats["instructions"] += len(instruction_ids)
+
+    async def stream_batch():
+        request_id_var.set(request_id)
+        current_trace.set(trace)
+        bytes_sent = 0
+        status = "cancelled"
+        ACTIVE_STREAMS.inc()
+        try:
+            start_event = encode_event({
+                'type': 'batch_start',
+                'instructions': instruction_ids,
+                'max_concurrency': max_concurrency
+            })
+            bytes_sent += len(start_event)
+            yield start_event
+            # 整个批量请求只计一次限流，各条指令的上游调用各自占用并发名额
+            try:
+                admission.check_rate(request.api_key)
+            except AdmissionRejected as e:
+                logger.warning("[Batch] 请求被限流: %s", e.detail)
+                status = "rejected"
+                yield admission_rejected_event(e)
+                return
+            stream = process_batch_stream(request, instruction_ids, document_hash, max_concurrency, http_request.is_disconnected)
+            try:
+                async for chunk in stream:
+                    bytes_sent += len(chunk)
+                    send_start = time.perf_counter()
+                    yield chunk
+                    if trace is not None:
+                        trace.accumulate("sse_send", time.perf_counter() - send_start)
+                status = "ok"
+            finally:
+                await stream.aclose()
+        except Exception as e:
+            logger.error("[Batch] Stream generator出错: %s", e, exc_info=True)
+            PROCESS_ERRORS.labels(500).inc()
+            status = "error"
+            yield encode_event({'type': 'error', 'status_code': 500, 'detail': str(e)})
+        finally:
+            ACTIVE_STREAMS.dec()
+            SSE_BYTES.observe(bytes_sent)
+            SSE_BYTES_SENT.inc(bytes_sent)
+            finish_trace(trace, status)
+
+    response = StreamingResponse(
+        stream_batch(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "Connection": "keep-alive",
+            "X-Accel-Buffering": "no",
+            "Access-Control-Allow-Origin": "*",
+            "Access-Control-Allow-Methods": "POST, OPTIONS",
+            "Access-Control-Allow-Headers": "Content-Type",
+            "Access-Control-Expose-Headers": "X-Document-Hash, X-Request-ID, Server-Timing",
+            "Timing-Allow-Origin": "*",
+            "X-Request-ID": request_id
+        }
+    )
+    if request.document_session_id:
+        response.headers["X-Document-Hash"] = document_hash
+    if trace is not None:
+        response.headers["Server-Timing"] = trace.server_timing()
+    return response
+
+
+@router.post("/api/documents")
+async def register_document(http_request: Request):
+    """注册文档会话（DocumentRegisterRequest，可以压缩），返回会话ID和文档哈希"""
+    request, content_hash = await read_request_model(http_request, DocumentRegisterRequest, "content")
+    session = document_sessions.create(request.content, content_hash)
+    return {
+        "session_id": session.session_id,
+        "content_hash": session.content_hash,
+        "length": len(session.content)
+    }
+
+
+@router.post("/api/documents/{session_id}/patch")
+async def patch_document(session_id: str, request: DocumentUpdateRequest):
+    """对文档会话应用补丁，返回新的文档哈希"""
+    session = document_sessions.update(session_id, request.base_hash, request.patches)
+    return {
+        "session_id": session.session_id,
+        "content_hash": session.content_hash,
+        "length": len(session.content)
+    }
+
+
+@router.delete("/api/documents/{session_id}")
+async def delete_document(session_id: str):
+    """删除文档会话"""
+    if not document_sessions.delete(session_id):
+        raise HTTPException(status_code=404, detail=f"文档会话不存在: {session_id}")
+    return {"deleted": session_id}
+
+
+@router.post("/api/conversations")
+async def create_conversation():
+    """创建对话会话，返回会话ID（之后的 /api/process 请求带上 conversation_id）"""
+    conversation = conversations.create()
+    return {"conversation_id": conversation.conversation_id}
+
+
+@router.get("/api/conversations/{conversation_id}")
+async def get_conversation(conversation_id: str):
+    """查看对话会话：轮次数、摘要、窗口中的最近几轮和历史的token数"""
+    return conversations.get(conversation_id).describe()
+
+
+@router.delete("/api/conversations/{conversation_id}")
+async def delete_conversation(conversation_id: str):
+    """删除对话会话"""
+    if not conversations.delete(conversation_id):
+        raise HTTPException(status_code=404, detail=f"对话会话不存在: {conversation_id}")
+    return {"deleted": conversation_id}
+
+
+# dist/ 中的其他文件（最后注册）
+@router.api_route("/{asset_path:path}", methods=["GET", "HEAD"])
+async def serve_static(request: Request, asset_path: str):
+    """dist/ 中的其他文件；目录请求返回其中的 index.html"""
+    if not asset_path or asset_path.endswith("/"):
+        asset_path += "index.html"
+    response = await serve_asset(request, asset_path)
+    if response is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return response
+
+
+def create_app(settings: Optional[AppSettings] = None) -> FastAPI:
+    """
+    创建应用
+
+    只做创建应用本身需要的工作（日志配置、中间件、路由），各子系统的初始化放到 lifespan 或后台，
+    每一步的耗时记录在 startup_profile 中（/health 的 startup）。
+    """
+    startup_profile.mark_imported()
+    settings = settings or AppSettings()
+
+    if settings.configure_logging:
+        # 日志：调用方只入队，由后台线程写入控制台和按大小/日期轮转的日志文件
+        # 多进程模式下每个进程写自己的日志文件（backend.<pid>.log），避免多个进程同时轮转同一个文件
+        with startup_profile.measure("logging"):
+            log_pipeline.start(settings.log_dir, name=f"backend.{os.getpid()}" if SERVER_WORKERS > 1 else "backend")
+        logger.info("日志文件: %s", log_pipeline.log_file)
+    logger.info("[Server] 前端构建目录: %s", settings.dist_dir)
+    logger.info("[Server] 资源目录: %s", settings.assets_dir)
+    if not settings.dist_dir.exists():
+        logger.warning("[Server] 警告: dist目录不存在，构建前端之前静态文件服务不可用")
+        logger.warning("[Server] 请先运行 'npm run build' 构建前端代码（构建后会自动加载）")
+
+    with startup_profile.measure("app"):
+        # 创建FastAPI应用
+        application = FastAPI(
+            title="Word AI助手服务",
+            description="Word/WPS AI助手插件的完整服务（API + 前端）",
+            version="1.0.0",
+            lifespan=lifespan
+        )
+        application.state.settings = settings
+        default_dist = settings.dist_dir.resolve() == asset_store.directory
+        application.state.assets = asset_store if default_dist else AssetStore(settings.dist_dir)
+
+        # 配置CORS（允许前端跨域请求）
+        application.add_middleware(
+            CORSMiddleware,
+            allow_origins=["*"],  # 生产环境应该指定具体域名
+            allow_credentials=True,
+            allow_methods=["*"],
+            allow_headers=["*"],
+        )
+
+        # 挂载资源目录（图标等）；需要在 router 的静态文件通配路由之前注册
+        if settings.assets_dir.exists():
+            application.mount("/assets", StaticFiles(directory=str(settings.assets_dir)), name="assets")
+        else:
+            logger.warning("[Server] 警告: assets目录不存在")
+        application.include_router(router)
+    return application
+
+
+def __getattr__(name: str) -> Any:
+    """模块属性 app：第一次访问时用默认配置创建（uvicorn main:app、旧的 from main import app）"""
+    if name == "app":
+        application = create_app()
+        globals()["app"] = application
+        return application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def run_server() -> None:
+    """启动服务（python main.py 或 start-server.py）"""
     import uvicorn
     import ssl
+
+    settings = AppSettings()
+    if SERVER_WORKERS > 1:
+        # 多进程模式：主进程监听端口，SERVER_WORKERS 个工作进程共用这个套接字，各自导入 main:app；
+        # 主进程只管理工作进程，同样写自己的日志文件
+        log_pipeline.start(settings.log_dir, name=f"backend.{os.getpid()}")
+        target: Any = "main:app"
+    else:
+        target = create_app(settings)
     
     # 尝试加载HTTPS证书（Office Add-ins要求HTTPS）
     cert_path = Path.home() / ".office-addin-dev-certs" / "localhost.crt"
@@ -774,11 +1946,18 @@ if __name__ == "__main__":
     
     # 启动服务器
     port = 3000
+    server_options: Dict[str, Any] = {"host": "0.0.0.0", "port": port}
+    if SERVER_WORKERS > 1:
+        server_options.update(workers=SERVER_WORKERS, app_dir=str(BACKEND_DIR))
+        logger.info("[Server] 多进程模式: %d 个工作进程，共享状态: %s", SERVER_WORKERS, SHARED_STATE_DB or "无")
     if ssl_context:
         logger.info("[Server] 启动HTTPS服务器: https://localhost:%d", port)
-        uvicorn.run(app, host="0.0.0.0", port=port, ssl_keyfile=str(key_path), ssl_certfile=str(cert_path))
+        uvicorn.run(target, ssl_keyfile=str(key_path), ssl_certfile=str(cert_path), **server_options)
     else:
         logger.info("[Server] 启动HTTP服务器: http://localhost:%d", port)
         logger.warning("[Server] 注意: Office Add-ins要求HTTPS，请配置证书或使用反向代理")
-        uvicorn.run(app, host="0.0.0.0", port=port)
+        uvicorn.run(target, **server_options)
 
+
+if __name__ == "__main__":
+    run_server()
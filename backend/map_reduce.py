@@ -0,0 +1,187 @@
+"""
+大文档的分段处理（map-reduce）
+把文档按段落/标题边界切分为不超过提示词文档预算的部分，每个部分单独调用AI API（由 main 并发执行），
+再把各部分的编辑操作按在原文中的位置合并为一个有序、无冲突的结果。
+总耗时取决于最慢的一个部分，而不是文档长度。
+"""
+import logging
+import os
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+from anchor_index import fold_text, uses_anchor
+from context_selector import DOCUMENT_CONTEXT_BUDGET
+
+logger = logging.getLogger(__name__)
+
+# 分段处理配置（从环境变量读取，如果没有则使用默认值）
+# 每个部分的字符上限；默认等于提示词的文档预算，使每个部分完整地放入提示词
+MAP_REDUCE_SECTION_CHARS = int(os.getenv("MAP_REDUCE_SECTION_CHARS", str(DOCUMENT_CONTEXT_BUDGET)))
+MAP_REDUCE_MAX_CONCURRENCY = int(os.getenv("MAP_REDUCE_MAX_CONCURRENCY", "4"))  # 同时进行的上游调用数
+MAP_REDUCE_MAX_SECTIONS = int(os.getenv("MAP_REDUCE_MAX_SECTIONS", "64"))  # 最多切分的部分数，超出时加大每个部分
+# 请求未指定 map_reduce 时，文档超过这个长度自动分段处理；0表示只在请求中指定时使用
+MAP_REDUCE_AUTO_CHARS = int(os.getenv("MAP_REDUCE_AUTO_CHARS", "0"))
+
+# Word文档的段落分隔符可能是 \r、\n 或 \r\n
+_PARAGRAPH_RE = re.compile(r"[\r\n]+")
+# 标题行：Markdown标题、“第X章/节”、“一、”、“1.2 ” 等编号开头的短行
+_HEADING_RE = re.compile(
+    r"^\s*(#{1,6}\s|第[0-9一二三四五六七八九十百零〇]+[章节部分篇条]|[一二三四五六七八九十]+[、.．]|\d+(\.\d+)*[.、．\s])"
+)
+_HEADING_MAX_CHARS = 40
+
+# 不通过锚点定位的编辑操作在合并时按这些字段去重
+_UNANCHORED_KEY_FIELDS = ("type", "content", "position", "style", "tableRows", "tableColumns", "tableData")
+# 会改变锚点文本的操作：同一锚点只保留第一个
+_DESTRUCTIVE_TYPES = frozenset(("replace", "delete"))
+
+
+def _is_heading(paragraph: str) -> bool:
+    return len(paragraph.strip()) <= _HEADING_MAX_CHARS and bool(_HEADING_RE.match(paragraph))
+
+
+def split_sections(document: str, section_chars: int = MAP_REDUCE_SECTION_CHARS) -> List[Tuple[int, str]]:
+    """
+    按段落切分文档为不超过 section_chars 的部分，尽量在标题处分开
+
+    Returns:
+        [(在原文中的起始位置, 部分文本), ...]，按文档顺序排列；超长段落按固定长度切开
+    """
+    if len(document) > section_chars * MAP_REDUCE_MAX_SECTIONS:
+        section_chars = -(-len(document) // MAP_REDUCE_MAX_SECTIONS)
+    sections: List[Tuple[int, str]] = []
+    current_start = -1
+    current_end = 0
+
+    def close() -> None:
+        nonlocal current_start
+        if current_start >= 0:
+            sections.append((current_start, document[current_start:current_end]))
+            current_start = -1
+
+    pos = 0
+    for sep in _PARAGRAPH_RE.finditer(document + "\n"):
+        para_start, para_end = pos, sep.start()
+        pos = sep.end()
+        paragraph = document[para_start:para_end]
+        if not paragraph.strip():
+            continue
+        if para_end - para_start > section_chars:
+            close()
+            for start in range(para_start, para_end, section_chars):
+                sections.append((start, document[start:min(start + section_chars, para_end)]))
+            continue
+        if current_start >= 0:
+            size = para_end - current_start
+            # 超出上限时分开；遇到标题且当前部分已过半时也在标题前分开，使章节尽量完整
+            if size > section_chars or (_is_heading(paragraph) and current_end - current_start >= section_chars // 2):
+                close()
+        if current_start < 0:
+            current_start = para_start
+        current_end = para_end
+    close()
+    return sections
+
+
+def section_instruction(user_request: str, index: int, total: int) -> str:
+    """分段处理时每个部分的用户需求：说明这只是文档的一部分，只为这一部分生成编辑操作"""
+    return (
+        f"{user_request}\n\n"
+        f"（说明：下面的文档内容是整个文档的第 {index + 1}/{total} 部分。只针对这一部分的内容生成编辑操作，"
+        f"用 searchText 定位要修改的文本；不要在文档开头或末尾插入针对整个文档的内容，除非需求明确要求。）"
+    )
+
+
+def _first_offset(edit: Dict[str, Any], section_start: int, section_text: str) -> int:
+    """编辑操作在原文中的位置：锚点在本部分中第一次出现的位置，找不到时使用部分的起始位置"""
+    offsets = edit.get("anchorOffsets")
+    if offsets:
+        return section_start + offsets[0]
+    if uses_anchor(edit):
+        found = fold_text(section_text).find(fold_text(edit["searchText"]))
+        if found != -1:
+            return section_start + found
+    return section_start
+
+
+def merge_section_results(
+    sections: List[Tuple[int, str]],
+    results: List[Optional[Dict[str, Any]]]
+) -> Tuple[Dict[str, Any], Dict[str, int]]:
+    """
+    合并各部分的 AIResponse（字典；失败的部分为None）
+
+    - 通过锚点定位的编辑操作按锚点在原文中的位置排序；完全相同的操作只保留一个；
+      同一锚点（忽略大小写）的 replace/delete 只保留第一个，其余操作排在它之前
+      （Word 的查找会作用于所有出现位置，先替换再格式化会找不到锚点）
+    - 不通过锚点定位的操作（在开头/末尾插入等）去重后按部分顺序放在最后
+
+    Returns:
+        (合并后的 AIResponse 字典, 合并统计)
+    """
+    anchored: List[Tuple[int, int, int, Dict[str, Any]]] = []
+    unanchored: List[Dict[str, Any]] = []
+    messages: List[str] = []
+    seen_messages = set()
+    seen_unanchored = set()
+    stats = {"edits": 0, "duplicates": 0, "conflicts": 0}
+    sequence = 0
+    for (section_start, section_text), result in zip(sections, results):
+        if result is None:
+            continue
+        message = (result.get("message") or "").strip()
+        if message and message not in seen_messages:
+            seen_messages.add(message)
+            messages.append(message)
+        for edit in result.get("edits", []):
+            stats["edits"] += 1
+            # 锚点统计相对于部分文本，合并后由调用方按整个文档重新解析
+            position = _first_offset(edit, section_start, section_text)
+            # 原始位置只在部分内有意义，合并后的顺序重新排列
+            edit = {key: value for key, value in edit.items() if key not in ("anchorCount", "anchorOffsets", "index")}
+            if uses_anchor(edit):
+                rank = 1 if edit.get("type") in _DESTRUCTIVE_TYPES else 0
+                anchored.append((position, rank, sequence, edit))
+            else:
+                key = repr([edit.get(field) for field in _UNANCHORED_KEY_FIELDS])
+                if key in seen_unanchored:
+                    stats["duplicates"] += 1
+                    continue
+                seen_unanchored.add(key)
+                unanchored.append(edit)
+            sequence += 1
+
+    # 同一锚点的所有操作放在该锚点第一次出现的位置，非破坏性操作在前
+    first_position: Dict[str, int] = {}
+    for position, _, _, edit in anchored:
+        anchor = fold_text(edit["searchText"])
+        first_position[anchor] = min(position, first_position.get(anchor, position))
+    anchored.sort(key=lambda item: (first_position[fold_text(item[3]["searchText"])], item[1], item[0], item[2]))
+
+    edits: List[Dict[str, Any]] = []
+    seen_edits = set()
+    destroyed = set()
+    for _, _, _, edit in anchored:
+        anchor = fold_text(edit["searchText"])
+        key = repr(sorted(edit.items(), key=lambda item: item[0]))
+        if key in seen_edits:
+            stats["duplicates"] += 1
+            continue
+        if edit.get("type") in _DESTRUCTIVE_TYPES:
+            if anchor in destroyed:
+                stats["conflicts"] += 1
+                logger.info("[MapReduce] 丢弃冲突的编辑操作: type=%s, searchText=%s", edit.get("type"), edit["searchText"][:50])
+                continue
+            destroyed.add(anchor)
+        seen_edits.add(key)
+        edits.append(edit)
+    edits.extend(unanchored)
+
+    completed = sum(1 for result in results if result is not None)
+    if not messages:
+        message = "操作完成"
+    elif len(messages) == 1:
+        message = messages[0]
+    else:
+        message = f"已分 {completed} 个部分处理：" + "；".join(messages)
+    return {"message": message, "edits": edits}, stats
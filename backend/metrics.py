@@ -0,0 +1,257 @@
+"""
+进程内指标（计数器、仪表、直方图），以Prometheus文本格式导出
+不依赖 prometheus_client；热路径上每次记录只是一次字典查找和一次二分查找
+"""
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+# 每个指标最多保留的标签组合数，超出后归入 "other"（api_url 等来自请求的标签不能无限增长）
+MAX_SERIES_PER_METRIC = 500
+
+# 常用的直方图分桶
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+GAP_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+RATE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if not self.labelnames:
+            self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """取得（必要时创建）一组标签对应的子指标；请求内多次记录时应先绑定再使用"""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(self._children) >= MAX_SERIES_PER_METRIC:
+                key = ("other",) * len(self.labelnames)
+                child = self._children.get(key)
+            if child is None:
+                child = self._new_child()
+                self._children[key] = child
+        return child
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._children[()].inc(amount)
+
+    def render(self) -> List[str]:
+        # 文本格式0.0.4中，TYPE行的名称需要与样本名（带 _total 后缀）一致
+        name = f"{self.name}_total"
+        lines = [f"# HELP {name} {self.documentation}", f"# TYPE {name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> Iterable[str]:
+        for key, child in self._children.items():
+            yield f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Gauge(_Metric):
+    """可增可减的当前值；给出 callback 时在导出时读取"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount: float = 1.0) -> None:
+        self._children[()].inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self._children[()].dec(amount)
+
+    def set(self, value: float) -> None:
+        self._children[()].set(value)
+
+    def _samples(self) -> Iterable[str]:
+        if self.callback is not None:
+            yield f"{self.name} {_format_value(float(self.callback()))}"
+            return
+        for key, child in self._children.items():
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"
+
+
+class _HistogramChild:
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # 每个桶只计本区间的样本，导出时再累加
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    """固定分桶的直方图"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.bounds = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value: float) -> None:
+        self._children[()].observe(value)
+
+    def _samples(self) -> Iterable[str]:
+        for key, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(self.bounds + (math.inf,), child.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(child.sum)}"
+            yield f"{self.name}_count{labels} {child.count}"
+
+
+class MetricsRegistry:
+    """指标注册表"""
+
+    def __init__(self, prefix: str = ""):
+        self.prefix = prefix
+        self._metrics: List[_Metric] = []
+
+    def _register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(self.prefix + name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+              callback: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(self.prefix + name, documentation, labelnames, callback))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self.prefix + name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Prometheus文本格式（0.0.4）"""
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# 全局注册表
+metrics = MetricsRegistry(prefix="compass_")
+
+# /api/process 各阶段的指标
+REQUEST_BODY_BYTES = metrics.histogram(
+    "request_body_bytes", "Size of /api/process request bodies", buckets=SIZE_BUCKETS)
+PROMPT_CHARS = metrics.histogram(
+    "prompt_chars", "Characters in the prompt built for the upstream call", buckets=SIZE_BUCKETS)
+UPSTREAM_CONNECT_SECONDS = metrics.histogram(
+    "upstream_connect_seconds", "Time to open a new upstream connection (TCP and TLS)", ("upstream",))
+UPSTREAM_HEADERS_SECONDS = metrics.histogram(
+    "upstream_response_headers_seconds", "Time from sending the upstream request to its response headers", ("upstream",))
+UPSTREAM_TTFT_SECONDS = metrics.histogram(
+    "upstream_ttft_seconds", "Time from sending the upstream request to the first content chunk", ("upstream", "model"))
+UPSTREAM_CHUNK_GAP_SECONDS = metrics.histogram(
+    "upstream_chunk_gap_seconds", "Gap between consecutive upstream content chunks", ("upstream",), buckets=GAP_BUCKETS)
+GENERATION_SECONDS = metrics.histogram(
+    "generation_seconds", "Total duration of a completed upstream generation", ("upstream", "model"))
+GENERATION_CHARS_PER_SECOND = metrics.histogram(
+    "generation_chars_per_second", "Characters generated per second after the first token", ("model",), buckets=RATE_BUCKETS)
+GENERATION_CHUNKS_PER_SECOND = metrics.histogram(
+    "generation_chunks_per_second", "Content chunks (about one token each) per second after the first token", ("model",), buckets=RATE_BUCKETS)
+UPSTREAM_REQUESTS = metrics.counter(
+    "upstream_requests", "Upstream calls by upstream, model and outcome", ("upstream", "model", "outcome"))
+PARSE_SECONDS = metrics.histogram(
+    "parse_ai_response_seconds", "Duration of parse_ai_response", buckets=GAP_BUCKETS)
+SSE_BYTES = metrics.histogram(
+    "sse_response_bytes", "SSE bytes sent per /api/process response", buckets=SIZE_BUCKETS)
+SSE_BYTES_SENT = metrics.counter(
+    "sse_bytes_sent", "SSE bytes sent to clients")
+PROCESS_ERRORS = metrics.counter(
+    "process_errors", "Error events sent to /api/process clients by status code", ("status_code",))
+ACTIVE_STREAMS = metrics.gauge(
+    "active_streams", "/api/process SSE responses currently streaming")
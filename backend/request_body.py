@@ -0,0 +1,308 @@
+"""
+流式读取请求体
+按块接收请求体并边收边解压（Content-Encoding: gzip/deflate，安装 zstandard 后支持 zstd），
+同时对JSON中的文档字段计算SHA-256。缓存查找仍在请求体全部接收并解析之后进行，
+节省的只是对文档的第二遍SHA-256计算；
+超出大小上限的请求在接收过程中立即拒绝，而不是缓冲完整个请求体之后。
+"""
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+from fastapi import HTTPException, Request
+
+logger = logging.getLogger(__name__)
+
+# 可选的 zstd 解压（pip install zstandard）；未安装时 zstd 请求体返回415
+if importlib.util.find_spec("zstandard") is not None:
+    import zstandard
+else:
+    zstandard = None
+
+# 可选的 orjson 解析（与 sse_codec 使用同一个JSON后端）
+if importlib.util.find_spec("orjson") is not None:
+    import orjson
+    _loads = orjson.loads
+    _JSON_ERRORS: Tuple[type, ...] = (orjson.JSONDecodeError,)
+else:
+    _loads = json.loads
+    _JSON_ERRORS = (ValueError,)
+
+# 请求体配置（从环境变量读取，如果没有则使用默认值）
+REQUEST_MAX_BODY_BYTES = int(os.getenv("REQUEST_MAX_BODY_BYTES", str(32 * 1024 * 1024)))  # 传输的请求体（压缩后）上限
+REQUEST_MAX_DECODED_BYTES = int(os.getenv("REQUEST_MAX_DECODED_BYTES", str(64 * 1024 * 1024)))  # 解压后的请求体上限
+
+SUPPORTED_ENCODINGS = ("identity", "gzip", "deflate") + (("zstd",) if zstandard is not None else ())
+
+# 请求体统计
+body_stats = {
+    "requests": 0,
+    "encoded": {},          # 按 Content-Encoding 计数
+    "wire_bytes": 0,        # 传输的字节数
+    "decoded_bytes": 0,     # 解压后的字节数
+    "rejected_too_large": 0,
+    "hashed_streaming": 0   # 边接收边算出文档哈希的请求数
+}
+
+
+def _too_large(detail: str) -> HTTPException:
+    body_stats["rejected_too_large"] += 1
+    return HTTPException(status_code=413, detail=detail)
+
+
+class _Decoder:
+    """流式解压器：每次产出的数据都计入解压后的大小上限，超出时立即停止（防止压缩炸弹）"""
+
+    def __init__(self, encoding: str, max_output: int):
+        self.encoding = encoding
+        self.max_output = max_output
+        self.produced = 0
+        self._zlib = None
+        self._zstd = None
+        if encoding == "gzip" or encoding == "deflate":
+            # wbits=47：自动识别 gzip 和 zlib 头
+            self._zlib = zlib.decompressobj(wbits=47)
+        elif encoding == "zstd":
+            self._zstd = zstandard.ZstdDecompressor().decompressobj()
+
+    def _count(self, data: bytes) -> bytes:
+        self.produced += len(data)
+        if self.produced > self.max_output:
+            raise _too_large(f"解压后的请求体超过上限 {self.max_output} 字节")
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        try:
+            if self._zlib is not None:
+                parts = []
+                while data:
+                    # 限制单次输出，超出上限时不必先把整块解压出来
+                    parts.append(self._count(self._zlib.decompress(data, self.max_output - self.produced + 1)))
+                    data = self._zlib.unconsumed_tail
+                return b"".join(parts)
+            if self._zstd is not None:
+                return self._count(self._zstd.decompress(data))
+        except (zlib.error, getattr(zstandard, "ZstdError", zlib.error)) as e:
+            raise HTTPException(status_code=400, detail=f"请求体解压失败（{self.encoding}）: {e}")
+        return self._count(data)
+
+    def finish(self) -> bytes:
+        if self._zlib is not None:
+            tail = self._count(self._zlib.flush())
+            if not self._zlib.eof:
+                raise HTTPException(status_code=400, detail=f"请求体不完整（{self.encoding}）")
+            return tail
+        return b""
+
+
+# JSON结构字符、字符串中的转义和结束引号
+_STRUCTURAL_RE = re.compile(rb'[{}\[\]",:]')
+_STRING_STOP_RE = re.compile(rb'[\\"]')
+_SIMPLE_ESCAPES = {
+    ord('"'): b'"', ord("\\"): b"\\", ord("/"): b"/", ord("b"): b"\b",
+    ord("f"): b"\f", ord("n"): b"\n", ord("r"): b"\r", ord("t"): b"\t"
+}
+
+
+class JsonFieldHasher:
+    """
+    在JSON请求体流过时，对顶层对象中一个字符串字段的值（解码转义后的UTF-8）计算SHA-256
+
+    结果与 document_sessions.hash_document(值) 相同。只跟踪顶层结构：其他字段的字符串直接跳过，
+    目标字段中不含转义的部分直接送入哈希，转义逐个解码；跨块的不完整转义留到下一块。
+    """
+
+    def __init__(self, field: str):
+        self.field = field.encode("utf-8")
+        self._pending = b""
+        self._depth = 0
+        self._expect_key = False
+        self._key: Optional[bytes] = None
+        self._mode = "scan"  # scan、key、skip（跳过字符串）、value（目标字段的值）
+        self._key_parts: list = []
+        self._hash = None
+        self._size = 0
+        self._valid = True
+        self.found = False
+
+    def feed(self, data: bytes) -> None:
+        if not self._valid:
+            return
+        if self._pending:
+            data = self._pending + data
+            self._pending = b""
+        pos = 0
+        length = len(data)
+        while pos < length:
+            if self._mode == "scan":
+                match = _STRUCTURAL_RE.search(data, pos)
+                if match is None:
+                    return
+                pos = match.end()
+                self._structural(data[match.start()])
+            else:
+                pos = self._string(data, pos)
+                if pos < 0:
+                    return
+
+    def _structural(self, ch: int) -> None:
+        if ch in (0x7B, 0x5B):  # { [
+            self._depth += 1
+            self._expect_key = self._depth == 1 and ch == 0x7B
+        elif ch in (0x7D, 0x5D):  # } ]
+            self._depth -= 1
+        elif self._depth != 1:
+            if ch == 0x22:
+                self._mode = "skip"
+        elif ch == 0x2C:  # ,
+            self._expect_key = True
+        elif ch == 0x3A:  # :
+            self._expect_key = False
+        elif ch == 0x22:  # "
+            if self._expect_key:
+                self._mode = "key"
+                self._key_parts = []
+            elif self._key == self.field:
+                # 重复的字段以最后一个为准（与JSON解析一致）
+                self._mode = "value"
+                self._hash = hashlib.sha256()
+                self._size = 0
+                self.found = True
+            else:
+                self._mode = "skip"
+
+    def _string(self, data: bytes, pos: int) -> int:
+        """处理字符串内容，返回下一个位置；数据不足时保存剩余部分并返回-1"""
+        match = _STRING_STOP_RE.search(data, pos)
+        end = match.start() if match is not None else len(data)
+        if end > pos:
+            self._consume(data[pos:end])
+        if match is None:
+            return -1
+        if data[end] == 0x22:
+            if self._mode == "key":
+                self._key = b"".join(self._key_parts)
+            self._mode = "scan"
+            return end + 1
+        # 转义
+        if end + 1 >= len(data):
+            self._pending = data[end:]
+            return -1
+        escape = data[end + 1]
+        if escape != 0x75:  # 不是 \u
+            decoded = _SIMPLE_ESCAPES.get(escape)
+            if decoded is None:
+                self._valid = False
+                return -1
+            self._consume(decoded)
+            return end + 2
+        if self._mode == "skip":
+            return end + 2
+        if end + 6 > len(data):
+            self._pending = data[end:]
+            return -1
+        try:
+            code = int(data[end + 2:end + 6], 16)
+        except ValueError:
+            self._valid = False
+            return -1
+        if 0xD800 <= code < 0xDC00:
+            # 高代理项，后面必须是 \uDC00-\uDFFF 的低代理项
+            if end + 12 > len(data):
+                self._pending = data[end:]
+                return -1
+            low = -1
+            if data[end + 6:end + 8] == b"\\u":
+                try:
+                    low = int(data[end + 8:end + 12], 16)
+                except ValueError:
+                    pass
+            if not 0xDC00 <= low < 0xE000:
+                # 孤立的代理项无法编码为UTF-8，放弃流式哈希，由调用方按解析后的值计算
+                self._valid = False
+                return -1
+            code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+            self._consume(chr(code).encode("utf-8"))
+            return end + 12
+        if 0xDC00 <= code < 0xE000:
+            self._valid = False
+            return -1
+        self._consume(chr(code).encode("utf-8"))
+        return end + 6
+
+    def _consume(self, chunk: bytes) -> None:
+        if self._mode == "value":
+            self._hash.update(chunk)
+            self._size += len(chunk)
+        elif self._mode == "key":
+            self._key_parts.append(chunk)
+
+    def result(self) -> Optional[Tuple[str, int]]:
+        """(十六进制哈希, UTF-8字节数)；没有找到字段、字段不是字符串或遇到无法处理的内容时返回None"""
+        if not self._valid or not self.found or self._mode != "scan" or self._pending:
+            return None
+        return self._hash.hexdigest(), self._size
+
+
+async def read_json_body(
+    request: Request,
+    hash_field: Optional[str] = None,
+    max_bytes: int = REQUEST_MAX_BODY_BYTES,
+    max_decoded: int = REQUEST_MAX_DECODED_BYTES
+) -> Tuple[Dict[str, Any], Optional[Tuple[str, int]]]:
+    """
+    流式读取并解析JSON请求体
+
+    Returns:
+        (解析后的对象, hash_field 字段的 (哈希, 字节数) 或None)
+    """
+    encoding = request.headers.get("content-encoding", "identity").strip().lower() or "identity"
+    if encoding not in SUPPORTED_ENCODINGS:
+        raise HTTPException(
+            status_code=415, detail=f"不支持的 Content-Encoding: {encoding}（支持 {', '.join(SUPPORTED_ENCODINGS)}）"
+        )
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise _too_large(f"请求体过大: {content_length} 字节（上限 {max_bytes} 字节）")
+
+    decoder = _Decoder(encoding, max_decoded)
+    hasher = JsonFieldHasher(hash_field) if hash_field else None
+    parts = []
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > max_bytes:
+            raise _too_large(f"请求体超过上限 {max_bytes} 字节")
+        data = decoder.decompress(chunk)
+        if data:
+            parts.append(data)
+            if hasher is not None:
+                hasher.feed(data)
+    tail = decoder.finish()
+    if tail:
+        parts.append(tail)
+        if hasher is not None:
+            hasher.feed(tail)
+
+    body_stats["requests"] += 1
+    body_stats["encoded"][encoding] = body_stats["encoded"].get(encoding, 0) + 1
+    body_stats["wire_bytes"] += received
+    body_stats["decoded_bytes"] += decoder.produced
+    if encoding != "identity":
+        logger.info("[Body] 请求体 %s: %d -> %d 字节", encoding, received, decoder.produced)
+
+    try:
+        parsed = _loads(b"".join(parts))
+    except _JSON_ERRORS as e:
+        raise HTTPException(status_code=400, detail=f"请求体不是有效的JSON: {e}")
+    if not isinstance(parsed, dict):
+        raise HTTPException(status_code=400, detail="请求体必须是JSON对象")
+    document_hash = hasher.result() if hasher is not None else None
+    if document_hash is not None:
+        body_stats["hashed_streaming"] += 1
+    return parsed, document_hash
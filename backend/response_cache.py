@@ -0,0 +1,218 @@
+"""
+/api/process 的内容寻址响应缓存
+内存LRU（按条目数、字节数和TTL淘汰），可选SQLite持久化层
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from shared_state import SHARED_STATE_DB
+from startup_profile import startup_profile
+
+logger = logging.getLogger(__name__)
+
+# 缓存配置（从环境变量读取，如果没有则使用默认值）
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+# SQLite持久化层路径，留空表示只使用内存缓存；多进程模式下默认使用共享状态数据库，各进程共享缓存结果
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB", "") or SHARED_STATE_DB
+RESPONSE_CACHE_DB_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_DB_MAX_ENTRIES", "10000"))
+
+
+def make_cache_key(
+    user_request: str,
+    document_hash: str,
+    model_name: str,
+    api_url: str,
+    prompt_version: str,
+    api_key: Optional[str] = None
+) -> str:
+    """
+    根据请求内容计算缓存键（文档以其哈希参与计算；各字段带长度前缀，避免拼接歧义）
+
+    API密钥也参与计算（只以摘要的形式），缓存结果和合并的在途请求按密钥隔离：
+    不同密钥的调用方不会共用一次由别人的密钥计费的生成，无效的密钥也拿不到缓存的结果。
+    """
+    digest = hashlib.sha256()
+    for field in (prompt_version, api_url, model_name, user_request, document_hash, api_key or ""):
+        data = field.encode("utf-8")
+        digest.update(len(data).to_bytes(8, "big"))
+        digest.update(data)
+    return digest.hexdigest()
+
+
+class _SQLiteTier:
+    """SQLite持久化层（同步实现，由 ResponseCache 放到线程池中调用）"""
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)"
+        )
+        self._conn.commit()
+        self._puts = 0
+
+    def get(self, key: str, ttl: float) -> Optional[Tuple[str, float]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if time.time() - row[1] > ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._conn.commit()
+                return None
+            return row[0], row[1]
+
+    def put(self, key: str, value: str, created: float) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created) VALUES (?, ?, ?)",
+                (key, value, created)
+            )
+            self._puts += 1
+            # 每写入一定次数清理一次超出上限的最旧条目
+            if self._puts % 100 == 0:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN ("
+                    "SELECT key FROM responses ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                    (self.max_entries,)
+                )
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """缓存最终的 AIResponse（以JSON字符串保存，便于统计占用字节数）"""
+
+    def __init__(
+        self,
+        max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        db_path: str = RESPONSE_CACHE_DB,
+        enabled: bool = RESPONSE_CACHE_ENABLED
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.enabled = enabled
+        # key -> (JSON字符串, 写入时间)
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        # SQLite持久化层在第一次查找或写入时才打开，创建缓存对象本身不访问文件系统
+        self._db_path = db_path if enabled else ""
+        self._disk: Optional[_SQLiteTier] = None
+        self._disk_opened = False
+
+    def _disk_tier(self) -> Optional[_SQLiteTier]:
+        if not self._disk_opened:
+            self._disk_opened = True
+            if self._db_path:
+                try:
+                    with startup_profile.measure("response_cache_db", phase="lazy"):
+                        self._disk = _SQLiteTier(self._db_path, RESPONSE_CACHE_DB_MAX_ENTRIES)
+                    logger.info("[Cache] 已启用SQLite持久化缓存: %s", self._db_path)
+                except sqlite3.Error as e:
+                    logger.warning("[Cache] 无法打开SQLite缓存 %s: %s，仅使用内存缓存", self._db_path, e)
+        return self._disk
+
+    def _store(self, key: str, value: str, created: float) -> None:
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[0])
+        self._entries[key] = (value, created)
+        self._bytes += len(value)
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查找缓存，命中返回 AIResponse 字典"""
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is not None:
+            if time.time() - entry[1] <= self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(entry[0])
+            self._bytes -= len(entry[0])
+            del self._entries[key]
+        disk = self._disk_tier()
+        if disk is not None:
+            try:
+                row = await asyncio.to_thread(disk.get, key, self.ttl)
+            except sqlite3.Error as e:
+                logger.warning("[Cache] 读取SQLite缓存失败: %s", e)
+                row = None
+            if row is not None:
+                self._store(key, row[0], row[1])
+                self.hits += 1
+                self.disk_hits += 1
+                return json.loads(row[0])
+        self.misses += 1
+        return None
+
+    async def put(self, key: str, response: Dict[str, Any]) -> None:
+        """写入缓存"""
+        if not self.enabled:
+            return
+        value = json.dumps(response, ensure_ascii=False)
+        created = time.time()
+        self._store(key, value, created)
+        disk = self._disk_tier()
+        if disk is not None:
+            try:
+                await asyncio.to_thread(disk.put, key, value, created)
+            except sqlite3.Error as e:
+                logger.warning("[Cache] 写入SQLite缓存失败: %s", e)
+
+    def record_bypass(self) -> None:
+        self.bypassed += 1
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "persistent": bool(self._db_path) and (self._disk is not None or not self._disk_opened)
+        }
+
+    def close(self) -> None:
+        if self._disk is not None:
+            self._disk.close()
+            self._disk = None
+
+
+# 全局缓存实例
+response_cache = ResponseCache()
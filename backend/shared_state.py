@@ -0,0 +1,246 @@
+"""
+多进程共享状态
+多个工作进程（uvicorn --workers）共用一个SQLite数据库文件（WAL模式），保存需要跨进程一致的状态：
+按API密钥的令牌桶、准入并发名额（按进程记账，进程退出后自动回收）、文档会话和对话会话；
+响应缓存的SQLite持久化层默认也使用这个文件。未配置时各模块使用进程内状态。
+数据库在第一次 get_shared_state() 时才打开（应用启动时由 lifespan 打开），导入本模块没有副作用，
+多进程模式下的主进程（只负责启动工作进程）也不会打开数据库。
+"""
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from startup_profile import startup_profile
+
+logger = logging.getLogger(__name__)
+
+# 多进程配置（从环境变量读取，如果没有则使用默认值）
+SERVER_WORKERS = max(1, int(os.getenv("SERVER_WORKERS", "1")))  # 工作进程数，大于1时启用共享状态
+# 共享状态数据库路径；多进程模式下未配置时使用 backend/data/shared_state.db
+SHARED_STATE_DB = os.getenv("SHARED_STATE_DB", "") or (
+    str(Path(__file__).resolve().parent / "data" / "shared_state.db") if SERVER_WORKERS > 1 else ""
+)
+SHARED_STATE_BUSY_TIMEOUT = float(os.getenv("SHARED_STATE_BUSY_TIMEOUT", "1.0"))  # 等待其他进程释放写锁的最长时间（秒）
+SHARED_STATE_POLL_INTERVAL = float(os.getenv("SHARED_STATE_POLL_INTERVAL", "0.1"))  # 排队请求检查其他进程释放名额的间隔（秒）
+
+# 清理已退出进程的名额、过期令牌桶的最小间隔（秒）
+_CLEANUP_INTERVAL = 10.0
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS workers (pid INTEGER PRIMARY KEY, started REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS slots ("
+    "name TEXT NOT NULL, pid INTEGER NOT NULL, count INTEGER NOT NULL, PRIMARY KEY (name, pid))",
+    "CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS documents ("
+    "session_id TEXT PRIMARY KEY, content TEXT NOT NULL, content_hash TEXT NOT NULL, "
+    "size INTEGER NOT NULL, last_access REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS documents_last_access ON documents (last_access)",
+    "CREATE TABLE IF NOT EXISTS conversations ("
+    "conversation_id TEXT PRIMARY KEY, state TEXT NOT NULL, version INTEGER NOT NULL, last_access REAL NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS conversations_last_access ON conversations (last_access)"
+)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class SharedState:
+    """
+    SQLite共享状态（同步实现）
+
+    每个事务都很小（几行读写），在事件循环中直接调用；写事务使用 BEGIN IMMEDIATE，
+    其他进程持有写锁时最多等待 busy_timeout 秒，超时抛出 sqlite3.Error，由调用方回退到进程内的判断。
+    """
+
+    def __init__(self, path: str, busy_timeout: float = SHARED_STATE_BUSY_TIMEOUT):
+        self.path = path
+        self.pid = os.getpid()
+        self._lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self.errors = 0
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # isolation_level=None：由这里显式控制事务
+        self._conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self.transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def register(self) -> None:
+        """登记当前工作进程（应用启动时调用），并回收已退出进程的名额"""
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO workers (pid, started) VALUES (?, ?)", (self.pid, time.time()))
+        self.cleanup(force=True)
+
+    class _Transaction:
+        def __init__(self, state: "SharedState"):
+            self.state = state
+
+        def __enter__(self) -> sqlite3.Connection:
+            self.state._lock.acquire()
+            try:
+                self.state._conn.execute("BEGIN IMMEDIATE")
+            except BaseException:
+                self.state._lock.release()
+                raise
+            return self.state._conn
+
+        def __exit__(self, exc_type, exc, tb) -> None:
+            try:
+                self.state._conn.execute("COMMIT" if exc_type is None else "ROLLBACK")
+            finally:
+                self.state._lock.release()
+            if exc_type is not None and issubclass(exc_type, sqlite3.Error):
+                self.state.errors += 1
+
+    def transaction(self) -> "SharedState._Transaction":
+        """写事务：with shared_state.transaction() as conn: ...（出错时回滚）"""
+        return SharedState._Transaction(self)
+
+    def read(self, sql: str, params: Sequence = ()) -> List[Tuple]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def cleanup(self, force: bool = False) -> None:
+        """回收已退出进程占用的名额"""
+        now = time.monotonic()
+        if not force and now - self._last_cleanup < _CLEANUP_INTERVAL:
+            return
+        self._last_cleanup = now
+        try:
+            pids = [row[0] for row in self.read("SELECT pid FROM workers UNION SELECT pid FROM slots")]
+            dead = [pid for pid in pids if pid != self.pid and not _pid_alive(pid)]
+            with self.transaction() as conn:
+                for pid in dead:
+                    conn.execute("DELETE FROM slots WHERE pid = ?", (pid,))
+                    conn.execute("DELETE FROM workers WHERE pid = ?", (pid,))
+                conn.execute("DELETE FROM slots WHERE count <= 0")
+            if dead:
+                logger.info("[Shared] 回收已退出进程的准入名额: %s", dead)
+        except sqlite3.Error as e:
+            logger.warning("[Shared] 清理共享状态失败: %s", e)
+
+    # ---- 准入名额 ----
+
+    def slot_counts(self, names: Sequence[str]) -> Dict[str, int]:
+        """所有进程占用的名额数"""
+        placeholders = ",".join("?" * len(names))
+        rows = self.read(f"SELECT name, SUM(count) FROM slots WHERE name IN ({placeholders}) GROUP BY name", names)
+        return {name: int(total) for name, total in rows}
+
+    def try_acquire(self, limits: Sequence[Tuple[str, int]]) -> bool:
+        """原子地为每个 (名额, 上限) 各占用一个名额；任一名额已满时不占用任何名额并返回False"""
+        with self.transaction() as conn:
+            for name, limit in limits:
+                row = conn.execute("SELECT COALESCE(SUM(count), 0) FROM slots WHERE name = ?", (name,)).fetchone()
+                if row[0] >= limit:
+                    return False
+            for name, _ in limits:
+                conn.execute(
+                    "INSERT INTO slots (name, pid, count) VALUES (?, ?, 1) "
+                    "ON CONFLICT (name, pid) DO UPDATE SET count = count + 1",
+                    (name, self.pid)
+                )
+        return True
+
+    def release(self, names: Sequence[str]) -> None:
+        with self.transaction() as conn:
+            for name in names:
+                conn.execute("UPDATE slots SET count = count - 1 WHERE name = ? AND pid = ?", (name, self.pid))
+
+    # ---- 令牌桶 ----
+
+    def take_token(self, key: str, rate: float, capacity: float) -> Optional[float]:
+        """从共享令牌桶取一个令牌；成功返回None，令牌不足时返回需要等待的秒数"""
+        now = time.time()
+        with self.transaction() as conn:
+            row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+            tokens = capacity if row is None else min(capacity, row[0] + max(0.0, now - row[1]) * rate)
+            if tokens < 1:
+                return (1 - tokens) / rate
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", (key, tokens - 1, now)
+            )
+            # 已经回满的桶和不存在的桶等价，顺带删除
+            conn.execute("DELETE FROM buckets WHERE updated < ?", (now - capacity / rate,))
+        return None
+
+    def worker_pids(self) -> List[int]:
+        return [row[0] for row in self.read("SELECT pid FROM workers ORDER BY pid")]
+
+    def stats(self) -> Dict:
+        try:
+            workers = self.worker_pids()
+            slots = dict(self.read("SELECT pid, SUM(count) FROM slots WHERE name = 'global' GROUP BY pid"))
+        except sqlite3.Error as e:
+            return {"enabled": True, "path": self.path, "pid": self.pid, "error": str(e)}
+        return {
+            "enabled": True,
+            "path": self.path,
+            "pid": self.pid,
+            "workers": workers,
+            "active_by_worker": {str(pid): int(count) for pid, count in slots.items()},
+            "errors": self.errors
+        }
+
+    def close(self) -> None:
+        """注销当前进程并释放它占用的名额（应用关闭时调用）"""
+        with self._lock:
+            try:
+                self._conn.execute("DELETE FROM slots WHERE pid = ?", (self.pid,))
+                self._conn.execute("DELETE FROM workers WHERE pid = ?", (self.pid,))
+            except sqlite3.Error:
+                pass
+            self._conn.close()
+
+
+def _open(path: str) -> Optional[SharedState]:
+    if not path:
+        return None
+    try:
+        with startup_profile.measure("shared_state_db"):
+            state = SharedState(path)
+        logger.info("[Shared] 已启用共享状态: %s (进程 %d)", path, state.pid)
+        return state
+    except sqlite3.Error as e:
+        logger.warning("[Shared] 无法打开共享状态 %s: %s，使用进程内状态", path, e)
+        return None
+
+
+# 全局实例：第一次使用时打开（未启用或打开失败时为None）
+_shared_state: Optional[SharedState] = None
+_opened = False
+_open_lock = threading.Lock()
+
+
+def get_shared_state() -> Optional[SharedState]:
+    """获取当前进程的共享状态（必要时打开数据库），未启用时返回None"""
+    global _shared_state, _opened
+    if not _opened:
+        with _open_lock:
+            if not _opened:
+                _shared_state = _open(SHARED_STATE_DB)
+                _opened = True
+    return _shared_state
+
+
+def close_shared_state() -> None:
+    """关闭共享状态（应用关闭时调用），之后再次使用时重新打开"""
+    global _shared_state, _opened
+    with _open_lock:
+        if _shared_state is not None:
+            _shared_state.close()
+        _shared_state = None
+        _opened = False
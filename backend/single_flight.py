@@ -0,0 +1,128 @@
+"""
+相同请求的在途合并（single-flight）
+第一个请求驱动上游调用，之后到达的相同请求作为订阅者复用同一个数据块流；
+订阅者的追踪中记录一个 coalesced 阶段，标明所等待的领导者请求
+"""
+import asyncio
+import logging
+import time
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Dict, List, Optional
+
+from tracing import current_trace, record_span, set_trace_attrs
+
+logger = logging.getLogger(__name__)
+
+
+class _Flight:
+    """一次在途的上游调用"""
+
+    def __init__(self, leader_id: Optional[str]):
+        # 发起上游调用的请求的追踪ID（request_id），订阅者的追踪据此关联到领导者
+        self.leader_id = leader_id
+        # 已产出的全部数据块（后加入的订阅者从头重放）
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._waiters: List[asyncio.Future] = []
+
+    def wait(self) -> asyncio.Future:
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        return waiter
+
+    def notify(self) -> None:
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+
+class SingleFlight:
+    """按请求指纹合并在途的上游流式调用"""
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def _drive(self, key: str, flight: _Flight, factory: Callable[[], AsyncIterator[Any]]) -> None:
+        try:
+            async for item in factory():
+                flight.items.append(item)
+                flight.notify()
+        except asyncio.CancelledError:
+            flight.error = asyncio.CancelledError()
+            raise
+        except BaseException as e:
+            flight.error = e
+        finally:
+            flight.done = True
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.notify()
+
+    async def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]]) -> AsyncGenerator[Any, None]:
+        """
+        订阅 key 对应的上游流；没有在途调用时用 factory() 发起一个
+
+        上游调用在独立任务中执行，不依赖于发起它的请求；
+        所有订阅者都离开后才会取消上游调用。
+        合并进来的请求自己不产生上游阶段，它的追踪中记录一个 coalesced 阶段（从加入到流结束），
+        带上领导者的 request_id，可以在 /debug/traces 中找到实际的上游耗时。
+        """
+        flight = self._flights.get(key)
+        joined_at = None
+        if flight is None:
+            trace = current_trace.get()
+            flight = _Flight(trace.request_id if trace is not None else None)
+            self._flights[key] = flight
+            flight.task = asyncio.create_task(self._drive(key, flight, factory))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+            joined_at = time.perf_counter()
+            set_trace_attrs(coalesced_with=flight.leader_id)
+            logger.info("[SingleFlight] 合并到在途请求 %s，当前订阅者: %d", flight.leader_id, flight.subscribers + 1)
+
+        flight.subscribers += 1
+        index = 0
+        try:
+            while True:
+                if index < len(flight.items):
+                    item = flight.items[index]
+                    index += 1
+                    yield item
+                    continue
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.wait()
+        finally:
+            if joined_at is not None:
+                record_span("coalesced", joined_at, time.perf_counter(), leader=flight.leader_id)
+            flight.subscribers -= 1
+            if flight.subscribers == 0 and not flight.done and flight.task is not None:
+                logger.info("[SingleFlight] 所有订阅者已离开，取消上游调用")
+                # 立即移除，避免新请求合并到一个正在取消的调用上
+                if self._flights.get(key) is flight:
+                    del self._flights[key]
+                flight.task.cancel()
+
+    def subscribers(self, key: str) -> int:
+        """key 对应的在途调用当前的订阅者数量"""
+        flight = self._flights.get(key)
+        return flight.subscribers if flight is not None else 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced
+        }
+
+
+# 全局实例
+single_flight = SingleFlight()
@@ -0,0 +1,101 @@
+"""
+SSE字节流编解码
+直接在上游响应的字节上切分SSE事件，并从OpenAI兼容的数据块中取出
+choices[0].delta.content 和 finish_reason；发往客户端的事件同样直接编码为字节。
+安装了 orjson 时用它作为JSON后端，否则使用标准库 json。
+"""
+import importlib.util
+import json
+from typing import Any, List, Optional, Tuple
+
+# 可选的快速JSON后端（pip install orjson）
+if importlib.util.find_spec("orjson") is not None:
+    import orjson
+
+    json_loads = orjson.loads
+
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj)
+else:
+    orjson = None
+    json_loads = json.loads
+
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+JSON_BACKEND = "orjson" if orjson is not None else "json"
+
+_DATA_PREFIX = b"data:"
+_DONE = b"[DONE]"
+
+
+def encode_event(data: Any) -> bytes:
+    """把一个事件编码为SSE的 data 帧"""
+    return b"data: " + _dumps(data) + b"\n\n"
+
+
+_EVENT_OBJECT_PREFIX = b"data: {"
+
+
+def tag_event(event: bytes, key: str, value: Any) -> bytes:
+    """
+    在 encode_event 编码的事件（JSON对象）开头插入一个字段，不重新解析和编码整个事件
+
+    批量请求用它给每个子请求的事件加上 instruction_id；不是对象的事件原样返回。
+    """
+    if not event.startswith(_EVENT_OBJECT_PREFIX):
+        return event
+    field = _dumps(key) + b":" + _dumps(value)
+    rest = event[len(_EVENT_OBJECT_PREFIX):]
+    separator = b"" if rest.startswith(b"}") else b","
+    return _EVENT_OBJECT_PREFIX + field + separator + rest
+
+
+class SSEDecoder:
+    """
+    把任意切分的字节块重新组帧为SSE的 data 负载
+
+    只处理单行 data 字段（OpenAI兼容接口每个事件只有一行 data），忽略注释、event、id 等字段；
+    负载以 bytes 返回，不做字符串解码。
+    """
+
+    def __init__(self):
+        self._pending = b""
+
+    def feed(self, chunk: bytes) -> List[bytes]:
+        """消费一个字节块，返回其中完整的 data 负载"""
+        if self._pending:
+            chunk = self._pending + chunk
+        # 按行切分在C层完成；最后一段可能是不完整的行，留到下一次
+        lines = chunk.split(b"\n")
+        self._pending = lines.pop()
+        payloads: List[bytes] = []
+        for line in lines:
+            if line[:5] != _DATA_PREFIX:
+                continue
+            if line[-1:] == b"\r":
+                line = line[:-1]
+            payloads.append(line[6:] if line[5:6] == b" " else line[5:])
+        return payloads
+
+
+def is_done(payload: bytes) -> bool:
+    return payload.strip() == _DONE
+
+
+def extract_delta(payload: bytes) -> Tuple[Optional[str], Optional[str]]:
+    """
+    从一个 chat.completion.chunk 负载中取出 (delta.content, finish_reason)
+
+    只看第一个choice（请求不设置 n，流中只有一个choice）。
+    负载不是合法JSON时抛出 ValueError。
+    """
+    chunk = json_loads(payload)
+    if not isinstance(chunk, dict):
+        return None, None
+    choices = chunk.get("choices") or []
+    if not choices:
+        return None, None
+    choice = choices[0]
+    delta = choice.get("delta") or {}
+    return delta.get("content") or None, choice.get("finish_reason")
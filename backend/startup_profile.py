@@ -0,0 +1,107 @@
+"""
+启动耗时记录
+记录导入阶段和各子系统初始化的耗时，启动完成后写入日志，并在 /health 的 startup 中返回；
+bench/startup_bench.py 用同一份报告检查冷启动预算。
+"""
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# 冷启动预算（秒）：从进程启动到可以处理请求，超出时记录警告
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "2.0"))
+
+
+def _process_uptime() -> Optional[float]:
+    """进程已运行的时间（Linux 读取 /proc，其他平台返回None）"""
+    try:
+        with open("/proc/self/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            system_uptime = float(f.read().split()[0])
+        return system_uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError, AttributeError):
+        return None
+
+
+class StartupProfile:
+    """按组件记录启动耗时；后台初始化的组件在完成时补记"""
+
+    def __init__(self, budget: float = STARTUP_BUDGET_SECONDS):
+        self.budget = budget
+        self._origin = time.perf_counter()
+        # 本模块被导入之前进程已经运行的时间（解释器启动和更早的导入）
+        self._before_origin = _process_uptime()
+        self._lock = threading.Lock()
+        self._components: List[Dict[str, Any]] = []
+        self.ready_at: Optional[float] = None
+        self._imported = False
+
+    def _elapsed(self) -> float:
+        return time.perf_counter() - self._origin
+
+    def record(self, component: str, phase: str, seconds: float, error: Optional[str] = None) -> None:
+        entry = {"component": component, "phase": phase, "ms": round(seconds * 1000, 2)}
+        if error:
+            entry["error"] = error
+        with self._lock:
+            self._components.append(entry)
+
+    @contextmanager
+    def measure(self, component: str, phase: str = "init") -> Iterator[None]:
+        """with startup_profile.measure("组件"): ... 记录这段代码的耗时（出错时也记录）"""
+        start = time.perf_counter()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.record(component, phase, time.perf_counter() - start, error)
+
+    def mark_imported(self) -> None:
+        """导入阶段结束（第一次调用 create_app）"""
+        if not self._imported:
+            self._imported = True
+            self.record("imports", "import", self._elapsed())
+
+    def mark_ready(self) -> None:
+        """应用可以处理请求（lifespan 启动阶段结束）"""
+        self.ready_at = self._elapsed()
+        total = self.total_seconds()
+        logger.info("[Startup] 启动完成，耗时 %.3f 秒: %s", total, ", ".join(
+            f"{c['component']}={c['ms']}ms" for c in self.components()
+        ))
+        if total is not None and total > self.budget:
+            logger.warning("[Startup] 启动耗时 %.3f 秒超出预算 %.3f 秒", total, self.budget)
+
+    def components(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._components)
+
+    def total_seconds(self) -> Optional[float]:
+        """从进程启动到就绪的时间；无法读取进程启动时间时从本模块导入开始计算"""
+        if self.ready_at is None:
+            return None
+        return self.ready_at + (self._before_origin or 0.0)
+
+    def report(self) -> Dict[str, Any]:
+        total = self.total_seconds()
+        return {
+            "ready": self.ready_at is not None,
+            "before_profile_ms": round(self._before_origin * 1000, 1) if self._before_origin is not None else None,
+            "ready_ms": round(self.ready_at * 1000, 1) if self.ready_at is not None else None,
+            "total_ms": round(total * 1000, 1) if total is not None else None,
+            "budget_ms": round(self.budget * 1000, 1),
+            "within_budget": total <= self.budget if total is not None else None,
+            "components": self.components()
+        }
+
+
+# 全局实例（尽早导入，作为导入阶段计时的起点）
+startup_profile = StartupProfile()
@@ -0,0 +1,315 @@
+"""
+前端静态资源（dist/）的内存服务
+启动时扫描一次构建目录：小文件连同预压缩的 gzip/brotli 版本常驻内存，大文件只记录元数据、从磁盘发送；
+每个文件带强ETag，条件请求返回304；文件名带内容哈希的资源使用 immutable 缓存头，其余资源每次重新验证。
+定期检查目录是否有变化（重新构建后），有变化时在线程池中重新加载并整体替换。
+"""
+import asyncio
+import gzip
+import hashlib
+import importlib.util
+import logging
+import mimetypes
+import os
+import re
+import time
+from email.utils import formatdate
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from fastapi.responses import FileResponse, Response
+
+from startup_profile import startup_profile
+
+logger = logging.getLogger(__name__)
+
+# 可选的 brotli 压缩（pip install brotli）；未安装时只提供 gzip
+if importlib.util.find_spec("brotli") is not None:
+    import brotli
+else:
+    brotli = None
+
+# 静态资源配置（从环境变量读取，如果没有则使用默认值）
+STATIC_MEMORY_FILE_MAX_BYTES = int(os.getenv("STATIC_MEMORY_FILE_MAX_BYTES", str(2 * 1024 * 1024)))  # 单个文件超过此大小时不放入内存
+STATIC_COMPRESS_MIN_BYTES = int(os.getenv("STATIC_COMPRESS_MIN_BYTES", "1024"))  # 小于此大小的文件不压缩
+STATIC_GZIP_LEVEL = int(os.getenv("STATIC_GZIP_LEVEL", "9"))
+STATIC_BROTLI_QUALITY = int(os.getenv("STATIC_BROTLI_QUALITY", "11"))
+STATIC_RELOAD_INTERVAL = float(os.getenv("STATIC_RELOAD_INTERVAL", "2"))  # 检查目录变化的最小间隔（秒），0表示不检查
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# 按偏好排序的编码及其预压缩文件后缀
+_ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+_COMPRESSIBLE_TYPES = ("text/", "application/javascript", "application/json", "image/svg+xml", "application/xml")
+# webpack [contenthash] 之类的文件名：taskpane.3f2a9c1b.js、chunk-3f2a9c1b4d.css
+_HASHED_NAME = re.compile(r"[.-][0-9a-f]{8,}\.[A-Za-z0-9]+$")
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("application/javascript", ".mjs")
+
+
+class _Variant:
+    """资源的一种编码表示：内存中的字节或磁盘上的文件"""
+    __slots__ = ("encoding", "body", "file", "size", "etag")
+
+    def __init__(self, encoding: str, body: Optional[bytes], file: Optional[Path], size: int, etag: str):
+        self.encoding = encoding  # identity | gzip | br
+        self.body = body
+        self.file = file
+        self.size = size
+        self.etag = etag
+
+
+class Asset:
+    """dist/ 中的一个文件"""
+    __slots__ = ("path", "content_type", "cache_control", "last_modified", "variants", "etags")
+
+    def __init__(self, path: str, content_type: str, cache_control: str, last_modified: str, variants: List[_Variant]):
+        self.path = path
+        self.content_type = content_type
+        self.cache_control = cache_control
+        self.last_modified = last_modified
+        self.variants = {variant.encoding: variant for variant in variants}
+        self.etags = {variant.etag for variant in variants}
+
+    @property
+    def memory_bytes(self) -> int:
+        return sum(len(v.body) for v in self.variants.values() if v.body is not None)
+
+
+def _accepted_encodings(header: str) -> set:
+    """解析 Accept-Encoding，返回可接受（q>0）的编码"""
+    accepted = set()
+    for item in header.split(","):
+        name, _, params = item.strip().partition(";")
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if q > 0:
+            accepted.add(name)
+    return accepted
+
+
+def _etag_matches(header: str, etags: Iterable[str]) -> bool:
+    """If-None-Match 使用弱比较：忽略 W/ 前缀"""
+    header = header.strip()
+    if header == "*":
+        return True
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return any(etag in candidates for etag in etags)
+
+
+def _file_digest(file: Path) -> str:
+    digest = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AssetStore:
+    """
+    静态资源存储
+
+    get 只读当前快照（一个字典），重新加载时构建新快照后整体替换，
+    因此请求路径上没有锁，也不会看到加载到一半的目录。
+    """
+
+    def __init__(self, directory: Path, reload_interval: float = STATIC_RELOAD_INTERVAL):
+        self.directory = directory
+        self.reload_interval = reload_interval
+        self._assets: Dict[str, Asset] = {}
+        self._signature: Optional[Tuple] = None
+        self._last_check = 0.0
+        self._load_task: Optional[asyncio.Task] = None
+        self._reload_task: Optional[asyncio.Task] = None
+        self._stats = {
+            "responses": 0,
+            "not_modified": 0,
+            "misses": 0,
+            "from_disk": 0,
+            "encoded": {"br": 0, "gzip": 0, "identity": 0},
+            "reloads": 0,
+            "last_load_seconds": None
+        }
+
+    def _scan(self) -> Tuple:
+        """目录签名：所有文件的 (相对路径, 大小, mtime)"""
+        entries = []
+        if not self.directory.is_dir():
+            return ()
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                file = Path(root) / name
+                try:
+                    stat = file.stat()
+                except OSError:
+                    continue
+                entries.append((file.relative_to(self.directory).as_posix(), stat.st_size, stat.st_mtime_ns))
+        return tuple(sorted(entries))
+
+    def _load_asset(self, rel_path: str, size: int, mtime_ns: int, names: set) -> Asset:
+        file = self.directory / rel_path
+        content_type = mimetypes.guess_type(rel_path)[0] or "application/octet-stream"
+        if content_type.startswith("text/") or content_type == "application/javascript":
+            content_type += "; charset=utf-8"
+        cache_control = IMMUTABLE_CACHE_CONTROL if _HASHED_NAME.search(rel_path) else REVALIDATE_CACHE_CONTROL
+        last_modified = formatdate(mtime_ns / 1e9, usegmt=True)
+
+        in_memory = size <= STATIC_MEMORY_FILE_MAX_BYTES
+        body = file.read_bytes() if in_memory else None
+        digest = hashlib.sha256(body).hexdigest() if body is not None else _file_digest(file)
+        tag = digest[:32]
+        variants = [_Variant("identity", body, file, size, f'"{tag}"')]
+
+        compressible = size >= STATIC_COMPRESS_MIN_BYTES and content_type.startswith(_COMPRESSIBLE_TYPES)
+        for encoding, suffix in _ENCODINGS:
+            etag = f'"{tag}-{suffix[1:]}"'
+            # 构建时已生成的预压缩文件优先（如 compression-webpack-plugin 的输出）
+            if rel_path + suffix in names:
+                compressed_file = self.directory / (rel_path + suffix)
+                compressed_size = compressed_file.stat().st_size
+                compressed = compressed_file.read_bytes() if compressed_size <= STATIC_MEMORY_FILE_MAX_BYTES else None
+                variants.append(_Variant(encoding, compressed, compressed_file, compressed_size, etag))
+                continue
+            if not (compressible and in_memory):
+                continue
+            if encoding == "br":
+                if brotli is None:
+                    continue
+                compressed = brotli.compress(body, quality=STATIC_BROTLI_QUALITY)
+            else:
+                compressed = gzip.compress(body, compresslevel=STATIC_GZIP_LEVEL, mtime=0)
+            # 压缩后没有明显变小就不保留这个版本
+            if len(compressed) < size * 0.9:
+                variants.append(_Variant(encoding, compressed, None, len(compressed), etag))
+        return Asset(rel_path, content_type, cache_control, last_modified, variants)
+
+    def _load(self, signature: Tuple) -> None:
+        start = time.perf_counter()
+        names = {entry[0] for entry in signature}
+        assets: Dict[str, Asset] = {}
+        for rel_path, size, mtime_ns in signature:
+            # 有原文件的 .gz/.br 作为它的编码版本，不单独提供
+            if any(rel_path.endswith(suffix) and rel_path[:-len(suffix)] in names for _, suffix in _ENCODINGS):
+                continue
+            try:
+                assets[rel_path] = self._load_asset(rel_path, size, mtime_ns, names)
+            except OSError as e:
+                # 构建过程中文件可能正在被替换；下一次检查时会再次加载
+                logger.warning("[Static] 加载静态文件失败 %s: %s", rel_path, e)
+        self._assets = assets
+        self._signature = signature
+        self._stats["reloads"] += 1
+        self._stats["last_load_seconds"] = round(time.perf_counter() - start, 3)
+        logger.info(
+            "[Static] 已加载 %d 个静态文件（内存 %d 字节，耗时 %.3f 秒）",
+            len(assets), sum(a.memory_bytes for a in assets.values()), self._stats["last_load_seconds"]
+        )
+
+    def _reload_if_changed(self) -> None:
+        signature = self._scan()
+        if signature != self._signature:
+            self._load(signature)
+
+    def load(self) -> None:
+        """同步加载"""
+        self._last_check = time.monotonic()
+        self._reload_if_changed()
+
+    async def _initial_load(self) -> None:
+        with startup_profile.measure("static_assets", phase="background"):
+            await asyncio.to_thread(self.load)
+
+    def start(self) -> None:
+        """在后台线程中开始首次加载（不阻塞启动）"""
+        if self._load_task is None:
+            self._load_task = asyncio.create_task(self._initial_load())
+
+    async def ensure_loaded(self) -> None:
+        """首次加载完成前到达的请求等待加载完成；没有调用过 start 时在这里开始加载"""
+        if self._signature is not None:
+            return
+        self.start()
+        await asyncio.shield(self._load_task)
+
+    async def _reload(self) -> None:
+        try:
+            await asyncio.to_thread(self._reload_if_changed)
+        finally:
+            self._reload_task = None
+
+    def _maybe_reload(self) -> None:
+        """超过检查间隔时在后台检查目录；本次请求仍使用当前快照"""
+        if self.reload_interval <= 0 or self._reload_task is not None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.reload_interval:
+            return
+        self._last_check = now
+        self._reload_task = asyncio.create_task(self._reload())
+
+    def get(self, path: str) -> Optional[Asset]:
+        self._maybe_reload()
+        return self._assets.get(path.lstrip("/"))
+
+    def exists(self, path: str) -> bool:
+        return path.lstrip("/") in self._assets
+
+    def respond(self, asset: Asset, accept_encoding: str = "", if_none_match: str = "") -> Response:
+        """根据请求头选择编码版本并构建响应（命中 If-None-Match 时返回304）"""
+        headers = {
+            "Cache-Control": asset.cache_control,
+            "Last-Modified": asset.last_modified
+        }
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+
+        variant = asset.variants["identity"]
+        if len(asset.variants) > 1 and accept_encoding:
+            accepted = _accepted_encodings(accept_encoding)
+            for encoding, _ in _ENCODINGS:
+                if encoding in accepted and encoding in asset.variants:
+                    variant = asset.variants[encoding]
+                    break
+        headers["ETag"] = variant.etag
+
+        if if_none_match and _etag_matches(if_none_match, asset.etags):
+            self._stats["not_modified"] += 1
+            return Response(status_code=304, headers=headers)
+
+        self._stats["responses"] += 1
+        self._stats["encoded"][variant.encoding] += 1
+        if variant.encoding != "identity":
+            headers["Content-Encoding"] = variant.encoding
+        if variant.body is not None:
+            return Response(content=variant.body, media_type=asset.content_type, headers=headers)
+        self._stats["from_disk"] += 1
+        # 不在内存中的大文件从磁盘发送；ETag等已由上面的头给出
+        return FileResponse(str(variant.file), media_type=asset.content_type, headers=headers)
+
+    def miss(self) -> None:
+        self._stats["misses"] += 1
+
+    def stats(self) -> Dict:
+        assets = list(self._assets.values())
+        return {
+            "directory": str(self.directory),
+            "files": len(assets),
+            "memory_bytes": sum(a.memory_bytes for a in assets),
+            "brotli_available": brotli is not None,
+            "reload_interval": self.reload_interval,
+            **self._stats
+        }
+
+
+# 全局实例
+asset_store = AssetStore(Path(__file__).resolve().parent.parent / "dist")
@@ -0,0 +1,195 @@
+"""
+增量流式JSON解析器
+在模型仍在生成时逐块消费输出，一旦某个编辑操作（edits数组中的对象）完整，立即产出
+"""
+import json
+import logging
+import re
+from typing import Any, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 字符串内部只需要关心引号和反斜杠，用正则一次跳过普通字符
+_STRING_SPECIAL = re.compile(r'["\\]')
+# 字符串外部关心的结构字符
+_STRUCTURAL = re.compile(r'[{}\[\]",]')
+
+# 解析器产出的事件类型
+EVENT_MESSAGE = "message"
+EVENT_EDIT = "edit"
+
+
+class _Frame:
+    """容器栈中的一层（对象或数组）"""
+    __slots__ = ("is_object", "expect_key", "key")
+
+    def __init__(self, is_object: bool):
+        self.is_object = is_object
+        self.expect_key = is_object
+        self.key: Optional[str] = None
+
+
+class IncrementalEditParser:
+    """
+    理解 AIResponse/EditOperation 结构的增量解析器
+
+    用法：
+        parser = IncrementalEditParser()
+        for chunk in chunks:
+            for kind, payload in parser.feed(chunk):
+                ...  # kind 为 "message"（payload为字符串）或 "edit"（payload为 (位置, 字典)）
+
+    顶层对象之前的任何内容（如 ```json 代码块标记）都会被忽略。
+    编辑操作的位置是它在 edits 数组中的原始下标（无法解析的元素也占一个位置），
+    与 parse_ai_response 给最终结果中的编辑操作设置的 index 一致，客户端可以按位置对应。
+    这里只负责尽早产出，最终结果仍以 parse_ai_response 对完整文本的解析为准。
+    """
+
+    def __init__(self):
+        self._stack: List[_Frame] = []
+        self._started = False
+        self._finished = False
+        self._in_string = False
+        self._escape = False
+        # 当前正在收集的片段：顶层 message 字符串值，或 edits 数组中的一个对象
+        self._capture: Optional[str] = None  # "message" | "edit" | "key"
+        self._capture_depth = 0
+        self._capture_parts: List[str] = []
+        self._edit_count = 0
+        # edits 数组中当前元素的下标，以及正在收集的编辑操作的下标
+        self._edit_position = 0
+        self._capture_position = 0
+
+    @property
+    def edit_count(self) -> int:
+        return self._edit_count
+
+    def _in_edits_array(self) -> bool:
+        """当前是否位于顶层对象的 edits 数组内（深度2）"""
+        return (
+            len(self._stack) == 2
+            and not self._stack[1].is_object
+            and self._stack[0].key == "edits"
+        )
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        """消费一个文本块，返回本块内新完成的事件列表"""
+        events: List[Tuple[str, Any]] = []
+        if self._finished or not chunk:
+            return events
+
+        pos = 0
+        capture_start = 0
+        n = len(chunk)
+
+        while pos < n:
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                    pos += 1
+                    continue
+                m = _STRING_SPECIAL.search(chunk, pos)
+                if m is None:
+                    pos = n
+                    break
+                pos = m.end()
+                if m.group() == "\\":
+                    self._escape = True
+                    continue
+                # 字符串结束
+                self._in_string = False
+                if self._capture in ("message", "key"):
+                    self._capture_parts.append(chunk[capture_start:pos])
+                    literal = "".join(self._capture_parts)
+                    self._capture_parts = []
+                    kind = self._capture
+                    self._capture = None
+                    value = self._decode_string(literal)
+                    if kind == "key":
+                        self._stack[-1].key = value
+                    elif value is not None:
+                        events.append((EVENT_MESSAGE, value))
+                continue
+
+            if not self._started:
+                start = chunk.find("{", pos)
+                if start < 0:
+                    return events
+                self._started = True
+                self._stack.append(_Frame(True))
+                pos = start + 1
+                continue
+
+            m = _STRUCTURAL.search(chunk, pos)
+            if m is None:
+                pos = n
+                break
+            ch = m.group()
+            idx = m.start()
+            pos = m.end()
+            frame = self._stack[-1]
+
+            if ch == '"':
+                self._in_string = True
+                if self._capture is None:
+                    if frame.is_object and frame.expect_key and len(self._stack) == 1:
+                        # 顶层对象的键，需要记住以识别 message / edits
+                        self._capture = "key"
+                        capture_start = idx
+                    elif len(self._stack) == 1 and frame.key == "message" and not frame.expect_key:
+                        self._capture = "message"
+                        capture_start = idx
+                if frame.is_object and frame.expect_key:
+                    frame.expect_key = False
+            elif ch == ",":
+                if frame.is_object:
+                    frame.expect_key = True
+                    if len(self._stack) == 1:
+                        frame.key = None
+                elif self._in_edits_array():
+                    self._edit_position += 1
+            elif ch in "{[":
+                if ch == "{" and self._capture is None and self._in_edits_array():
+                    self._capture = "edit"
+                    self._capture_depth = len(self._stack)
+                    self._capture_position = self._edit_position
+                    capture_start = idx
+                elif ch == "[" and len(self._stack) == 1 and frame.key == "edits":
+                    self._edit_position = 0
+                self._stack.append(_Frame(ch == "{"))
+            else:  # } 或 ]
+                self._stack.pop()
+                if self._capture == "edit" and len(self._stack) == self._capture_depth:
+                    self._capture_parts.append(chunk[capture_start:pos])
+                    text = "".join(self._capture_parts)
+                    self._capture_parts = []
+                    self._capture = None
+                    edit = self._decode_edit(text)
+                    if edit is not None:
+                        events.append((EVENT_EDIT, (self._capture_position, edit)))
+                if not self._stack:
+                    self._finished = True
+                    break
+
+        # 本块结束时仍在收集的片段，先保存已读部分
+        if self._capture is not None:
+            self._capture_parts.append(chunk[capture_start:pos])
+
+        return events
+
+    def _decode_string(self, literal: str) -> Optional[str]:
+        try:
+            return json.loads(literal)
+        except json.JSONDecodeError:
+            return None
+
+    def _decode_edit(self, text: str) -> Optional[Dict[str, Any]]:
+        try:
+            edit = json.loads(text)
+        except json.JSONDecodeError as e:
+            logger.debug("[StreamParser] 编辑操作解析失败: %s", e)
+            return None
+        if not isinstance(edit, dict) or "type" not in edit:
+            return None
+        self._edit_count += 1
+        return edit
@@ -0,0 +1,10 @@
+"""
+后端单元测试
+测试直接导入 backend 目录下的模块（与 main.py 的导入方式一致），在 backend 目录下运行：python -m pytest -q
+"""
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
@@ -0,0 +1,73 @@
+"""锚点解析（anchor_index）"""
+import random
+
+import pytest
+
+import anchor_index
+from anchor_index import AhoCorasick, DocumentAnchors, annotate_edits, fold_text
+
+
+def _brute_force(patterns, text):
+    return sorted(
+        (index, start)
+        for index, pattern in enumerate(patterns)
+        for start in range(len(text) - len(pattern) + 1)
+        if text.startswith(pattern, start)
+    )
+
+
+def test_automaton_finds_all_overlapping_matches():
+    patterns = ["he", "she", "his", "hers", "e", "甲乙", "乙甲乙"]
+    text = "ushers 甲乙甲乙甲 his hershe"
+    automaton = AhoCorasick(patterns)
+    assert sorted(automaton.finditer(text)) == _brute_force(patterns, text)
+
+
+def test_automaton_matches_brute_force_on_random_text():
+    rng = random.Random(7)
+    text = "".join(rng.choice("abc") for _ in range(300))
+    patterns = sorted({"".join(rng.choice("abc") for _ in range(rng.randint(1, 4))) for _ in range(20)})
+    automaton = AhoCorasick(patterns)
+    assert sorted(automaton.finditer(text)) == _brute_force(automaton.patterns, text)
+
+
+def test_empty_patterns_are_ignored():
+    automaton = AhoCorasick(["", "a"])
+    assert automaton.patterns == ["a"]
+    assert list(AhoCorasick([]).finditer("abc")) == []
+
+
+def test_fold_text_keeps_offsets_aligned():
+    text = "İstanbul\rWord ÄBC"
+    assert len(fold_text(text)) == len(text)
+    assert fold_text("A\rB") == "a\nb"
+
+
+@pytest.mark.parametrize("min_patterns", [1, 1000])
+def test_resolve_counts_non_overlapping_case_insensitive(monkeypatch, min_patterns):
+    # 两条路径（逐个 str.find 和自动机）的结果一致
+    monkeypatch.setattr(anchor_index, "ANCHOR_AUTOMATON_MIN_PATTERNS", min_patterns)
+    anchors = DocumentAnchors("AAAA aa 标题\r正文 Title title")
+    result = anchors.resolve(["aa", "AA", "标题\n正文", "title", "缺失"])
+    assert (result["aa"].count, result["aa"].offsets) == (3, [0, 2, 5])
+    assert result["AA"] is result["aa"]
+    assert result["标题\n正文"].offsets == [8]
+    assert result["title"].count == 2
+    assert result["缺失"].count == 0
+
+
+def test_annotate_edits_flags_and_drops_missing_anchors(monkeypatch):
+    edits = [
+        {"type": "replace", "searchText": "Word", "content": "WPS"},
+        {"type": "delete", "searchText": "不存在"},
+        {"type": "insertText", "content": "结尾", "position": "end"},
+    ]
+    document = "用 word 编辑，再用 Word 保存"
+    flagged = annotate_edits(edits, document, record=False)
+    assert flagged[0]["anchorCount"] == 2 and flagged[0]["anchorOffsets"] == [2, 13]
+    assert flagged[1]["anchorCount"] == 0
+    assert flagged[2] is edits[2]
+
+    monkeypatch.setattr(anchor_index, "ANCHOR_RESOLUTION", "drop")
+    kept = annotate_edits(edits, document, record=False)
+    assert [edit["type"] for edit in kept] == ["replace", "insertText"]
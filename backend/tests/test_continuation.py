@@ -0,0 +1,101 @@
+"""续写内容的衔接（continuation）"""
+import asyncio
+
+import pytest
+
+import continuation
+from continuation import UpstreamTruncated, _Stitcher, stream_with_continuation
+
+PREVIOUS = '{"message": "已将所有标题加粗", "edits": [{"type": "format", "searchText": "第一章 总则", "format": {"bold": true}}, {"type": "format", "sear'
+REST = 'chText": "第二章 范围", "format": {"bold": true}}]}'
+
+
+def _stitch(previous: str, continued: str, size: int = 5) -> str:
+    stitcher = _Stitcher(previous)
+    out = [stitcher.feed(continued[start:start + size]) for start in range(0, len(continued), size)]
+    out.append(stitcher.flush())
+    return "".join(out)
+
+
+def test_clean_continuation_is_passed_through():
+    assert _stitch(PREVIOUS, REST) == REST
+
+
+def test_repeated_tail_is_skipped():
+    assert _stitch(PREVIOUS, PREVIOUS[-30:] + REST) == REST
+
+
+def test_restart_from_the_beginning_is_skipped():
+    for size in (1, 5, 200):
+        assert _stitch(PREVIOUS, PREVIOUS + REST, size) == REST
+
+
+def test_repeated_code_fence_is_dropped():
+    assert _stitch(PREVIOUS, "```json\n" + PREVIOUS[-20:] + REST) == REST
+
+
+def test_short_continuation_is_decided_on_flush():
+    stitcher = _Stitcher(PREVIOUS)
+    assert stitcher.feed("}]}") == ""
+    assert stitcher.flush() == "}]}"
+    assert stitcher.skipped == 0
+
+
+def _fake_upstream(responses):
+    """每次调用 start 时按顺序使用一个响应：(数据块列表, 结束时是否中断)"""
+    calls = []
+
+    async def start(messages, response_format):
+        calls.append((messages, response_format))
+        chunks, truncated = responses[len(calls) - 1]
+        length = 0
+        for count, chunk in enumerate(chunks, 1):
+            length += len(chunk)
+            yield chunk, count, length, 0.0
+        if truncated:
+            raise UpstreamTruncated("连接断开")
+
+    return start, calls
+
+
+def _collect(start, **kwargs):
+    async def run():
+        return [item async for item in stream_with_continuation(start, [{"role": "user", "content": "加粗标题"}], **kwargs)]
+    return asyncio.run(run())
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(continuation, "CONTINUATION_BACKOFF", 0)
+
+
+def test_truncated_stream_is_continued_and_stitched():
+    start, calls = _fake_upstream([
+        ([PREVIOUS[:60], PREVIOUS[60:]], True),
+        ([PREVIOUS[-25:], REST], False),
+    ])
+    items = _collect(start, response_format={"type": "json_object"})
+    assert "".join(item[0] for item in items) == PREVIOUS + REST
+    # 数据块计数和累计长度在两次上游调用之间连续
+    assert [item[1] for item in items] == sorted(item[1] for item in items)
+    assert items[-1][2] == len(PREVIOUS + REST)
+    # 续写请求带上已收到的内容，不带 response_format
+    messages, response_format = calls[1]
+    assert messages[-2] == {"role": "assistant", "content": PREVIOUS}
+    assert response_format is None
+
+
+def test_gives_up_with_partial_content_after_max_attempts():
+    start, calls = _fake_upstream([(["abc"], True), (["def"], True)])
+    items = _collect(start, max_attempts=1)
+    assert "".join(item[0] for item in items) == "abcdef"
+    assert len(calls) == 2
+
+
+def test_failure_before_first_call_is_raised():
+    async def start(messages, response_format):
+        raise RuntimeError("上游不可用")
+        yield
+
+    with pytest.raises(RuntimeError):
+        _collect(start)
@@ -0,0 +1,75 @@
+"""分段处理的切分与合并（map_reduce）"""
+from map_reduce import merge_section_results, split_sections
+
+DOCUMENT = "\r".join([
+    "第一章 总则",
+    "本规定适用于全体员工。" * 3,
+    "第二章 范围",
+    "范围包括所有部门。" * 3,
+    "",
+    "第三章 附则",
+    "本规定自发布之日起施行。",
+])
+
+
+def test_sections_cover_document_in_order():
+    sections = split_sections(DOCUMENT, 60)
+    assert len(sections) > 1
+    for start, text in sections:
+        assert DOCUMENT[start:start + len(text)] == text
+        assert len(text) <= 60
+    starts = [start for start, _ in sections]
+    assert starts == sorted(starts)
+    # 所有非空段落都落在某个部分中
+    covered = "".join(text for _, text in sections).replace("\r", "")
+    assert covered == DOCUMENT.replace("\r", "")
+
+
+def test_long_paragraph_is_cut_to_the_limit():
+    document = "甲" * 250
+    sections = split_sections(document, 100)
+    assert [(start, len(text)) for start, text in sections] == [(0, 100), (100, 100), (200, 50)]
+
+
+def test_split_prefers_heading_boundaries():
+    sections = split_sections(DOCUMENT, 60)
+    assert sections[1][1].startswith("第二章")
+
+
+def _edit(edit_type, search, **fields):
+    return dict(type=edit_type, searchText=search, **fields)
+
+
+def test_merge_orders_by_position_and_resolves_conflicts():
+    sections = [(0, "甲乙丙"), (100, "丁戊甲")]
+    results = [
+        {"message": "第一部分", "edits": [
+            _edit("format", "丙", format={"bold": True}, anchorCount=1, anchorOffsets=[2], index=0),
+            _edit("replace", "甲", content="A"),
+            {"type": "insertText", "content": "结尾", "position": "end"},
+        ]},
+        {"message": "第二部分", "edits": [
+            _edit("replace", "丁", content="D"),
+            _edit("format", "甲", format={"italic": True}),
+            _edit("replace", "甲", content="B"),
+            _edit("format", "丙", format={"bold": True}),
+            {"type": "insertText", "content": "结尾", "position": "end"},
+        ]},
+    ]
+    merged, stats = merge_section_results(sections, results)
+    assert merged["edits"] == [
+        _edit("format", "甲", format={"italic": True}),
+        _edit("replace", "甲", content="A"),
+        _edit("format", "丙", format={"bold": True}),
+        _edit("replace", "丁", content="D"),
+        {"type": "insertText", "content": "结尾", "position": "end"},
+    ]
+    assert stats == {"edits": 8, "duplicates": 2, "conflicts": 1}
+    assert merged["message"] == "已分 2 个部分处理：第一部分；第二部分"
+
+
+def test_merge_skips_failed_sections():
+    sections = [(0, "甲"), (10, "乙")]
+    merged, stats = merge_section_results(sections, [None, {"message": "完成", "edits": [_edit("delete", "乙")]}])
+    assert merged == {"message": "完成", "edits": [_edit("delete", "乙")]}
+    assert stats["edits"] == 1
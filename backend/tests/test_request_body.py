@@ -0,0 +1,51 @@
+"""请求体流式哈希（request_body.JsonFieldHasher）"""
+import json
+
+import pytest
+
+from document_sessions import hash_document
+from request_body import JsonFieldHasher
+
+DOCUMENTS = [
+    "",
+    "普通文本",
+    'Quote " backslash \\ slash / tab\t newline\n\r\x01',
+    "代理对 😀 和   以及 é",
+    '{"document_content": "嵌套的同名键"}',
+]
+
+
+def _hash_in_chunks(body: bytes, size: int):
+    hasher = JsonFieldHasher("document_content")
+    for start in range(0, len(body), size):
+        hasher.feed(body[start:start + size])
+    return hasher.result()
+
+
+@pytest.mark.parametrize("ensure_ascii", [True, False])
+@pytest.mark.parametrize("document", DOCUMENTS)
+def test_matches_hash_document_for_any_chunk_size(document, ensure_ascii):
+    body = json.dumps({
+        "user_request": "document_content 出现在其他值中",
+        "options": {"document_content": "嵌套对象中的同名键", "list": ["\"", "\\u0041"]},
+        "document_content": document,
+        "bypass_cache": False,
+    }, ensure_ascii=ensure_ascii).encode("utf-8")
+    for size in (1, 2, 5, 6, 11, len(body)):
+        assert _hash_in_chunks(body, size) == hash_document(document), size
+
+
+def test_duplicate_field_uses_the_last_value():
+    body = b'{"document_content": "first", "document_content": "second"}'
+    assert _hash_in_chunks(body, 3) == hash_document("second")
+
+
+@pytest.mark.parametrize("body", [
+    b'{"user_request": "no document"}',
+    b'{"document_content": null}',
+    b'{"document_content": "unterminated',
+    b'{"document_content": "lone \\ud800 surrogate"}',
+    b'{"document_content": "bad \\x escape"}',
+])
+def test_returns_none_when_value_cannot_be_hashed(body):
+    assert _hash_in_chunks(body, 4) is None
@@ -0,0 +1,55 @@
+"""增量编辑操作解析器（stream_parser）"""
+import json
+
+from stream_parser import EVENT_EDIT, EVENT_MESSAGE, IncrementalEditParser
+
+RESPONSE = {
+    "message": "已完成 {2} 处修改，\"引号\" 和 \\ 反斜杠",
+    "edits": [
+        {"type": "replace", "searchText": "旧文本 [1]", "content": "新文本 {a}"},
+        {"content": "缺少 type 的元素"},
+        "不是对象",
+        {"type": "format", "searchText": "标题", "format": {"bold": True}},
+    ],
+}
+
+
+def _feed_all(text: str, size: int):
+    parser = IncrementalEditParser()
+    events = []
+    for start in range(0, len(text), size):
+        events.extend(parser.feed(text[start:start + size]))
+    return parser, events
+
+
+def test_events_match_full_parse_for_any_chunk_size():
+    text = "```json\n" + json.dumps(RESPONSE, ensure_ascii=False, indent=2) + "\n```"
+    for size in (1, 2, 3, 7, 64, len(text)):
+        parser, events = _feed_all(text, size)
+        assert events == [
+            (EVENT_MESSAGE, RESPONSE["message"]),
+            (EVENT_EDIT, (0, RESPONSE["edits"][0])),
+            (EVENT_EDIT, (3, RESPONSE["edits"][3])),
+        ], size
+        assert parser.edit_count == 2
+
+
+def test_edit_is_emitted_as_soon_as_it_closes():
+    parser = IncrementalEditParser()
+    assert parser.feed('{"edits": [{"type": "delete", "searchText": "x"}') == [
+        (EVENT_EDIT, (0, {"type": "delete", "searchText": "x"}))
+    ]
+    assert parser.feed(', {"type": "delete"') == []
+    assert parser.feed('}]') == [(EVENT_EDIT, (1, {"type": "delete"}))]
+
+
+def test_nested_keys_named_edits_are_ignored():
+    parser, events = _feed_all('{"meta": {"edits": [{"type": "replace"}]}, "message": "ok"}', 5)
+    assert events == [(EVENT_MESSAGE, "ok")]
+    assert parser.edit_count == 0
+
+
+def test_input_after_top_level_object_is_ignored():
+    parser = IncrementalEditParser()
+    parser.feed('{"message": "a"}')
+    assert parser.feed('{"message": "b"}') == []
@@ -0,0 +1,270 @@
+"""
+请求追踪
+每个请求一个追踪上下文（随 asyncio 任务的上下文传播），记录各阶段的耗时：读取请求体、构建提示词、
+建立上游连接、等待首个token、生成、解析响应、SSE发送等。阶段耗时汇总放在最终的 result 事件中
+（开始流式响应前已完成的阶段同时放在 Server-Timing 响应头中），完成的追踪保存在内存环形缓冲区中
+（另外保留最慢的N个请求），可通过 /debug/traces 查询，也可以写入按大小轮转的本地文件。
+"""
+import contextvars
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# 追踪配置（从环境变量读取，如果没有则使用默认值）
+TRACE_ENABLED = os.getenv("TRACE_ENABLED", "true").lower() in ("1", "true", "yes")
+TRACE_RING_SIZE = int(os.getenv("TRACE_RING_SIZE", "200"))  # 内存中保留的最近请求数
+TRACE_SLOWEST = int(os.getenv("TRACE_SLOWEST", "20"))  # 另外保留的最慢请求数
+TRACE_MAX_SPANS = int(os.getenv("TRACE_MAX_SPANS", "200"))  # 单个请求最多记录的阶段数（超出的只计入汇总）
+TRACE_FILE = os.getenv("TRACE_FILE", "")  # 追踪写入的JSON行文件，空表示只保存在内存中
+TRACE_FILE_MAX_BYTES = int(os.getenv("TRACE_FILE_MAX_BYTES", str(10 * 1024 * 1024)))  # 单个追踪文件的最大字节数
+TRACE_FILE_BACKUP_COUNT = int(os.getenv("TRACE_FILE_BACKUP_COUNT", "3"))  # 保留的已轮转追踪文件数
+
+# 当前请求的追踪（由请求入口设置）和阶段所属的子任务（批量请求的指令、分段处理的部分）
+current_trace: contextvars.ContextVar[Optional["Trace"]] = contextvars.ContextVar("current_trace", default=None)
+trace_scope: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("trace_scope", default=None)
+
+
+class Trace:
+    """一个请求的追踪：阶段列表（相对于请求开始的偏移量和耗时）和按阶段名累计的耗时"""
+
+    def __init__(self, request_id: str, path: str):
+        self.request_id = request_id
+        self.path = path
+        self.started_at = time.time()
+        self._origin = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.dropped_spans = 0
+        # (子任务, 阶段名) -> 累计秒数
+        self._totals: Dict[Tuple[Optional[str], str], float] = {}
+        self.attrs: Dict[str, Any] = {}
+        self.status: Optional[str] = None
+        self.total_ms: Optional[float] = None
+
+    def record(self, name: str, start: float, end: float, **attrs: Any) -> None:
+        """记录一个阶段（start、end 为 time.perf_counter() 的值）"""
+        scope = trace_scope.get()
+        key = (scope, name)
+        self._totals[key] = self._totals.get(key, 0.0) + (end - start)
+        if len(self.spans) >= TRACE_MAX_SPANS:
+            self.dropped_spans += 1
+            return
+        span: Dict[str, Any] = {
+            "name": name,
+            "start_ms": round((start - self._origin) * 1000, 2),
+            "ms": round((end - start) * 1000, 2)
+        }
+        if scope is not None:
+            span["scope"] = scope
+        if attrs:
+            span["attrs"] = attrs
+        self.spans.append(span)
+
+    def accumulate(self, name: str, seconds: float) -> None:
+        """只累计耗时、不单独记录阶段（SSE发送这种次数很多的小段时间）"""
+        key = (trace_scope.get(), name)
+        self._totals[key] = self._totals.get(key, 0.0) + seconds
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._origin) * 1000, 2)
+
+    def summary(self) -> Dict[str, float]:
+        """
+        各阶段的耗时（毫秒）和到目前为止的总耗时
+
+        同一子任务中同名的阶段累加；并发的子任务（批量指令、分段处理的各部分）取最长的一个，
+        所以汇总近似于关键路径上的耗时，而不是所有子任务的总和。
+        """
+        stages: Dict[str, float] = {}
+        for (_, name), seconds in self._totals.items():
+            stages[name] = max(stages.get(name, 0.0), seconds)
+        result = {name: round(seconds * 1000, 2) for name, seconds in stages.items()}
+        result["total"] = self.total_ms if self.total_ms is not None else self.elapsed_ms()
+        return result
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头的值"""
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.summary().items())
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "request_id": self.request_id,
+            "path": self.path,
+            "started_at": round(self.started_at, 3),
+            "status": self.status,
+            "total_ms": self.total_ms,
+            "timing": self.summary(),
+            "attrs": self.attrs,
+            "spans": self.spans,
+            "dropped_spans": self.dropped_spans
+        }
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[None]:
+    """with span("阶段"): ... 在当前请求的追踪中记录这段代码的耗时（没有追踪时什么都不做）"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.record(name, start, time.perf_counter(), **attrs)
+
+
+def record_span(name: str, start: float, end: float, **attrs: Any) -> None:
+    """记录一个不便用 with 包住的阶段（例如首个token之前的等待时间）"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.record(name, start, end, **attrs)
+
+
+def set_trace_attrs(**attrs: Any) -> None:
+    """给当前请求的追踪附加属性（模型、是否命中缓存等）；子任务中的属性按子任务分开保存"""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    scope = trace_scope.get()
+    if scope is None:
+        trace.attrs.update(attrs)
+    else:
+        trace.attrs.setdefault("scopes", {}).setdefault(scope, {}).update(attrs)
+
+
+def timing_summary() -> Optional[Dict[str, float]]:
+    """当前请求到目前为止的阶段耗时汇总（放在 result 事件中），没有追踪时返回None"""
+    trace = current_trace.get()
+    return trace.summary() if trace is not None else None
+
+
+class TraceSink:
+    """
+    保存完成的追踪：最近的 ring_size 个请求（环形缓冲区）和最慢的 slowest 个请求（小顶堆）
+
+    配置了 TRACE_FILE 时，追踪由后台线程写入按大小轮转的JSON行文件，请求处理中不做文件写入。
+    """
+
+    def __init__(self, ring_size: int = TRACE_RING_SIZE, slowest: int = TRACE_SLOWEST, file_path: str = TRACE_FILE):
+        self.slowest_size = slowest
+        self._lock = threading.Lock()
+        self._recent: Deque[Dict[str, Any]] = deque(maxlen=ring_size)
+        self._slowest: List[Tuple[float, int, Dict[str, Any]]] = []
+        self._sequence = itertools.count()
+        self.recorded = 0
+        self.file_path = file_path
+        self._queue: Optional["queue.Queue[logging.LogRecord]"] = None
+        self._listener: Optional[logging.handlers.QueueListener] = None
+        self._file_logger: Optional[logging.Logger] = None
+
+    def _start_file(self) -> None:
+        """第一次写入时打开追踪文件并启动后台写入线程"""
+        Path(self.file_path).parent.mkdir(parents=True, exist_ok=True)
+        handler = logging.handlers.RotatingFileHandler(
+            self.file_path, maxBytes=TRACE_FILE_MAX_BYTES, backupCount=TRACE_FILE_BACKUP_COUNT, encoding="utf-8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._queue = queue.Queue()
+        self._listener = logging.handlers.QueueListener(self._queue, handler)
+        self._listener.start()
+        # 独立的记录器，不经过根记录器的日志管道
+        file_logger = logging.getLogger("trace_file")
+        file_logger.propagate = False
+        file_logger.setLevel(logging.INFO)
+        file_logger.handlers = [logging.handlers.QueueHandler(self._queue)]
+        self._file_logger = file_logger
+
+    def add(self, trace: Trace) -> None:
+        entry = trace.to_dict()
+        total = trace.total_ms or 0.0
+        with self._lock:
+            self.recorded += 1
+            self._recent.append(entry)
+            if self.slowest_size > 0:
+                item = (total, next(self._sequence), entry)
+                if len(self._slowest) < self.slowest_size:
+                    heapq.heappush(self._slowest, item)
+                elif total > self._slowest[0][0]:
+                    heapq.heapreplace(self._slowest, item)
+            if self.file_path and self._file_logger is None:
+                try:
+                    self._start_file()
+                except OSError as e:
+                    logger.error("[Trace] 无法打开追踪文件 %s: %s", self.file_path, e)
+                    self.file_path = ""
+        if self._file_logger is not None:
+            self._file_logger.info(json.dumps(entry, ensure_ascii=False))
+
+    def recent(self, limit: int) -> List[Dict[str, Any]]:
+        """最近的追踪，最新的在前"""
+        with self._lock:
+            return list(itertools.islice(reversed(self._recent), max(limit, 0)))
+
+    def slowest(self, limit: int) -> List[Dict[str, Any]]:
+        """最慢的追踪，最慢的在前"""
+        with self._lock:
+            ordered = sorted(self._slowest, key=lambda item: (-item[0], item[1]))
+        return [entry for _, _, entry in ordered[:max(limit, 0)]]
+
+    def find(self, request_id: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            candidates = list(self._recent) + [entry for _, _, entry in self._slowest]
+        found: Dict[int, Dict[str, Any]] = {}
+        for entry in candidates:
+            if entry["request_id"] == request_id:
+                found[id(entry)] = entry
+        return sorted(found.values(), key=lambda entry: entry["started_at"], reverse=True)
+
+    def close(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+            for handler in self._listener.handlers:
+                handler.close()
+            self._listener = None
+            self._file_logger = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            slowest_ms = max((item[0] for item in self._slowest), default=None)
+            return {
+                "enabled": TRACE_ENABLED,
+                "recorded": self.recorded,
+                "recent": len(self._recent),
+                "slowest_retained": len(self._slowest),
+                "slowest_ms": slowest_ms,
+                "file": self.file_path or None
+            }
+
+
+# 全局追踪存储
+trace_sink = TraceSink()
+
+
+def start_trace(request_id: str, path: str) -> Optional[Trace]:
+    """开始当前请求的追踪（TRACE_ENABLED=false 时返回None）"""
+    if not TRACE_ENABLED:
+        return None
+    trace = Trace(request_id, path)
+    current_trace.set(trace)
+    return trace
+
+
+def finish_trace(trace: Optional[Trace], status: str) -> None:
+    """请求结束：记下总耗时和状态并保存"""
+    if trace is None or trace.total_ms is not None:
+        return
+    trace.total_ms = trace.elapsed_ms()
+    trace.status = status
+    trace_sink.add(trace)
@@ -0,0 +1,198 @@
+"""
+上游AI API的HTTP客户端注册表
+为配置的上游源站维护长期存活的连接池（keep-alive，可选HTTP/2），并在启动时预热连接；
+请求中临时指定的上游也会复用连接池，但数量有上限，超出时关闭最久未使用的连接池
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Iterable, Optional, Set
+from urllib.parse import urlsplit
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# 连接池配置（从环境变量读取，如果没有则使用默认值）
+UPSTREAM_MAX_CONNECTIONS = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "120"))
+UPSTREAM_HTTP2 = os.getenv("UPSTREAM_HTTP2", "false").lower() in ("1", "true", "yes")
+UPSTREAM_PREWARM = os.getenv("UPSTREAM_PREWARM", "true").lower() in ("1", "true", "yes")
+UPSTREAM_PREWARM_TIMEOUT = float(os.getenv("UPSTREAM_PREWARM_TIMEOUT", "5"))
+# 额外需要预热的上游地址（逗号分隔），DEFAULT_API_URL 总是会被预热
+UPSTREAM_PREWARM_URLS = [u.strip() for u in os.getenv("UPSTREAM_PREWARM_URLS", "").split(",") if u.strip()]
+# 请求中指定的（未配置的）上游最多保留的连接池数，超出时关闭最久未使用的
+UPSTREAM_MAX_ADHOC_POOLS = int(os.getenv("UPSTREAM_MAX_ADHOC_POOLS", "16"))
+
+# 流式请求的超时配置（读超时较长，因为模型生成可能需要几分钟）
+UPSTREAM_TIMEOUT = httpx.Timeout(
+    connect=10.0,
+    read=300.0,
+    write=10.0,
+    pool=10.0
+)
+
+
+def _origin_of(api_url: str) -> str:
+    """提取URL的源站（scheme://host:port），同一源站的不同路径共享一个连接池"""
+    parts = urlsplit(api_url)
+    return f"{parts.scheme}://{parts.netloc}".lower()
+
+
+class UpstreamClientRegistry:
+    """
+    按上游源站缓存 httpx.AsyncClient
+
+    固定的源站（配置的默认上游、预热地址、上游池）的客户端在整个应用生命周期内复用；
+    其他源站（请求中的 api_url）最多保留 max_adhoc 个，按LRU淘汰，淘汰的客户端在没有进行中的请求后关闭。
+    """
+
+    def __init__(
+        self,
+        max_connections: int = UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive: int = UPSTREAM_MAX_KEEPALIVE,
+        keepalive_expiry: float = UPSTREAM_KEEPALIVE_EXPIRY,
+        http2: bool = UPSTREAM_HTTP2,
+        timeout: httpx.Timeout = UPSTREAM_TIMEOUT,
+        max_adhoc: int = UPSTREAM_MAX_ADHOC_POOLS
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = timeout
+        # HTTP/2 需要可选依赖 h2（pip install "httpx[http2]"）
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("[Upstream] 已启用HTTP/2但未安装h2，回退到HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.max_adhoc = max_adhoc
+        # 最久未使用的在最前面
+        self._clients: "OrderedDict[str, httpx.AsyncClient]" = OrderedDict()
+        self._pinned: Set[str] = {_origin_of(url) for url in UPSTREAM_PREWARM_URLS}
+        # 每个客户端上进行中的请求数；已淘汰但仍有请求的客户端等请求结束后关闭
+        self._in_use: Dict[httpx.AsyncClient, int] = {}
+        self._retiring: Set[httpx.AsyncClient] = set()
+        self._closing: Set[asyncio.Task] = set()
+        self.evicted = 0
+
+    def pin(self, api_urls: Iterable[str]) -> None:
+        """把配置的上游标记为固定（不会被淘汰）"""
+        for url in api_urls:
+            if url:
+                self._pinned.add(_origin_of(url))
+
+    def get(self, api_url: str) -> httpx.AsyncClient:
+        """获取（必要时创建）指定上游对应的共享客户端"""
+        origin = _origin_of(api_url)
+        client = self._clients.get(origin)
+        if client is None or client.is_closed:
+            client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=self.limits,
+                http2=self.http2
+            )
+            self._clients[origin] = client
+            logger.info("[Upstream] 创建连接池: %s (http2=%s)", origin, self.http2)
+        self._clients.move_to_end(origin)
+        if origin not in self._pinned:
+            self._evict()
+        return client
+
+    def _evict(self) -> None:
+        adhoc = [origin for origin in self._clients if origin not in self._pinned]
+        for origin in adhoc[:max(len(adhoc) - self.max_adhoc, 0)]:
+            client = self._clients.pop(origin)
+            self.evicted += 1
+            logger.info("[Upstream] 淘汰连接池: %s", origin)
+            if self._in_use.get(client):
+                self._retiring.add(client)
+            else:
+                self._close_later(client)
+
+    def _close_later(self, client: httpx.AsyncClient) -> None:
+        task = asyncio.get_running_loop().create_task(client.aclose())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    @asynccontextmanager
+    async def lease(self, api_url: str) -> AsyncIterator[httpx.AsyncClient]:
+        """
+        async with upstream_clients.lease(api_url) as client: ...
+        在请求期间使用指定上游的客户端，期间即使被淘汰也不会关闭
+        """
+        client = self.get(api_url)
+        self._in_use[client] = self._in_use.get(client, 0) + 1
+        try:
+            yield client
+        finally:
+            remaining = self._in_use[client] - 1
+            if remaining:
+                self._in_use[client] = remaining
+            else:
+                del self._in_use[client]
+                if client in self._retiring:
+                    self._retiring.discard(client)
+                    await client.aclose()
+
+    async def _warm_one(self, api_url: str) -> None:
+        origin = _origin_of(api_url)
+        client = self.get(api_url)
+        started = asyncio.get_running_loop().time()
+        try:
+            # 任意响应都可以：目的只是完成DNS、TCP和TLS握手，让连接进入keep-alive池
+            await client.head(origin + "/")
+            elapsed = asyncio.get_running_loop().time() - started
+            logger.info("[Upstream] 连接预热完成: %s (%.0fms)", origin, elapsed * 1000)
+        except httpx.HTTPError as e:
+            logger.warning("[Upstream] 连接预热失败: %s: %s", origin, e)
+
+    async def prewarm(self, api_urls: Iterable[str], timeout: float = UPSTREAM_PREWARM_TIMEOUT) -> None:
+        """并发预热多个上游连接，整体耗时不超过 timeout 秒"""
+        origins: Dict[str, str] = {}
+        for url in api_urls:
+            if url:
+                origins.setdefault(_origin_of(url), url)
+        if not origins:
+            return
+        self.pin(origins.values())
+        tasks = [asyncio.create_task(self._warm_one(url)) for url in origins.values()]
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning("[Upstream] %d 个上游预热超时（%.1f秒），跳过", len(pending), timeout)
+
+    async def aclose(self) -> None:
+        """关闭所有连接池（应用关闭时调用）"""
+        clients = list(self._clients.values()) + list(self._retiring)
+        self._clients.clear()
+        self._retiring.clear()
+        for client in clients:
+            await client.aclose()
+        logger.info("[Upstream] 已关闭 %d 个连接池", len(clients))
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pools": len(self._clients),
+            "pinned": sum(1 for origin in self._clients if origin in self._pinned),
+            "retiring": len(self._retiring),
+            "evicted": self.evicted
+        }
+
+
+# 全局注册表（整个应用共享）
+upstream_clients = UpstreamClientRegistry()
+
+
+def prewarm_targets(default_api_url: Optional[str]) -> list:
+    """启动时需要预热的上游地址列表"""
+    targets = list(UPSTREAM_PREWARM_URLS)
+    if default_api_url:
+        targets.insert(0, default_api_url)
+    return targets
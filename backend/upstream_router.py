@@ -0,0 +1,301 @@
+"""
+多上游路由
+在一组OpenAI兼容的上游之间按首token延迟（EWMA）和权重选择，带熔断、首token前自动故障转移和可选的对冲请求
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+from collections import deque
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, List, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# 上游池配置：JSON字符串或JSON文件路径，留空表示不启用（使用请求中的api_url或DEFAULT_API_URL）
+# 格式：[{"name": "primary", "url": "https://.../v1/chat/completions", "api_key": "可选",
+#        "weight": 1, "models": {"gpt-3.5-turbo": "实际模型名", "*": "默认模型名"}}]
+UPSTREAM_POOL = os.getenv("UPSTREAM_POOL", "")
+ROUTER_EWMA_ALPHA = float(os.getenv("ROUTER_EWMA_ALPHA", "0.3"))
+ROUTER_DEFAULT_TTFT = float(os.getenv("ROUTER_DEFAULT_TTFT", "2.0"))  # 没有样本时假定的首token延迟（秒）
+ROUTER_BREAKER_THRESHOLD = int(os.getenv("ROUTER_BREAKER_THRESHOLD", "3"))  # 连续失败多少次后熔断
+ROUTER_BREAKER_COOLDOWN = float(os.getenv("ROUTER_BREAKER_COOLDOWN", "30"))  # 熔断后多久允许试探（秒）
+ROUTER_HEDGE = os.getenv("ROUTER_HEDGE", "false").lower() in ("1", "true", "yes")
+ROUTER_HEDGE_PERCENTILE = float(os.getenv("ROUTER_HEDGE_PERCENTILE", "0.95"))
+ROUTER_HEDGE_MIN_DELAY = float(os.getenv("ROUTER_HEDGE_MIN_DELAY", "1.0"))  # 对冲等待的下限（秒）
+
+# 每个上游保留的首token延迟样本数（用于计算分位数）
+_TTFT_SAMPLES = 200
+
+# 熔断器状态
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class Upstream:
+    """一个上游及其健康状态"""
+
+    def __init__(self, name: str, url: str, api_key: Optional[str] = None,
+                 weight: float = 1.0, models: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.url = url
+        self.api_key = api_key
+        self.weight = max(weight, 0.01)
+        self.models = models or {}
+        self.ewma_ttft: Optional[float] = None
+        self.ttft_samples: Deque[float] = deque(maxlen=_TTFT_SAMPLES)
+        self.breaker = BREAKER_CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.trial_in_flight = False
+        self.requests = 0
+        self.failures = 0
+
+    def model_for(self, model_name: str) -> str:
+        return self.models.get(model_name) or self.models.get("*") or model_name
+
+    def available(self, now: float) -> bool:
+        """熔断打开时不可用；冷却结束后进入半开状态，只允许一个试探请求"""
+        if self.breaker == BREAKER_OPEN and now - self.opened_at >= ROUTER_BREAKER_COOLDOWN:
+            self.breaker = BREAKER_HALF_OPEN
+        if self.breaker == BREAKER_OPEN:
+            return False
+        if self.breaker == BREAKER_HALF_OPEN:
+            return not self.trial_in_flight
+        return True
+
+    def percentile_ttft(self, q: float) -> Optional[float]:
+        if not self.ttft_samples:
+            return None
+        ordered = sorted(self.ttft_samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "breaker": self.breaker,
+            "weight": self.weight,
+            "ewma_ttft": round(self.ewma_ttft, 3) if self.ewma_ttft is not None else None,
+            "p95_ttft": self.percentile_ttft(0.95),
+            "requests": self.requests,
+            "failures": self.failures
+        }
+
+
+def _counts_as_failure(error: BaseException) -> bool:
+    """只有上游自身的问题（5xx、429、网络错误）才计入熔断；401/400等请求问题不计入"""
+    if isinstance(error, HTTPException):
+        return error.status_code >= 500 or error.status_code == 429
+    return True
+
+
+class UpstreamRouter:
+    """上游池路由器"""
+
+    def __init__(self, upstreams: List[Upstream], hedge: bool = ROUTER_HEDGE):
+        self.upstreams = upstreams
+        self.hedge = hedge
+        self.failovers = 0
+        self.hedges_started = 0
+        self.hedges_won = 0
+
+    @classmethod
+    def from_env(cls) -> "UpstreamRouter":
+        config = UPSTREAM_POOL.strip()
+        if not config:
+            return cls([])
+        try:
+            if not config.startswith("["):
+                with open(config, encoding="utf-8") as f:
+                    config = f.read()
+            entries = json.loads(config)
+            upstreams = [
+                Upstream(
+                    name=entry.get("name") or entry["url"],
+                    url=entry["url"],
+                    api_key=entry.get("api_key"),
+                    weight=float(entry.get("weight", 1.0)),
+                    models=entry.get("models")
+                )
+                for entry in entries
+            ]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("[Router] 上游池配置无效，忽略: %s", e)
+            return cls([])
+        logger.info("[Router] 已加载 %d 个上游: %s", len(upstreams), ", ".join(u.name for u in upstreams))
+        return cls(upstreams)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.upstreams)
+
+    @property
+    def pool_id(self) -> str:
+        """上游池的标识（用于缓存键和日志）"""
+        return "pool:" + ",".join(u.name for u in self.upstreams)
+
+    def urls(self) -> List[str]:
+        return [u.url for u in self.upstreams]
+
+    def has_credentials(self) -> bool:
+        return any(u.api_key for u in self.upstreams)
+
+    def candidates(self) -> List[Upstream]:
+        """
+        按优先顺序排列可用上游
+
+        以 权重/首token延迟 作为速率做加权随机排序：延迟低、权重高的上游大概率排在前面，
+        但其他上游仍会分到少量流量，使它们的延迟估计保持更新。
+        """
+        now = time.monotonic()
+        available = [u for u in self.upstreams if u.available(now)]
+        if not available:
+            # 全部熔断时仍然尝试延迟最低的那个，而不是直接失败
+            available = sorted(self.upstreams, key=lambda u: u.ewma_ttft or ROUTER_DEFAULT_TTFT)[:1]
+        return sorted(
+            available,
+            key=lambda u: random.expovariate(u.weight / (u.ewma_ttft or ROUTER_DEFAULT_TTFT))
+        )
+
+    def _record_success(self, upstream: Upstream, ttft: float) -> None:
+        upstream.consecutive_failures = 0
+        upstream.breaker = BREAKER_CLOSED
+        upstream.ttft_samples.append(ttft)
+        if upstream.ewma_ttft is None:
+            upstream.ewma_ttft = ttft
+        else:
+            upstream.ewma_ttft = ROUTER_EWMA_ALPHA * ttft + (1 - ROUTER_EWMA_ALPHA) * upstream.ewma_ttft
+
+    def _record_failure(self, upstream: Upstream, error: BaseException) -> None:
+        upstream.failures += 1
+        if not _counts_as_failure(error):
+            return
+        upstream.consecutive_failures += 1
+        if upstream.breaker == BREAKER_HALF_OPEN or upstream.consecutive_failures >= ROUTER_BREAKER_THRESHOLD:
+            if upstream.breaker != BREAKER_OPEN:
+                logger.warning("[Router] 上游 %s 熔断（连续失败 %d 次）", upstream.name, upstream.consecutive_failures)
+            upstream.breaker = BREAKER_OPEN
+            upstream.opened_at = time.monotonic()
+
+    def _hedge_delay(self, upstream: Upstream) -> float:
+        p = upstream.percentile_ttft(ROUTER_HEDGE_PERCENTILE)
+        if p is None:
+            p = (upstream.ewma_ttft or ROUTER_DEFAULT_TTFT) * 2
+        return max(p, ROUTER_HEDGE_MIN_DELAY)
+
+    async def stream(
+        self,
+        call: Callable[..., AsyncGenerator[Any, None]],
+        messages: List[Dict[str, str]],
+        api_key: Optional[str],
+        model_name: str,
+        response_format: Optional[Dict[str, Any]] = None
+    ) -> AsyncGenerator[Any, None]:
+        """
+        通过上游池调用AI API，产出与 call 相同的数据块
+
+        首个数据块到达之前出错会自动换下一个上游；开启对冲时，主上游在p95首token延迟内
+        没有产出则并发启动下一个上游，先产出者胜出，另一个被取消。
+        首个数据块产出之后的错误不再故障转移，直接抛出。
+        """
+        generator, first_item = await self._first_token(call, self.candidates(), messages, api_key, model_name, response_format)
+        yield first_item
+        async for item in generator:
+            yield item
+
+    async def _first_token(self, call, candidates: List[Upstream], messages, api_key, model_name, response_format):
+        """
+        依次（或对冲地）启动候选上游，直到某个上游产出第一个数据块
+
+        Returns:
+            (胜出上游的生成器, 第一个数据块)；全部失败时抛出最后一个错误
+        """
+        generators: Dict[asyncio.Task, Any] = {}
+        started: Dict[asyncio.Task, float] = {}
+        owners: Dict[asyncio.Task, Upstream] = {}
+        hedged: set = set()
+        remaining = list(candidates)
+        hedges_left = 1 if self.hedge else 0
+        last_error: Optional[BaseException] = None
+
+        def start(upstream: Upstream) -> asyncio.Task:
+            upstream.requests += 1
+            if upstream.breaker == BREAKER_HALF_OPEN:
+                upstream.trial_in_flight = True
+            generator = call(messages, upstream.api_key or api_key, upstream.url,
+                             upstream.model_for(model_name), response_format)
+            task = asyncio.ensure_future(generator.__anext__())
+            generators[task] = generator
+            started[task] = time.monotonic()
+            owners[task] = upstream
+            logger.info("[Router] 调用上游: %s", upstream.name)
+            return task
+
+        try:
+            pending = {start(remaining.pop(0))}
+            while pending:
+                timeout = None
+                if hedges_left and remaining:
+                    oldest = min(pending, key=lambda t: started[t])
+                    timeout = max(0.0, started[oldest] + self._hedge_delay(owners[oldest]) - time.monotonic())
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 主上游迟迟没有首token，启动对冲请求
+                    hedges_left -= 1
+                    self.hedges_started += 1
+                    task = start(remaining.pop(0))
+                    hedged.add(task)
+                    pending.add(task)
+                    logger.info("[Router] 首token超过对冲等待时间，启动对冲: %s", owners[task].name)
+                    continue
+                for task in done:
+                    upstream = owners[task]
+                    upstream.trial_in_flight = False
+                    error = task.exception()
+                    if error is None:
+                        self._record_success(upstream, time.monotonic() - started[task])
+                        if task in hedged:
+                            self.hedges_won += 1
+                        return generators.pop(task), task.result()
+                    if isinstance(error, StopAsyncIteration):
+                        error = HTTPException(status_code=502, detail=f"上游 {upstream.name} 未返回任何内容")
+                    self._record_failure(upstream, error)
+                    last_error = error
+                    generators.pop(task)
+                    logger.warning("[Router] 上游 %s 在首token前失败: %s", upstream.name, getattr(error, "detail", error))
+                if not pending and remaining:
+                    # 故障转移：还没有向客户端发送任何内容，换下一个上游
+                    self.failovers += 1
+                    pending = {start(remaining.pop(0))}
+            if last_error is not None:
+                raise last_error
+            raise HTTPException(status_code=503, detail="没有可用的AI API上游")
+        finally:
+            # 取消落败或未完成的尝试，关闭其上游连接（胜出者已从 generators 中移除）
+            for task, generator in generators.items():
+                owners[task].trial_in_flight = False
+                if not task.done():
+                    task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                try:
+                    await generator.aclose()
+                except Exception:
+                    pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "hedge": self.hedge,
+            "failovers": self.failovers,
+            "hedges_started": self.hedges_started,
+            "hedges_won": self.hedges_won,
+            "upstreams": [u.stats() for u in self.upstreams]
+        }
+
+
+# 全局路由器
+upstream_router = UpstreamRouter.from_env()
@@ -1,10 +1,20 @@
 #!/bin/bash
 # 查看后端服务日志的脚本
+# 单进程时日志文件为 backend.log；SERVER_WORKERS>1 时每个工作进程写自己的 backend.<pid>.log，全部一起跟随
 
 LOG_DIR="$(cd "$(dirname "$0")" && pwd)/logs"
-LATEST_LOG=$(ls -t "$LOG_DIR"/*.log 2>/dev/null | head -1)
 
-if [ -z "$LATEST_LOG" ]; then
+shopt -s nullglob
+LOG_FILES=()
+for LOG_FILE in "$LOG_DIR"/backend.log "$LOG_DIR"/backend.*.log; do
+    # 已轮转的日志（backend_<开始时间>.log、backend.<pid>_<开始时间>.log）不跟随
+    case "$(basename "$LOG_FILE")" in
+        *_*) continue ;;
+    esac
+    [ -f "$LOG_FILE" ] && LOG_FILES+=("$LOG_FILE")
+done
+
+if [ ${#LOG_FILES[@]} -eq 0 ]; then
     echo "❌ 未找到日志文件"
     echo "日志目录: $LOG_DIR"
     echo ""
@@ -13,11 +23,13 @@ if [ -z "$LATEST_LOG" ]; then
 fi
 
 echo "📋 查看后端服务日志"
-echo "日志文件: $LATEST_LOG"
+for LOG_FILE in "${LOG_FILES[@]}"; do
+    echo "日志文件: $LOG_FILE"
+done
+echo "已轮转的日志为 backend_<开始时间>.log.gz（多进程时为 backend.<pid>_<开始时间>.log.gz），可用 zcat 查看"
 echo "按 Ctrl+C 退出"
 echo "----------------------------------------"
 echo ""
 
-# 实时查看日志（最后50行）
-tail -f -n 50 "$LATEST_LOG"
-
+# 实时查看日志（每个文件最后50行；-F 在日志轮转后自动跟随新文件）
+tail -F -n 50 "${LOG_FILES[@]}"
@@ -125,6 +125,14 @@ export const ChatWindow: React.FC = () => {
     }
   };
 
+  const handleNewChat = () => {
+    if (isLoading) return;
+    // 清空消息并开始新的对话，之后的请求不再带上之前的对话历史
+    AIService.resetConversation();
+    setMessages([]);
+    setError(null);
+  };
+
   const handleKeyPress = (e: React.KeyboardEvent<HTMLTextAreaElement>) => {
     if (e.key === 'Enter' && !e.shiftKey) {
       e.preventDefault();
@@ -144,6 +152,21 @@ export const ChatWindow: React.FC = () => {
           <span style={{ fontSize: '11px', opacity: 0.8 }}>
             {PlatformDetector.getPlatformName()}
           </span>
+          <button
+            onClick={handleNewChat}
+            disabled={isLoading}
+            style={{
+              background: 'rgba(255, 255, 255, 0.2)',
+              border: 'none',
+              color: 'white',
+              padding: '4px 12px',
+              borderRadius: '4px',
+              cursor: 'pointer',
+              fontSize: '12px',
+            }}
+          >
+            新对话
+          </button>
           <button
             onClick={() => setShowSettings(true)}
             style={{
@@ -9,6 +9,9 @@ export class AIService {
   private static apiKey: string | null = null;
   private static apiUrl: string = 'https://api.openai.com/v1/chat/completions';
   private static modelName: string = 'gpt-3.5-turbo';
+  private static conversationId: string | null = null;
+  // 创建对话会话时的文档标识，切换到其他文档后开始新的对话
+  private static conversationDocument: string | null = null;
 
   /**
    * 设置API密钥
@@ -38,6 +41,86 @@ export class AIService {
     return this.modelName;
   }
 
+  /**
+   * 开始新的对话（之后的请求不再带上之前的对话历史），并通知后端删除旧会话
+   */
+  static resetConversation(): void {
+    const conversationId = this.conversationId;
+    this.forgetConversation();
+    if (conversationId) {
+      // 删除失败时会话到期后由后端自动清理
+      fetch(`${this.getBackendUrl()}/api/conversations/${conversationId}`, { method: 'DELETE' }).catch(() => undefined);
+    }
+  }
+
+  private static forgetConversation(): void {
+    this.conversationId = null;
+    this.conversationDocument = null;
+  }
+
+  /**
+   * 当前文档的标识（Office 提供的文档地址；未保存的新文档或不支持的平台为空字符串）
+   */
+  private static getDocumentKey(): string {
+    try {
+      if (typeof Office !== 'undefined' && Office.context && Office.context.document) {
+        return Office.context.document.url || '';
+      }
+    } catch (error) {
+      console.warn('⚠️ 获取文档标识失败', error);
+    }
+    return '';
+  }
+
+  /**
+   * 获取对话会话ID，没有时向后端创建；创建失败时返回null（请求不带对话历史）
+   * 切换到其他文档后自动开始新的对话，之前关于其他文档的对话不会进入提示词
+   */
+  private static async ensureConversation(backendUrl: string): Promise<string | null> {
+    const documentKey = this.getDocumentKey();
+    if (this.conversationId && documentKey !== this.conversationDocument) {
+      console.log('💬 文档已切换，开始新的对话');
+      this.resetConversation();
+    }
+    if (this.conversationId) {
+      return this.conversationId;
+    }
+    try {
+      const response = await fetch(`${backendUrl}/api/conversations`, { method: 'POST' });
+      if (!response.ok) {
+        console.warn(`⚠️ 创建对话会话失败 (${response.status})，本次请求不带对话历史`);
+        return null;
+      }
+      const data = await response.json();
+      this.conversationId = data.conversation_id;
+      this.conversationDocument = documentKey;
+      console.log(`💬 已创建对话会话: ${this.conversationId}`);
+      return this.conversationId;
+    } catch (error) {
+      console.warn('⚠️ 创建对话会话失败，本次请求不带对话历史', error);
+      return null;
+    }
+  }
+
+  /**
+   * 编码请求体：超过阈值且浏览器支持 CompressionStream 时用gzip压缩（后端边接收边解压）
+   */
+  private static async encodeRequestBody(json: string): Promise<{ body: BodyInit; headers: Record<string, string> }> {
+    const headers: Record<string, string> = { 'Content-Type': 'application/json' };
+    if (json.length < 64 * 1024 || typeof CompressionStream === 'undefined') {
+      return { body: json, headers };
+    }
+    try {
+      const stream = new Blob([json]).stream().pipeThrough(new CompressionStream('gzip'));
+      const compressed = await new Response(stream).arrayBuffer();
+      console.log(`📤 [Fetch] 请求体gzip压缩: ${json.length} -> ${compressed.byteLength} 字节`);
+      return { body: compressed, headers: { ...headers, 'Content-Encoding': 'gzip' } };
+    } catch (error) {
+      console.warn('⚠️ 请求体压缩失败，发送未压缩的请求体', error);
+      return { body: json, headers };
+    }
+  }
+
   /**
    * 处理用户请求并返回编辑操作
    */
@@ -147,12 +230,14 @@ ${documentContent.substring(0, 2000)}${documentContent.length > 2000 ? '...' : '
     console.log(`🌐 当前页面协议: ${window.location.protocol}`);
     console.log(`🌐 当前页面主机: ${window.location.host}`);
     
+    const conversationId = await this.ensureConversation(backendUrl);
     const requestBody = {
       user_request: userRequest,
       document_content: documentContent,
       api_key: this.apiKey,
       api_url: this.apiUrl,
       model_name: this.modelName,
+      conversation_id: conversationId,
     };
 
     const requestStartTime = Date.now();
@@ -168,7 +253,9 @@ ${documentContent.substring(0, 2000)}${documentContent.length > 2000 ? '...' : '
     try {
       console.log(`📤 [Fetch] 准备发送请求到: ${apiEndpoint}`);
       console.log(`📤 [Fetch] 请求方法: POST`);
-      console.log(`📤 [Fetch] 请求体大小: ${JSON.stringify(requestBody).length} 字节`);
+      const requestJson = JSON.stringify(requestBody);
+      console.log(`📤 [Fetch] 请求体大小: ${requestJson.length} 字节`);
+      const encodedBody = await this.encodeRequestBody(requestJson);
       console.log(`📤 [Fetch] AbortController信号状态: ${controller.signal.aborted ? '已中止' : '活跃'}`);
       
       // 监听AbortController信号
@@ -193,10 +280,8 @@ ${documentContent.substring(0, 2000)}${documentContent.length > 2000 ? '...' : '
       try {
         response = await fetch(apiEndpoint, {
           method: 'POST',
-          headers: {
-            'Content-Type': 'application/json',
-          },
-          body: JSON.stringify(requestBody),
+          headers: encodedBody.headers,
+          body: encodedBody.body,
           signal: controller.signal,
         });
         
@@ -234,6 +319,10 @@ ${documentContent.substring(0, 2000)}${documentContent.length > 2000 ? '...' : '
         console.error(`❌ [Fetch] 响应状态码错误: ${response.status}`);
         const errorText = await response.text();
         console.error(`❌ [Fetch] 错误响应内容: ${errorText.substring(0, 500)}`);
+        if (response.status === 404 && conversationId) {
+          // 对话会话已过期，下一次请求创建新会话
+          this.forgetConversation();
+        }
         throw new Error(`后端API请求失败 (${response.status}): ${errorText.substring(0, 200)}`);
       }
 
@@ -513,6 +602,11 @@ ${documentContent.substring(0, 2000)}${documentContent.length > 2000 ? '...' : '
               }
               console.log(`✅ [SSE] 完整结果JSON: ${JSON.stringify(result, null, 2)}`);
               console.log(`✅ [SSE] ════════════════════════════════════════`);
+            } else if (eventData.type === 'message') {
+              console.log(`💬 [SSE] 收到增量消息: "${eventData.message}"，耗时: ${eventReceiveDuration.toFixed(2)} 秒`);
+            } else if (eventData.type === 'edit') {
+              // 增量编辑操作：最终仍以 result 事件中的完整列表为准（按 index 与其中的编辑操作对应）
+              console.log(`🧩 [SSE] 收到增量编辑操作 #${eventData.index + 1}: type=${eventData.data?.type}，耗时: ${eventReceiveDuration.toFixed(2)} 秒`);
             } else if (eventData.type === 'error') {
               console.error(`❌ [SSE] ════════════════════════════════════════`);
               console.error(`❌ [SSE] 📨 收到错误事件`);
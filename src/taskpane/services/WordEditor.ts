@@ -21,6 +21,11 @@ export interface EditOperation {
   tableData?: string[][]; // 表格数据，二维数组，第一行通常是表头
   // 段落样式相关参数
   style?: 'Heading1' | 'Heading2' | 'Heading3' | 'Normal' | string; // 段落样式，用于标题
+  // 后端解析的锚点：searchText 在文档中的出现次数和起始偏移量（0 表示文档中找不到）
+  anchorCount?: number;
+  anchorOffsets?: number[];
+  // 在模型输出的 edits 数组中的位置，与增量 edit 事件的 index 一致（用于对应已收到的增量编辑操作）
+  index?: number;
 }
 
 export class WordEditor {
@@ -196,6 +201,12 @@ export class WordEditor {
     console.log(`🔧 执行编辑操作: type=${edit.type}, content=${edit.content?.substring(0, 30) || 'N/A'}..., style=${edit.style || 'none'}`);
     const body = context.document.body;
 
+    // 后端已确认锚点不存在时跳过，不再为它发起一次 body.search
+    if (edit.searchText && edit.anchorCount === 0) {
+      console.warn(`⚠️ 锚点在文档中不存在，跳过操作: type=${edit.type}, searchText=${edit.searchText.substring(0, 50)}`);
+      return;
+    }
+
     switch (edit.type) {
       case 'insert':
         if (edit.position === 'start') {
@@ -13,13 +13,18 @@ def main():
     dist_dir = project_root / "dist"
     
     if not dist_dir.exists():
+        # 构建在后台进行，不阻塞服务启动；后端检测到 dist 目录出现后会自动加载静态文件
+        # 需要等构建完成再启动时使用 --wait-build
         print("⚠️  警告: dist目录不存在，正在构建前端...")
         print("运行: npm run build")
-        result = subprocess.run(["npm", "run", "build"], cwd=project_root)
-        if result.returncode != 0:
-            print("❌ 前端构建失败，请检查错误信息")
-            sys.exit(1)
-        print("✅ 前端构建完成")
+        build = subprocess.Popen(["npm", "run", "build"], cwd=project_root)
+        if "--wait-build" in sys.argv:
+            if build.wait() != 0:
+                print("❌ 前端构建失败，请检查错误信息")
+                sys.exit(1)
+            print("✅ 前端构建完成")
+        else:
+            print("⏳ 前端在后台构建，完成前访问页面会返回404")
     
     # 启动Python服务
     backend_dir = project_root / "backend"
@@ -34,9 +39,9 @@ def main():
     os.chdir(backend_dir)
     sys.path.insert(0, str(backend_dir))
     
-    # 直接运行main.py
+    # 导入main.py没有副作用，由 run_server 创建应用并启动服务
     import main
-    # main.py的if __name__ == "__main__"块会自动执行
+    main.run_server()
 
 if __name__ == "__main__":
     main()